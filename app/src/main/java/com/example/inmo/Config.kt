@@ -24,6 +24,8 @@ object Config {
     // 流传输配置
     const val FRAME_CAPTURE_INTERVAL = 200L // 帧捕获间隔(ms) - 5 FPS (降低帧率)
     const val CHUNK_SIZE = 8192 // 数据块大小 (8KB)
+    const val PROCESSED_PIXEL_FORMAT = "rgb565" // 服务器下发的像素格式: nv21 / rgb565 / rgb888（由服务器完成转换）
+    const val UPLOAD_CODEC = "zlib" // 上传帧编码: raw / zlib（zlib可大幅减少上行带宽）
     
     // 视频配置
     const val MAX_VIDEO_WIDTH = 640 // 最大视频宽度
@@ -108,8 +108,12 @@ class ProcessedVideoView @JvmOverloads constructor(
                 // 清除画布
                 canvas.drawColor(Color.BLACK)
                 
-                // 尝试将YUV数据转换为RGB bitmap
-                val bitmap = convertYuvToRgbBitmap(yuvData)
+                // 服务器已转换为RGB565时直接拷贝，否则在本地将YUV数据转换为RGB bitmap
+                val bitmap = if (yuvData.size == videoWidth * videoHeight * 2) {
+                    copyRgb565ToBitmap(yuvData)
+                } else {
+                    convertYuvToRgbBitmap(yuvData)
+                }
                 
                 if (bitmap != null) {
                     // 计算缩放和居中显示
@@ -149,6 +153,22 @@ class ProcessedVideoView @JvmOverloads constructor(
         }
     }
     
+    private fun copyRgb565ToBitmap(rgbData: ByteArray): Bitmap? {
+        try {
+            if (reusableBitmap == null) {
+                reusableBitmap = Bitmap.createBitmap(videoWidth, videoHeight, Bitmap.Config.RGB_565)
+            }
+            
+            // 服务器按小端序输出RGB565，与Bitmap内存布局一致
+            reusableBitmap!!.copyPixelsFromBuffer(ByteBuffer.wrap(rgbData))
+            return reusableBitmap
+            
+        } catch (e: Exception) {
+            Log.e(TAG, "拷贝RGB565数据失败: ${e.message}")
+            return null
+        }
+    }
+    
     private fun convertYuvToRgbBitmap(yuvData: ByteArray): Bitmap? {
         try {
             Log.d(TAG, "转换YUV数据: 尺寸=${videoWidth}x${videoHeight}, 数据大小=${yuvData.size}")
@@ -51,6 +51,11 @@ class StreamingCameraActivity : AppCompatActivity(), SurfaceHolder.Callback {
     private var videoWidth = 640
     private var videoHeight = 480
     
+    // 采集参数（可由服务器的拥塞反馈调整）
+    private var frameCaptureInterval = Config.FRAME_CAPTURE_INTERVAL
+    private var captureMaxWidth = Config.MAX_VIDEO_WIDTH
+    private var captureMaxHeight = Config.MAX_VIDEO_HEIGHT
+    
     // 隐藏的Surface用于在切换视图时维持摄像头预览
     private var hiddenSurfaceView: SurfaceView? = null
     
@@ -65,7 +70,6 @@ class StreamingCameraActivity : AppCompatActivity(), SurfaceHolder.Callback {
     companion object {
         private const val TAG = "StreamingCameraActivity"
         private const val CAMERA_PERMISSION_REQUEST_CODE = 100
-        private val FRAME_CAPTURE_INTERVAL = Config.FRAME_CAPTURE_INTERVAL
     }
     
     override fun onCreate(savedInstanceState: Bundle?) {
@@ -195,6 +199,12 @@ class StreamingCameraActivity : AppCompatActivity(), SurfaceHolder.Callback {
                     Toast.makeText(this@StreamingCameraActivity, "流传输错误: $error", Toast.LENGTH_SHORT).show()
                 }
             }
+            
+            override fun onAdjustCapture(fps: Int, width: Int, height: Int) {
+                runOnUiThread {
+                    adjustCapture(fps, width, height)
+                }
+            }
         })
     }   
  
@@ -237,13 +247,40 @@ class StreamingCameraActivity : AppCompatActivity(), SurfaceHolder.Callback {
             override fun run() {
                 if (isStreamingActive.get() && isPreviewRunning) {
                     captureFrame()
-                    handler.postDelayed(this, FRAME_CAPTURE_INTERVAL)
+                    handler.postDelayed(this, frameCaptureInterval)
                 }
             }
         }
         handler.post(frameCapture!!)
     }
     
+    /**
+     * 按服务器建议调整采集帧率和分辨率（分辨率变化时重启预览）
+     */
+    private fun adjustCapture(fps: Int, width: Int, height: Int) {
+        if (fps > 0) {
+            frameCaptureInterval = 1000L / fps
+        }
+        
+        val targetWidth = minOf(width, Config.MAX_VIDEO_WIDTH)
+        val targetHeight = minOf(height, Config.MAX_VIDEO_HEIGHT)
+        if (targetWidth != captureMaxWidth || targetHeight != captureMaxHeight) {
+            captureMaxWidth = targetWidth
+            captureMaxHeight = targetHeight
+            
+            if (isPreviewRunning) {
+                stopFrameCapture()
+                stopCameraPreview()
+                startCameraPreview()
+                if (isStreamingActive.get()) {
+                    startFrameCapture()
+                }
+            }
+        }
+        
+        Log.d(TAG, "采集调整为: 间隔=${frameCaptureInterval}ms, 最大尺寸=${captureMaxWidth}x${captureMaxHeight}")
+    }
+    
     private fun stopFrameCapture() {
         frameCapture?.let { handler.removeCallbacks(it) }
         frameCapture = null
@@ -518,8 +555,8 @@ class StreamingCameraActivity : AppCompatActivity(), SurfaceHolder.Callback {
                 val supportedPreviewSizes = parameters.supportedPreviewSizes
                 
                 if (supportedPreviewSizes.isNotEmpty()) {
-                    // 选择合适的分辨率（不超过640x480）
-                    val targetSize = findBestPreviewSize(supportedPreviewSizes, Config.MAX_VIDEO_WIDTH, Config.MAX_VIDEO_HEIGHT)
+                    // 选择合适的分辨率（不超过当前采集上限，默认640x480）
+                    val targetSize = findBestPreviewSize(supportedPreviewSizes, captureMaxWidth, captureMaxHeight)
                     parameters.setPreviewSize(targetSize.width, targetSize.height)
                     
                     // 保存实际的预览尺寸
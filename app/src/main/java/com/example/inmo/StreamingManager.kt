@@ -9,7 +9,9 @@ import org.json.JSONObject
 import retrofit2.Call
 import retrofit2.Callback
 import retrofit2.Response
+import java.io.ByteArrayOutputStream
 import java.util.concurrent.atomic.AtomicBoolean
+import java.util.zip.Deflater
 
 class StreamingManager(private val serverUrl: String) {
     
@@ -27,6 +29,11 @@ class StreamingManager(private val serverUrl: String) {
         fun onChunkSent(success: Boolean)
         fun onProcessedData(data: ByteArray)
         fun onError(error: String)
+        
+        /**
+         * 服务器根据拥塞情况建议调整采集帧率和分辨率
+         */
+        fun onAdjustCapture(fps: Int, width: Int, height: Int) {}
     }
     
     private var callback: StreamingCallback? = null
@@ -57,6 +64,12 @@ class StreamingManager(private val serverUrl: String) {
                             callback?.onStreamStarted(streamId)
                             Log.d(TAG, "流开始成功: $streamId")
                         }
+                    } else if (response.code() == 503) {
+                        // 服务器处理能力已满，按 Retry-After 提示稍后重试
+                        val retryAfter = response.headers()["Retry-After"] ?: "?"
+                        val error = "服务器繁忙，请 $retryAfter 秒后重试"
+                        Log.w(TAG, error)
+                        callback?.onError(error)
                     } else {
                         val error = "开始流失败: ${response.message()}"
                         Log.e(TAG, error)
@@ -80,8 +93,10 @@ class StreamingManager(private val serverUrl: String) {
             return
         }
         
-        val requestBody = data.toRequestBody("application/octet-stream".toMediaTypeOrNull())
-        NetworkManager.videoApiService.uploadChunk(streamId, requestBody)
+        val codec = Config.UPLOAD_CODEC
+        val payload = if (codec == "zlib") compressFrame(data) else data
+        val requestBody = payload.toRequestBody("application/octet-stream".toMediaTypeOrNull())
+        NetworkManager.videoApiService.uploadChunk(streamId, codec, requestBody)
             .enqueue(object : Callback<ChunkUploadResponse> {
                 override fun onResponse(
                     call: Call<ChunkUploadResponse>,
@@ -102,6 +117,23 @@ class StreamingManager(private val serverUrl: String) {
             })
     }
     
+    /**
+     * zlib压缩一帧（最快速度档，NV21帧通常可压缩数倍），服务器需要像素时才解压
+     */
+    private fun compressFrame(data: ByteArray): ByteArray {
+        val deflater = Deflater(Deflater.BEST_SPEED)
+        deflater.setInput(data)
+        deflater.finish()
+        val output = ByteArrayOutputStream(data.size / 4)
+        val buffer = ByteArray(Config.CHUNK_SIZE)
+        while (!deflater.finished()) {
+            val count = deflater.deflate(buffer)
+            output.write(buffer, 0, count)
+        }
+        deflater.end()
+        return output.toByteArray()
+    }
+    
     fun stopStream() {
         val streamId = currentStreamId
         if (!isStreaming.get() || streamId == null) {
@@ -155,6 +187,7 @@ class StreamingManager(private val serverUrl: String) {
                 // 请求处理后的数据流
                 val data = JSONObject()
                 data.put("stream_id", streamId)
+                data.put("format", Config.PROCESSED_PIXEL_FORMAT)
                 socket?.emit("request_processed_stream", data)
             }
             
@@ -166,6 +199,11 @@ class StreamingManager(private val serverUrl: String) {
                 try {
                     if (args.isNotEmpty()) {
                         val data = args[0] as JSONObject
+                        if (data.optBoolean("repeat", false)) {
+                            // 画面未变化，服务器只发送重复标记，继续显示上一帧
+                            Log.d(TAG, "画面未变化，沿用第 ${data.optInt("repeat_of")} 帧")
+                            return@on
+                        }
                         val base64Data = data.getString("data")
                         val decodedData = android.util.Base64.decode(base64Data, android.util.Base64.DEFAULT)
                         Log.d(TAG, "接收到处理后数据: ${decodedData.size} bytes")
@@ -176,6 +214,21 @@ class StreamingManager(private val serverUrl: String) {
                 }
             }
             
+            socket?.on("adjust_capture") { args ->
+                try {
+                    if (args.isNotEmpty()) {
+                        val data = args[0] as JSONObject
+                        val fps = data.getInt("fps")
+                        val width = data.getInt("width")
+                        val height = data.getInt("height")
+                        Log.d(TAG, "服务器建议调整采集: ${fps}fps ${width}x${height} (${data.optString("reason")})")
+                        callback?.onAdjustCapture(fps, width, height)
+                    }
+                } catch (e: Exception) {
+                    Log.e(TAG, "处理采集调整失败: ${e.message}")
+                }
+            }
+            
             socket?.on("error") { args ->
                 val error = if (args.isNotEmpty()) args[0].toString() else "WebSocket错误"
                 Log.e(TAG, "WebSocket错误: $error")
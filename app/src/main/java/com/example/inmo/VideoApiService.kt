@@ -16,6 +16,7 @@ interface VideoApiService {
     @POST("stream/{streamId}/chunk")
     fun uploadChunk(
         @Path("streamId") streamId: String,
+        @Header("X-Frame-Codec") codec: String,
         @Body chunk: RequestBody
     ): Call<ChunkUploadResponse>
     
@@ -1,13 +1,21 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from flask import Flask, request, jsonify, send_file, url_for
+from flask import Flask, Request, Response, request, jsonify, url_for
 from flask_cors import CORS
 import os
+import json
+import math
+import shutil
+import heapq
+import hashlib
+import sqlite3
 import uuid
 import time
 import threading
+from collections import OrderedDict, deque
 from datetime import datetime
+from werkzeug.http import http_date, parse_content_range_header
 import logging
 
 # 配置日志
@@ -22,47 +30,1290 @@ UPLOAD_FOLDER = 'uploads'
 PROCESSED_FOLDER = 'processed'
 ALLOWED_EXTENSIONS = {'mp4', 'avi', 'mov', 'mkv'}
 
+# 分块上传配置
+UPLOAD_BLOCK_SIZE = 1024 * 1024  # 每次从请求流读取1MB，内存占用与文件大小无关
+MAX_UPLOAD_SIZE = 4 * 1024 * 1024 * 1024  # 单个视频最大4GB
+
+# 处理队列配置
+PROCESSING_WORKERS = int(os.environ.get('PROCESSING_WORKERS', 2))  # 同时处理的视频数
+MAX_PENDING_JOBS = int(os.environ.get('MAX_PENDING_JOBS', 50))  # 排队上限，超出后拒绝新上传
+JOB_PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+DEFAULT_JOB_DURATION = 8.0  # 没有历史数据时估算的单个任务耗时（秒）
+
+# 状态存储配置
+DATABASE_PATH = os.environ.get('VIDEO_DB_PATH', 'videos.db')
+PROGRESS_FLUSH_INTERVAL = 1.0  # 处理进度等缓存字段批量写入数据库的间隔（秒）
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# 下载配置
+DOWNLOAD_BLOCK_SIZE = 256 * 1024  # 服务器不支持sendfile时每次读取的块大小
+VIDEO_CACHE_MAX_AGE = 3600  # 处理结果生成后不再修改，允许客户端缓存
+PROCESSING_BLOCK_SIZE = 256 * 1024  # 处理结果按块写出，边处理边可下载
+PROGRESSIVE_STALL_TIMEOUT = 60  # 渐进式下载等待新数据的最长时间（秒）
+
+# 状态推送配置
+MAX_STATUS_WAIT = 60  # 长轮询 ?wait= 的最长等待时间（秒）
+SSE_KEEPALIVE_INTERVAL = 15  # SSE没有事件时发送心跳的间隔（秒）
+TERMINAL_STATUSES = ('completed', 'failed')
+
+# 处理结果缓存（按内容摘要复用），超出容量时淘汰最久未使用的结果
+PROCESSED_CACHE_MAX_BYTES = int(os.environ.get('PROCESSED_CACHE_MAX_BYTES', 10 * 1024 * 1024 * 1024))
+
+# 过期清理配置
+VIDEO_TTL = int(os.environ.get('VIDEO_TTL', 3600))  # 视频保留时间（秒）
+STORAGE_QUOTA_BYTES = int(os.environ.get('STORAGE_QUOTA_BYTES', 0))  # uploads和processed总配额，0表示不限制
+EXPIRY_CHECK_INTERVAL = 30  # 没有到期任务时检查磁盘配额的间隔（秒）
+DELETE_BATCH_SIZE = 100  # 每批删除的视频数
+
 # 确保目录存在
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(PROCESSED_FOLDER, exist_ok=True)
 
-# 视频处理状态存储
-video_status = {}
+# 分块上传会话
+upload_sessions = {}
+upload_sessions_lock = threading.Lock()
 
 def allowed_file(filename):
     """检查文件扩展名是否允许"""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def simulate_video_processing(video_id, input_path, output_path):
-    """模拟视频处理过程"""
+class HashingUploadFile:
+    """multipart解析时直接写入uploads目录并同步计算SHA-256的文件对象"""
+
+    def __init__(self):
+        self.path = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4()}.upload")
+        self.file = open(self.path, 'w+b')
+        self.hasher = hashlib.sha256()
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.file.write(data)
+
+    def read(self, *args):
+        return self.file.read(*args)
+
+    def seek(self, *args):
+        return self.file.seek(*args)
+
+    def tell(self):
+        return self.file.tell()
+
+    def flush(self):
+        return self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+    def discard(self):
+        """关闭并删除临时文件（已被移走时不做任何事）"""
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class HashingUploadRequest(Request):
+    """上传接口的文件不经过Werkzeug临时文件，边接收边写盘边计算摘要"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.path == '/api/upload/video':
+            return HashingUploadFile()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+app.request_class = HashingUploadRequest
+
+class UploadSession:
+    """可断点续传的分块上传会话
+
+    文件在创建时按总大小预分配，各分块直接写入各自的偏移位置，
+    因此分块可以乱序或并行上传，断线后只需补传缺失的区间。
+    """
+
+    def __init__(self, upload_id, device_id, filename, total_size):
+        self.upload_id = upload_id
+        self.device_id = device_id
+        self.filename = filename
+        self.total_size = total_size
+        self.part_path = os.path.join(UPLOAD_FOLDER, f"{upload_id}.part")
+        self.created_at = datetime.now()
+        self.ranges = []  # 已接收的字节区间 [start, end)，保持有序且不重叠
+        self.lock = threading.Lock()
+        # 内容摘要按已连续接收的前缀增量计算，hash_offset之前的字节已计入
+        self.hasher = hashlib.sha256()
+        self.hash_offset = 0
+        self.hash_lock = threading.Lock()
+
+    def preallocate(self):
+        """按总大小预分配文件"""
+        with open(self.part_path, 'wb') as f:
+            if self.total_size > 0 and hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(f.fileno(), 0, self.total_size)
+                    return
+                except OSError:
+                    pass
+            f.truncate(self.total_size)
+
+    def write_part(self, start, stream, length):
+        """将请求流中的数据直接写入文件偏移处，返回实际写入的字节数"""
+        offset = start
+        # 分块正好接在已计算摘要的位置之后时，边写边计算摘要（顺序上传的常见情况）
+        hashing = self.hash_lock.acquire(blocking=False)
+        if hashing and self.hash_offset != start:
+            self.hash_lock.release()
+            hashing = False
+        try:
+            with open(self.part_path, 'r+b') as f:
+                f.seek(start)
+                remaining = length
+                while remaining > 0:
+                    block = stream.read(min(UPLOAD_BLOCK_SIZE, remaining))
+                    if not block:
+                        break
+                    f.write(block)
+                    if hashing:
+                        self.hasher.update(block)
+                        self.hash_offset += len(block)
+                    offset += len(block)
+                    remaining -= len(block)
+        finally:
+            if hashing:
+                self.hash_lock.release()
+            # 即使连接中途断开，已写入的部分也记为已接收
+            if offset > start:
+                self.mark_received(start, offset)
+        self.advance_hash()
+        return offset - start
+
+    def advance_hash(self):
+        """把乱序到达后变为连续的数据计入摘要（从页缓存读回）"""
+        with self.hash_lock:
+            with self.lock:
+                if not self.ranges or self.ranges[0][0] != 0:
+                    return
+                contiguous_end = self.ranges[0][1]
+            if contiguous_end <= self.hash_offset:
+                return
+            with open(self.part_path, 'rb') as f:
+                f.seek(self.hash_offset)
+                while self.hash_offset < contiguous_end:
+                    block = f.read(min(UPLOAD_BLOCK_SIZE, contiguous_end - self.hash_offset))
+                    if not block:
+                        break
+                    self.hasher.update(block)
+                    self.hash_offset += len(block)
+
+    def hexdigest(self):
+        """返回完整文件的SHA-256，需在全部数据接收后调用"""
+        self.advance_hash()
+        with self.hash_lock:
+            if self.hash_offset != self.total_size:
+                raise ValueError('文件尚未上传完整')
+            return self.hasher.hexdigest()
+
+    def mark_received(self, start, end):
+        """合并新接收的区间"""
+        with self.lock:
+            merged = []
+            for r_start, r_end in self.ranges:
+                if r_end < start or r_start > end:
+                    merged.append([r_start, r_end])
+                else:
+                    start = min(start, r_start)
+                    end = max(end, r_end)
+            merged.append([start, end])
+            merged.sort()
+            self.ranges = merged
+
+    def received_bytes(self):
+        with self.lock:
+            return sum(r_end - r_start for r_start, r_end in self.ranges)
+
+    def missing_ranges(self):
+        """返回尚未接收的区间"""
+        with self.lock:
+            missing = []
+            cursor = 0
+            for r_start, r_end in self.ranges:
+                if r_start > cursor:
+                    missing.append([cursor, r_start])
+                cursor = max(cursor, r_end)
+            if cursor < self.total_size:
+                missing.append([cursor, self.total_size])
+            return missing
+
+    def is_complete(self):
+        return not self.missing_ranges()
+
+    def to_dict(self):
+        with self.lock:
+            ranges = [list(r) for r in self.ranges]
+        return {
+            'uploadId': self.upload_id,
+            'size': self.total_size,
+            'blockSize': UPLOAD_BLOCK_SIZE,
+            'receivedBytes': self.received_bytes(),
+            'receivedRanges': ranges,
+            'missingRanges': self.missing_ranges(),
+            'complete': self.is_complete()
+        }
+
+    def to_record(self):
+        """转换为数据库记录"""
+        with self.lock:
+            ranges = json.dumps(self.ranges)
+        return {
+            'upload_id': self.upload_id,
+            'device_id': self.device_id,
+            'filename': self.filename,
+            'total_size': self.total_size,
+            'ranges': ranges,
+            'created_at': self.created_at.isoformat()
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        """从数据库记录恢复会话"""
+        session = cls(record['upload_id'], record['device_id'], record['filename'], record['total_size'])
+        session.created_at = datetime.fromisoformat(record['created_at'])
+        session.ranges = json.loads(record['ranges'])
+        return session
+
+class VideoStatusStore:
+    """基于SQLite的视频状态存储
+
+    每个线程使用独立连接（WAL模式，读写互不阻塞）。状态变化立即写入，
+    处理进度和访问时间先缓存在内存中，由后台线程按批次写入，避免每次更新都提交事务。
+    """
+
+    VIDEO_COLUMNS = [
+        ('video_id', 'TEXT PRIMARY KEY'),
+        ('device_id', 'TEXT'),
+        ('original_filename', 'TEXT'),
+        ('status', 'TEXT NOT NULL'),
+        ('priority', "TEXT DEFAULT 'normal'"),
+        ('progress', 'REAL DEFAULT 0'),
+        ('uploaded_at', 'TEXT NOT NULL'),
+        ('completed_at', 'TEXT'),
+        ('input_path', 'TEXT'),
+        ('output_path', 'TEXT'),
+        ('error', 'TEXT'),
+        ('digest', 'TEXT'),
+        ('leader_id', 'TEXT'),  # 相同内容的任务正在处理时，跟随该任务的结果
+        ('expires_at', 'REAL'),
+        ('last_accessed', 'REAL')
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.pending_updates = {}  # 视频ID -> 待批量写入的字段
+        self.pending_lock = threading.Lock()
+        self._init_schema()
+        
+        flush_thread = threading.Thread(target=self._flush_loop, name='status-store-flush')
+        flush_thread.daemon = True
+        flush_thread.start()
+
+    def _connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        conn = self._connect()
+        with conn:
+            columns = ', '.join(f'{name} {kind}' for name, kind in self.VIDEO_COLUMNS)
+            conn.execute(f'CREATE TABLE IF NOT EXISTS videos ({columns})')
+            # 旧数据库缺少的列在启动时补齐
+            existing = {row['name'] for row in conn.execute('PRAGMA table_info(videos)')}
+            for name, kind in self.VIDEO_COLUMNS:
+                if name not in existing:
+                    conn.execute(f'ALTER TABLE videos ADD COLUMN {name} {kind}')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_videos_uploaded_at ON videos (uploaded_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_videos_device ON videos (device_id, uploaded_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_videos_status ON videos (status, uploaded_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_videos_digest ON videos (digest)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_videos_leader ON videos (leader_id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_videos_last_accessed ON videos (last_accessed)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS processed_cache (
+                    digest TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_processed_cache_last_used ON processed_cache (last_used)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS upload_sessions (
+                    upload_id TEXT PRIMARY KEY,
+                    device_id TEXT,
+                    filename TEXT,
+                    total_size INTEGER NOT NULL,
+                    ranges TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                )
+            ''')
+
+    def create(self, record):
+        """新增视频记录"""
+        names = ', '.join(record)
+        placeholders = ', '.join('?' for _ in record)
+        conn = self._connect()
+        with conn:
+            conn.execute(f'INSERT INTO videos ({names}) VALUES ({placeholders})', list(record.values()))
+
+    def get(self, video_id):
+        """获取视频记录，不存在时返回None"""
+        row = self._connect().execute('SELECT * FROM videos WHERE video_id = ?', (video_id,)).fetchone()
+        if row is None:
+            return None
+        record = dict(row)
+        with self.pending_lock:
+            record.update(self.pending_updates.get(video_id, {}))
+        return record
+
+    def update(self, video_id, **fields):
+        """立即更新视频记录的字段"""
+        with self.pending_lock:
+            pending = self.pending_updates.pop(video_id, {})
+        fields = {**pending, **fields}
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        conn = self._connect()
+        with conn:
+            conn.execute(f'UPDATE videos SET {assignments} WHERE video_id = ?', [*fields.values(), video_id])
+
+    def set_progress(self, video_id, progress):
+        """缓存处理进度，稍后批量写入"""
+        with self.pending_lock:
+            self.pending_updates.setdefault(video_id, {})['progress'] = progress
+
+    def touch(self, video_id):
+        """缓存最近访问时间，用于磁盘配额的LRU淘汰"""
+        with self.pending_lock:
+            self.pending_updates.setdefault(video_id, {})['last_accessed'] = time.time()
+
+    def delete(self, video_id):
+        with self.pending_lock:
+            self.pending_updates.pop(video_id, None)
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM videos WHERE video_id = ?', (video_id,))
+
+    def list(self, device_id=None, status=None, before=None, limit=DEFAULT_PAGE_SIZE):
+        """按上传时间倒序分页列出视频，before为上一页最后一条的uploaded_at"""
+        conditions = []
+        params = []
+        if device_id:
+            conditions.append('device_id = ?')
+            params.append(device_id)
+        if status:
+            conditions.append('status = ?')
+            params.append(status)
+        if before:
+            conditions.append('uploaded_at < ?')
+            params.append(before)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        rows = self._connect().execute(
+            f'SELECT video_id, device_id, status, progress, uploaded_at, completed_at '
+            f'FROM videos {where} ORDER BY uploaded_at DESC LIMIT ?',
+            [*params, limit]
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def list_expiry_entries(self):
+        """列出所有视频的过期时间，用于重建过期堆"""
+        rows = self._connect().execute('SELECT video_id, uploaded_at, expires_at FROM videos').fetchall()
+        entries = []
+        for row in rows:
+            expires_at = row['expires_at']
+            if expires_at is None:
+                expires_at = datetime.fromisoformat(row['uploaded_at']).timestamp() + VIDEO_TTL
+            entries.append((expires_at, row['video_id']))
+        return entries
+
+    def list_least_recently_used(self, limit):
+        """按最近访问时间列出已结束的视频"""
+        rows = self._connect().execute(
+            "SELECT * FROM videos WHERE status IN ('completed', 'failed') "
+            "ORDER BY COALESCE(last_accessed, 0) LIMIT ?",
+            (limit,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def list_unfinished(self):
+        """列出尚未处理完成的视频（用于重启后恢复）"""
+        rows = self._connect().execute(
+            "SELECT * FROM videos WHERE status IN ('uploaded', 'processing') ORDER BY uploaded_at"
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def find_leader(self, digest, exclude_id):
+        """查找相同内容、正在排队或处理中的任务"""
+        row = self._connect().execute(
+            "SELECT * FROM videos WHERE digest = ? AND video_id != ? AND leader_id IS NULL "
+            "AND status IN ('uploaded', 'processing') LIMIT 1",
+            (digest, exclude_id)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def list_followers(self, leader_id):
+        rows = self._connect().execute('SELECT * FROM videos WHERE leader_id = ?', (leader_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def digest_in_use(self, digest):
+        """是否还有记录引用该内容的上传文件"""
+        row = self._connect().execute('SELECT 1 FROM videos WHERE digest = ? LIMIT 1', (digest,)).fetchone()
+        return row is not None
+
+    def cache_get(self, digest):
+        """查找处理结果缓存并更新最近使用时间"""
+        conn = self._connect()
+        row = conn.execute('SELECT path FROM processed_cache WHERE digest = ?', (digest,)).fetchone()
+        if row is None:
+            return None
+        with conn:
+            conn.execute('UPDATE processed_cache SET last_used = ? WHERE digest = ?', (time.time(), digest))
+        return row['path']
+
+    def cache_add(self, digest, path, size):
+        conn = self._connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO processed_cache (digest, path, size, last_used) VALUES (?, ?, ?, ?)',
+                         (digest, path, size, time.time()))
+
+    def cache_evict(self, max_bytes, keep=None):
+        """删除最久未使用的缓存记录直到总大小不超过上限（keep指定的记录不删除），返回被淘汰的文件路径"""
+        conn = self._connect()
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM processed_cache').fetchone()[0]
+        evicted = []
+        if total <= max_bytes:
+            return evicted
+        for row in conn.execute('SELECT digest, path, size FROM processed_cache ORDER BY last_used').fetchall():
+            if total <= max_bytes:
+                break
+            if row['digest'] == keep:
+                continue
+            evicted.append((row['digest'], row['path']))
+            total -= row['size']
+        with conn:
+            conn.executemany('DELETE FROM processed_cache WHERE digest = ?', [(digest,) for digest, _ in evicted])
+        return [path for _, path in evicted]
+
+    def cache_list_lru(self):
+        rows = self._connect().execute('SELECT digest, path FROM processed_cache ORDER BY last_used').fetchall()
+        return [(row['digest'], row['path']) for row in rows]
+
+    def cache_remove(self, digest):
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM processed_cache WHERE digest = ?', (digest,))
+
+    def save_upload_session(self, session):
+        record = session.to_record()
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO upload_sessions '
+                '(upload_id, device_id, filename, total_size, ranges, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                list(record.values())
+            )
+
+    def delete_upload_session(self, upload_id):
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM upload_sessions WHERE upload_id = ?', (upload_id,))
+
+    def load_upload_sessions(self):
+        rows = self._connect().execute('SELECT * FROM upload_sessions').fetchall()
+        return [UploadSession.from_record(dict(row)) for row in rows]
+
+    def flush_pending(self):
+        """将缓存的字段更新批量写入数据库"""
+        with self.pending_lock:
+            if not self.pending_updates:
+                return
+            batch = self.pending_updates
+            self.pending_updates = {}
+        # 按字段组合分组，每组一次executemany
+        groups = {}
+        for video_id, fields in batch.items():
+            names = tuple(sorted(fields))
+            groups.setdefault(names, []).append([*(fields[name] for name in names), video_id])
+        conn = self._connect()
+        with conn:
+            for names, rows in groups.items():
+                assignments = ', '.join(f'{name} = ?' for name in names)
+                conn.executemany(f'UPDATE videos SET {assignments} WHERE video_id = ?', rows)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(PROGRESS_FLUSH_INTERVAL)
+            try:
+                self.flush_pending()
+            except Exception as e:
+                logger.error(f"批量写入状态更新失败: {str(e)}")
+
+video_store = VideoStatusStore(DATABASE_PATH)
+
+class JobOutput:
+    """正在处理的任务的输出状态，渐进式下载在其条件变量上等待新数据"""
+
+    def __init__(self, path):
+        self.path = path
+        self.condition = threading.Condition()
+        self.written = 0
+        self.finished = False
+        self.failed = False
+
+    def advance(self, written):
+        with self.condition:
+            self.written = written
+            self.condition.notify_all()
+
+    def finish(self, failed=False):
+        with self.condition:
+            self.finished = True
+            self.failed = failed
+            self.condition.notify_all()
+
+# 视频ID -> 正在写出的处理结果
+job_outputs = {}
+job_outputs_lock = threading.Lock()
+
+class StatusChannel:
+    """单个视频的状态变化通知，版本号在每次变化时递增"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.version = 0
+        self.subscribers = 0
+
+    def wait(self, version, timeout):
+        """等待版本号变化或超时，返回当前版本号"""
+        with self.condition:
+            if self.version == version:
+                self.condition.wait(timeout)
+            return self.version
+
+class StatusNotifier:
+    """按视频分发状态变化
+
+    只为有等待方（长轮询或SSE）的视频创建通知通道，等待方被唤醒后重新读取状态，
+    没有人等待时发布通知只是一次字典查找。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels = {}
+
+    def subscribe(self, video_id):
+        with self.lock:
+            channel = self.channels.get(video_id)
+            if channel is None:
+                channel = self.channels[video_id] = StatusChannel()
+            channel.subscribers += 1
+            return channel
+
+    def unsubscribe(self, video_id, channel):
+        with self.lock:
+            channel.subscribers -= 1
+            if channel.subscribers == 0 and self.channels.get(video_id) is channel:
+                del self.channels[video_id]
+
+    def has_subscribers(self):
+        return bool(self.channels)
+
+    def publish(self, video_id):
+        with self.lock:
+            channel = self.channels.get(video_id)
+        if channel is not None:
+            with channel.condition:
+                channel.version += 1
+                channel.condition.notify_all()
+
+status_notifier = StatusNotifier()
+
+def notify_status(video_id):
+    """通知等待该视频及跟随它的视频的请求"""
+    status_notifier.publish(video_id)
+    if status_notifier.has_subscribers():
+        for follower in video_store.list_followers(video_id):
+            status_notifier.publish(follower['video_id'])
+
+def simulate_video_processing(video_id, input_path, output_path, job_output):
+    """模拟视频处理过程，结果按块写出"""
+    # 模拟处理时间（5-10秒），均摊到每个输出块
+    processing_time = 8
+    total_size = os.path.getsize(input_path)
+    blocks = max(1, math.ceil(total_size / PROCESSING_BLOCK_SIZE))
+    block_delay = processing_time / blocks
+    
+    # 简单的"处理"：逐块复制原文件到processed目录
+    # 在实际应用中，这里可以调用FFmpeg或其他视频处理工具
+    written = 0
+    logged_step = 0
+    with open(input_path, 'rb') as src, open(output_path, 'wb') as dst:
+        for i in range(blocks):
+            time.sleep(block_delay)
+            block = src.read(PROCESSING_BLOCK_SIZE)
+            dst.write(block)
+            dst.flush()
+            written += len(block)
+            job_output.advance(written)
+            
+            progress = (i + 1) / blocks * 100
+            video_store.set_progress(video_id, round(progress, 1))
+            notify_status(video_id)
+            if int(progress // 10) > logged_step:
+                logged_step = int(progress // 10)
+                logger.info(f"视频 {video_id} 处理进度: {progress:.1f}%")
+    shutil.copystat(input_path, output_path)
+
+def link_file(source, target):
+    """以硬链接复用文件，文件系统不支持时退回复制"""
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+def cache_path_for(digest):
+    return os.path.join(PROCESSED_FOLDER, f"{digest}.mp4")
+
+def add_to_processed_cache(digest, path):
+    """登记处理结果缓存，超出容量时淘汰最久未使用的其它结果；结果本身超过缓存容量时不缓存，删除缓存文件
+
+    调用前各视频的输出必须已经链接到该结果。
+    """
+    size = os.path.getsize(path)
+    if size > PROCESSED_CACHE_MAX_BYTES:
+        os.remove(path)
+        logger.info(f"处理结果 {path} 超过缓存容量，不缓存")
+        return
+    video_store.cache_add(digest, path, size)
+    for evicted_path in video_store.cache_evict(PROCESSED_CACHE_MAX_BYTES, keep=digest):
+        # 已完成视频的输出是硬链接，删除缓存项不影响它们的下载
+        if os.path.exists(evicted_path):
+            os.remove(evicted_path)
+        logger.info(f"处理结果缓存淘汰: {evicted_path}")
+
+def complete_video(record, cached_path):
+    """通过硬链接复用已缓存的处理结果完成视频"""
+    link_file(cached_path, record['output_path'])
+    video_store.update(record['video_id'], status='completed', progress=100, leader_id=None,
+                       completed_at=datetime.now().isoformat())
+    status_notifier.publish(record['video_id'])
+
+def run_processing_job(video_id):
+    """执行处理任务，并把结果交给等待相同内容的视频"""
+    record = video_store.get(video_id)
+    if record is None:
+        return  # 排队期间已被清理
+    
+    digest = record['digest']
+    # 有摘要时结果写入内容寻址的缓存文件，再硬链接到各视频的输出路径
+    result_path = cache_path_for(digest) if digest else record['output_path']
+    partial_path = f"{result_path}.partial"
+    job_output = JobOutput(partial_path)
+    with job_outputs_lock:
+        job_outputs[video_id] = job_output
     try:
         logger.info(f"开始处理视频 {video_id}")
-        video_status[video_id]['status'] = 'processing'
-        
-        # 模拟处理时间（5-10秒）
-        processing_time = 8
-        for i in range(processing_time):
-            time.sleep(1)
-            progress = (i + 1) / processing_time * 100
-            logger.info(f"视频 {video_id} 处理进度: {progress:.1f}%")
+        video_store.update(video_id, status='processing')
+        notify_status(video_id)
         
-        # 简单的"处理"：复制原文件到processed目录
-        # 在实际应用中，这里可以调用FFmpeg或其他视频处理工具
-        import shutil
-        shutil.copy2(input_path, output_path)
+        simulate_video_processing(video_id, record['input_path'], partial_path, job_output)
+        os.replace(partial_path, result_path)
         
-        # 更新状态为完成
-        video_status[video_id]['status'] = 'completed'
-        video_status[video_id]['processed_video_url'] = f"/api/video/{video_id}"
-        video_status[video_id]['completed_at'] = datetime.now().isoformat()
+        # 先把结果链接到各视频的输出，再登记缓存（登记时可能淘汰文件）；
+        # 持有分派锁，完成前到达的相同内容不会错过跟随或缓存
+        with dispatch_lock:
+            if digest:
+                complete_video(record, result_path)
+            else:
+                video_store.update(video_id, status='completed', progress=100,
+                                   completed_at=datetime.now().isoformat())
+                status_notifier.publish(video_id)
+            
+            for follower in video_store.list_followers(video_id):
+                complete_video(follower, result_path)
+            
+            if digest:
+                add_to_processed_cache(digest, result_path)
         
+        job_output.finish()
         logger.info(f"视频 {video_id} 处理完成")
         
     except Exception as e:
         logger.error(f"视频 {video_id} 处理失败: {str(e)}")
-        video_status[video_id]['status'] = 'failed'
-        video_status[video_id]['error'] = str(e)
+        job_output.finish(failed=True)
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        video_store.update(video_id, status='failed', error=str(e))
+        status_notifier.publish(video_id)
+        for follower in video_store.list_followers(video_id):
+            video_store.update(follower['video_id'], status='failed', leader_id=None, error=str(e))
+            status_notifier.publish(follower['video_id'])
+    finally:
+        with job_outputs_lock:
+            job_outputs.pop(video_id, None)
+
+class JobReservation:
+    """上传开始前预留的排队名额，提交任务时转为排队任务，上传失败时释放"""
+
+    def __init__(self):
+        self.active = True
+
+class JobScheduler:
+    """有界的优先级处理队列
+
+    固定数量的工作线程从队列取任务。高优先级先执行，同一优先级内按设备轮转，
+    避免单个设备的突发上传挤占其它设备；排队数加预留数达到上限时拒绝新上传。
+    """
+
+    def __init__(self, workers, max_pending):
+        self.max_pending = max_pending
+        self.worker_count = workers
+        self.condition = threading.Condition()
+        # 优先级 -> 设备ID -> 该设备的任务队列，设备顺序即轮转顺序
+        self.queues = {level: OrderedDict() for level in sorted(JOB_PRIORITIES.values())}
+        self.pending = 0
+        self.reserved = 0
+        self.running = {}
+        self.avg_duration = DEFAULT_JOB_DURATION
+        self.completed_count = 0
+        
+        for i in range(workers):
+            worker = threading.Thread(target=self._worker, name=f'video-worker-{i}')
+            worker.daemon = True
+            worker.start()
+
+    def reserve(self):
+        """预留一个排队名额，队列已满时返回None"""
+        with self.condition:
+            if self.pending + self.reserved >= self.max_pending:
+                return None
+            self.reserved += 1
+            return JobReservation()
+
+    def release(self, reservation):
+        """释放未使用的预留名额（已提交或已释放时不做任何事）"""
+        with self.condition:
+            if reservation is not None and reservation.active:
+                reservation.active = False
+                self.reserved -= 1
+
+    def submit(self, video_id, device_id, priority, task, force=False, reservation=None):
+        """提交任务，队列已满时返回False
+
+        传入预留名额时使用该名额；force为True时忽略上限（仅用于重启后恢复任务）。
+        """
+        with self.condition:
+            if reservation is not None and reservation.active:
+                reservation.active = False
+                self.reserved -= 1
+            elif self.pending + self.reserved >= self.max_pending and not force:
+                return False
+            device_queue = self.queues[priority].setdefault(device_id, deque())
+            device_queue.append((video_id, task))
+            self.pending += 1
+            self.condition.notify()
+            return True
+
+    def is_full(self):
+        with self.condition:
+            return self.pending + self.reserved >= self.max_pending
+
+    def position(self, video_id):
+        """返回任务在队列中的位置（从1开始），不在队列中时返回None"""
+        with self.condition:
+            position = 0
+            for level in self.queues.values():
+                device_jobs = [list(jobs) for jobs in level.values()]
+                rounds = max((len(jobs) for jobs in device_jobs), default=0)
+                # 按工作线程实际的取任务顺序（设备轮转）计数
+                for r in range(rounds):
+                    for jobs in device_jobs:
+                        if r < len(jobs):
+                            position += 1
+                            if jobs[r][0] == video_id:
+                                return position
+            return None
+
+    def retry_after(self):
+        """估算队列腾出空位所需的秒数"""
+        with self.condition:
+            return max(1, math.ceil(self.avg_duration / self.worker_count))
+
+    def stats(self):
+        with self.condition:
+            return {
+                'workers': self.worker_count,
+                'running': len(self.running),
+                'pending': self.pending,
+                'reserved': self.reserved,
+                'max_pending': self.max_pending,
+                'completed': self.completed_count,
+                'avg_duration': round(self.avg_duration, 3)
+            }
+
+    def _next_job(self):
+        """取出最高优先级中轮到的设备的下一个任务"""
+        for level in self.queues.values():
+            if level:
+                device_id, jobs = level.popitem(last=False)
+                job = jobs.popleft()
+                if jobs:
+                    level[device_id] = jobs  # 还有任务则排到轮转末尾
+                return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                while self.pending == 0:
+                    self.condition.wait()
+                video_id, task = self._next_job()
+                self.pending -= 1
+                self.running[video_id] = time.time()
+            
+            started_at = time.time()
+            try:
+                task()
+            except Exception as e:
+                logger.error(f"处理任务 {video_id} 异常: {str(e)}")
+            finally:
+                duration = time.time() - started_at
+                with self.condition:
+                    self.running.pop(video_id, None)
+                    self.completed_count += 1
+                    self.avg_duration = 0.8 * self.avg_duration + 0.2 * duration
+
+job_scheduler = JobScheduler(PROCESSING_WORKERS, MAX_PENDING_JOBS)
+
+dispatch_lock = threading.Lock()
+
+def store_upload(temp_path, digest):
+    """把上传的临时文件按内容摘要存放，相同内容只保留一份"""
+    input_path = os.path.join(UPLOAD_FOLDER, f"{digest}.mp4")
+    with dispatch_lock:
+        if os.path.exists(input_path):
+            os.remove(temp_path)
+        else:
+            os.replace(temp_path, input_path)
+    return input_path
+
+def remove_unreferenced_upload(digest, input_path):
+    """没有记录再引用该内容时删除上传文件"""
+    with dispatch_lock:
+        if not video_store.digest_in_use(digest) and os.path.exists(input_path):
+            os.remove(input_path)
+
+def delete_video(record):
+    """删除视频记录及其文件"""
+    video_store.delete(record['video_id'])
+    if record['output_path'] and os.path.exists(record['output_path']):
+        os.remove(record['output_path'])
+    
+    # 上传文件按内容共享，没有其它记录引用时才删除
+    if record['digest']:
+        remove_unreferenced_upload(record['digest'], record['input_path'])
+    elif record['input_path'] and os.path.exists(record['input_path']):
+        os.remove(record['input_path'])
+
+def storage_usage():
+    """统计uploads和processed的磁盘占用，硬链接只计一次"""
+    seen = set()
+    total = 0
+    for folder in (UPLOAD_FOLDER, PROCESSED_FOLDER):
+        for entry in os.scandir(folder):
+            if entry.is_file():
+                stat = entry.stat()
+                if (stat.st_dev, stat.st_ino) not in seen:
+                    seen.add((stat.st_dev, stat.st_ino))
+                    total += stat.st_size
+    return total
+
+class ExpiryService:
+    """后台过期清理服务
+
+    最小堆按过期时间排列视频，到期后由后台线程批量删除；设置了磁盘配额时，
+    超出配额先淘汰处理结果缓存，再按最近访问时间淘汰已结束的视频。
+    文件删除都在该线程中完成，请求处理不会因大量删除而阻塞。
+    """
+
+    def __init__(self, quota_bytes):
+        self.quota_bytes = quota_bytes
+        self.heap = []  # (过期时间, 视频ID)
+        self.condition = threading.Condition()
+        self.started = False
+        self.expired_count = 0
+        self.evicted_count = 0
+        self.last_usage = None
+
+    def start(self):
+        """从数据库重建过期堆并启动清理线程"""
+        with self.condition:
+            if self.started:
+                return
+            self.heap.extend(video_store.list_expiry_entries())
+            heapq.heapify(self.heap)
+            self.started = True
+        
+        thread = threading.Thread(target=self._run, name='expiry-service')
+        thread.daemon = True
+        thread.start()
+
+    def schedule(self, video_id, expires_at):
+        with self.condition:
+            heapq.heappush(self.heap, (expires_at, video_id))
+            if self.heap[0][1] == video_id:
+                self.condition.notify()
+
+    def wake(self):
+        """立即执行一轮检查"""
+        with self.condition:
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'scheduled': len(self.heap),
+                'next_expiry': self.heap[0][0] if self.heap else None,
+                'expired': self.expired_count,
+                'evicted': self.evicted_count,
+                'quota_bytes': self.quota_bytes,
+                'usage_bytes': self.last_usage
+            }
+
+    def _pop_due(self):
+        """等待到期或超时，取出一批到期的视频ID"""
+        with self.condition:
+            now = time.time()
+            if not self.heap or self.heap[0][0] > now:
+                timeout = EXPIRY_CHECK_INTERVAL
+                if self.heap:
+                    timeout = min(timeout, self.heap[0][0] - now)
+                self.condition.wait(timeout)
+                now = time.time()
+            due = []
+            while self.heap and self.heap[0][0] <= now and len(due) < DELETE_BATCH_SIZE:
+                due.append(heapq.heappop(self.heap)[1])
+            return due
+
+    def _expire(self, video_ids):
+        for video_id in video_ids:
+            record = video_store.get(video_id)
+            if record is None:
+                continue
+            if record['status'] in ('uploaded', 'processing'):
+                # 仍在处理的视频延后到处理结束之后
+                self.schedule(video_id, time.time() + VIDEO_TTL)
+                continue
+            if record['expires_at'] is not None and record['expires_at'] > time.time():
+                continue  # 过期时间已被延长，堆中是旧条目
+            delete_video(record)
+            self.expired_count += 1
+        if video_ids:
+            logger.info(f"过期清理: 检查 {len(video_ids)} 个视频")
+
+    def _evict_unshared_cache(self):
+        """淘汰已没有视频引用的缓存结果（只剩缓存自身一个链接），返回淘汰数量"""
+        evicted = 0
+        for digest, path in video_store.cache_list_lru():
+            if os.path.exists(path) and os.stat(path).st_nlink > 1:
+                continue  # 删除它不会释放空间
+            video_store.cache_remove(digest)
+            if os.path.exists(path):
+                os.remove(path)
+            evicted += 1
+            if evicted >= DELETE_BATCH_SIZE:
+                break
+        return evicted
+
+    def _enforce_quota(self):
+        if not self.quota_bytes:
+            return
+        usage = storage_usage()
+        while usage > self.quota_bytes:
+            if not self._evict_unshared_cache():
+                records = video_store.list_least_recently_used(DELETE_BATCH_SIZE)
+                if not records:
+                    logger.warning(f"磁盘占用 {usage} 超出配额 {self.quota_bytes}，但没有可淘汰的视频")
+                    break
+                for record in records:
+                    delete_video(record)
+                self.evicted_count += len(records)
+            usage = storage_usage()
+        self.last_usage = usage
+
+    def _run(self):
+        while True:
+            try:
+                self._expire(self._pop_due())
+                self._enforce_quota()
+            except Exception as e:
+                logger.error(f"过期清理失败: {str(e)}")
+                time.sleep(1)
+
+expiry_service = ExpiryService(STORAGE_QUOTA_BYTES)
+
+def dispatch_video(record, reservation=None):
+    """复用相同内容的处理结果，或跟随正在处理的相同内容任务，否则提交新任务
+
+    上传接口在读取请求体之前已预留排队名额，提交时使用该名额；没有预留名额的是
+    重启后恢复的任务，不受排队上限限制。复用或跟随时预留名额由调用方释放。
+    """
+    video_id = record['video_id']
+    digest = record['digest']
+    with dispatch_lock:
+        if digest:
+            cached_path = video_store.cache_get(digest)
+            if cached_path and os.path.exists(cached_path):
+                complete_video(record, cached_path)
+                logger.info(f"视频 {video_id} 复用已处理的相同内容结果")
+                return
+            leader = video_store.find_leader(digest, video_id)
+            if leader is not None:
+                video_store.update(video_id, leader_id=leader['video_id'])
+                logger.info(f"视频 {video_id} 与正在处理的 {leader['video_id']} 内容相同，等待其结果")
+                return
+        job_scheduler.submit(
+            video_id, record['device_id'], JOB_PRIORITIES[parse_priority(record['priority'])],
+            lambda: run_processing_job(video_id),
+            force=reservation is None, reservation=reservation
+        )
+
+def start_video_processing(video_id, device_id, original_filename, input_path, priority, digest, reservation):
+    """记录视频信息并开始处理，reservation为上传前预留的排队名额"""
+    record = {
+        'video_id': video_id,
+        'device_id': device_id,
+        'original_filename': original_filename,
+        'status': 'uploaded',
+        'priority': priority,
+        'progress': 0,
+        'uploaded_at': datetime.now().isoformat(),
+        'input_path': input_path,
+        'output_path': os.path.join(PROCESSED_FOLDER, f"{video_id}.mp4"),
+        'digest': digest,
+        'expires_at': time.time() + VIDEO_TTL,
+        'last_accessed': time.time()
+    }
+    video_store.create(record)
+    expiry_service.schedule(video_id, record['expires_at'])
+    dispatch_video(record, reservation)
+
+def recover_state():
+    """服务重启后恢复未完成的任务和上传会话，并清理孤立文件"""
+    # 恢复分块上传会话
+    known_parts = set()
+    for session in video_store.load_upload_sessions():
+        if os.path.exists(session.part_path):
+            upload_sessions[session.upload_id] = session
+            known_parts.add(os.path.basename(session.part_path))
+        else:
+            video_store.delete_upload_session(session.upload_id)
+    
+    # 先删除没有对应记录的文件（包括上次运行未完成的.upload/.partial临时文件），
+    # 再重新分派任务，避免删掉重新开始的任务刚创建的.partial文件
+    orphaned = 0
+    for folder in (UPLOAD_FOLDER, PROCESSED_FOLDER):
+        for entry in os.scandir(folder):
+            if not entry.is_file() or entry.name in known_parts:
+                continue
+            key, _, extension = entry.name.partition('.')
+            if extension == 'mp4':
+                record = video_store.get(key)
+                if record is not None and entry.path in (record['input_path'], record['output_path']):
+                    continue
+                if folder == UPLOAD_FOLDER and video_store.digest_in_use(key):
+                    continue
+                if folder == PROCESSED_FOLDER and video_store.cache_get(key) == entry.path:
+                    continue
+            os.remove(entry.path)
+            orphaned += 1
+    
+    # 重新分派未完成的任务（相同内容的任务重新选出一个执行，其余跟随）
+    recovered = 0
+    unfinished = video_store.list_unfinished()
+    for record in unfinished:
+        video_store.update(record['video_id'], status='uploaded', progress=0, leader_id=None)
+    for record in unfinished:
+        if record['input_path'] and os.path.exists(record['input_path']):
+            dispatch_video(record)
+            recovered += 1
+        else:
+            video_store.update(record['video_id'], status='failed', error='服务重启时输入文件已丢失')
+    
+    expiry_service.start()
+    
+    logger.info(f"状态恢复完成: 上传会话 {len(upload_sessions)} 个, 重新排队 {recovered} 个, 清理孤立文件 {orphaned} 个")
+
+recovery_lock = threading.Lock()
+recovery_done = False
+
+@app.before_request
+def ensure_state_recovered():
+    """在处理第一个请求前恢复状态（避免调试模式下重载器的父进程也执行恢复）"""
+    global recovery_done
+    if recovery_done:
+        return
+    with recovery_lock:
+        if not recovery_done:
+            recover_state()
+            recovery_done = True
+
+def parse_priority(value):
+    """解析任务优先级，无效值按normal处理"""
+    return value if value in JOB_PRIORITIES else 'normal'
+
+def queue_full_response():
+    """处理队列已满时的响应，附带重试时间"""
+    retry_after = job_scheduler.retry_after()
+    response = jsonify({
+        'success': False,
+        'message': '处理队列已满，请稍后重试',
+        'retryAfter': retry_after
+    })
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 503
+
+class FileRangeIterator:
+    """按块读取文件指定区间，用于区间请求或WSGI服务器没有提供file_wrapper（sendfile）的情况"""
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.start = start
+        self.length = length
+
+    def __iter__(self):
+        self.file.seek(self.start)
+        remaining = self.length
+        while remaining > 0:
+            block = self.file.read(min(DOWNLOAD_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+    def close(self):
+        self.file.close()
+
+def file_etag(stat):
+    """由inode、大小和修改时间生成强ETag，文件内容变化时必然改变"""
+    return f'{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}'
+
+def send_video_file(path, download_name):
+    """发送视频文件，支持Range（206）和条件请求（304）
+
+    发送完整文件且WSGI服务器提供wsgi.file_wrapper时（如gunicorn），文件交给服务器通过sendfile零拷贝发送；
+    区间请求按块读取指定区间（通用的file_wrapper如wsgiref会忽略Content-Length一直读到文件末尾）。
+    """
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = file_etag(stat)
+    headers = {
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(stat.st_mtime),
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': f'private, max-age={VIDEO_CACHE_MAX_AGE}',
+        'Content-Disposition': f'inline; filename="{download_name}"'
+    }
+    
+    # 条件请求：If-None-Match优先于If-Modified-Since
+    if request.if_none_match:
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers=headers)
+    elif request.if_modified_since and request.if_modified_since.timestamp() >= int(stat.st_mtime):
+        return Response(status=304, headers=headers)
+    
+    start, length, status = 0, size, 200
+    byte_range = request.range
+    if byte_range is not None and request.if_range.etag is not None:
+        # If-Range要求强比较，不匹配时返回完整文件
+        if request.if_range.etag != etag:
+            byte_range = None
+    elif byte_range is not None and request.if_range.date is not None:
+        if request.if_range.date.timestamp() != int(stat.st_mtime):
+            byte_range = None
+    
+    if byte_range is not None and byte_range.units == 'bytes' and len(byte_range.ranges) == 1:
+        requested = byte_range.range_for_length(size)
+        if requested is None:
+            headers['Content-Range'] = f'bytes */{size}'
+            return Response(status=416, headers=headers)
+        start, stop = requested
+        length = stop - start
+        status = 206
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    # 多区间请求按完整文件返回
+    
+    headers['Content-Length'] = str(length)
+    
+    f = open(path, 'rb')
+    server_file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if server_file_wrapper is not None and status == 200:
+        body = server_file_wrapper(f, DOWNLOAD_BLOCK_SIZE)
+    else:
+        body = FileRangeIterator(f, start, length)
+    
+    return Response(body, status=status, headers=headers, mimetype='video/mp4', direct_passthrough=True)
+
+class GrowingFileIterator:
+    """读取正在写出的处理结果，读到末尾时等待新数据，直到处理结束"""
+
+    def __init__(self, file, job_output):
+        self.file = file
+        self.job_output = job_output
+
+    def __iter__(self):
+        offset = 0
+        while True:
+            block = self.file.read(DOWNLOAD_BLOCK_SIZE)
+            if block:
+                offset += len(block)
+                yield block
+                continue
+            
+            output = self.job_output
+            with output.condition:
+                if output.written <= offset and not output.finished:
+                    output.condition.wait(PROGRESSIVE_STALL_TIMEOUT)
+                if output.failed:
+                    break
+                if output.written <= offset:
+                    if not output.finished:
+                        logger.warning(f"渐进式下载等待超时: {output.path}")
+                    break
+
+    def close(self):
+        self.file.close()
+
+def send_growing_file(job_output, download_name):
+    """边处理边发送结果，长度未知，使用分块传输"""
+    f = open(job_output.path, 'rb')
+    return Response(
+        GrowingFileIterator(f, job_output),
+        mimetype='video/mp4',
+        direct_passthrough=True,
+        headers={
+            'Cache-Control': 'no-store',
+            'Content-Disposition': f'inline; filename="{download_name}"',
+            'X-Processing-Status': 'processing'
+        }
+    )
 
 @app.route('/')
 def index():
@@ -72,7 +1323,12 @@ def index():
         'version': '1.0.0',
         'endpoints': {
             'upload': '/api/upload/video',
+            'upload_session': '/api/upload/session',
+            'upload_part': '/api/upload/session/{uploadId}',
+            'upload_complete': '/api/upload/session/{uploadId}/complete',
+            'queue': '/api/queue',
             'status': '/api/video/{videoId}/status',
+            'events': '/api/video/{videoId}/events',
             'download': '/api/video/{videoId}'
         }
     })
@@ -80,7 +1336,11 @@ def index():
 @app.route('/api/upload/video', methods=['POST'])
 def upload_video():
     """上传视频接口"""
-    try:
+    # 在读取文件之前预留排队名额，队列已满时直接拒绝
+    reservation = job_scheduler.reserve()
+    if reservation is None:
+        return queue_full_response()
+    try:        
         # 检查是否有文件
         if 'video' not in request.files:
             return jsonify({
@@ -90,6 +1350,7 @@ def upload_video():
         
         file = request.files['video']
         device_id = request.form.get('device_id', 'unknown')
+        priority = parse_priority(request.form.get('priority'))
         
         # 检查文件名
         if file.filename == '':
@@ -108,33 +1369,16 @@ def upload_video():
         # 生成唯一的视频ID
         video_id = str(uuid.uuid4())
         
-        # 保存文件
-        filename = f"{video_id}.mp4"
-        input_path = os.path.join(UPLOAD_FOLDER, filename)
-        output_path = os.path.join(PROCESSED_FOLDER, filename)
-        
-        file.save(input_path)
-        
-        # 记录视频信息
-        video_status[video_id] = {
-            'video_id': video_id,
-            'device_id': device_id,
-            'original_filename': file.filename,
-            'status': 'uploaded',
-            'uploaded_at': datetime.now().isoformat(),
-            'input_path': input_path,
-            'output_path': output_path
-        }
+        # 文件在解析请求时已写入uploads目录并计算了摘要，按摘要保存
+        upload_file = file.stream
+        upload_file.close()
+        digest = upload_file.hexdigest()
+        input_path = store_upload(upload_file.path, digest)
         
-        # 启动后台处理线程
-        processing_thread = threading.Thread(
-            target=simulate_video_processing,
-            args=(video_id, input_path, output_path)
-        )
-        processing_thread.daemon = True
-        processing_thread.start()
+        # 记录视频信息并开始处理（相同内容直接复用结果）
+        start_video_processing(video_id, device_id, file.filename, input_path, priority, digest, reservation)
         
-        logger.info(f"视频上传成功: {video_id}, 设备: {device_id}, 文件: {file.filename}")
+        logger.info(f"视频上传成功: {video_id}, 设备: {device_id}, 文件: {file.filename}, 摘要: {digest[:12]}")
         
         return jsonify({
             'success': True,
@@ -148,36 +1392,263 @@ def upload_video():
             'success': False,
             'message': f'上传失败: {str(e)}'
         }), 500
+    finally:
+        # 上传失败或复用了已有结果时释放预留名额
+        job_scheduler.release(reservation)
+        # 删除未被保存的临时文件（校验失败或多余的文件字段）
+        for uploaded in request.files.values():
+            if isinstance(uploaded.stream, HashingUploadFile):
+                uploaded.stream.discard()
 
-@app.route('/api/video/<video_id>/status', methods=['GET'])
-def get_video_status(video_id):
-    """获取视频处理状态"""
+@app.route('/api/upload/session', methods=['POST'])
+def create_upload_session():
+    """创建分块上传会话"""
     try:
-        if video_id not in video_status:
+        data = request.get_json(silent=True) or {}
+        device_id = data.get('device_id', 'unknown')
+        filename = data.get('filename', '')
+        total_size = data.get('size')
+        
+        if not filename or not allowed_file(filename):
             return jsonify({
                 'success': False,
-                'message': '视频不存在'
+                'message': '不支持的文件格式'
+            }), 400
+        
+        if not isinstance(total_size, int) or total_size <= 0 or total_size > MAX_UPLOAD_SIZE:
+            return jsonify({
+                'success': False,
+                'message': '文件大小无效'
+            }), 400
+        
+        upload_id = str(uuid.uuid4())
+        session = UploadSession(upload_id, device_id, filename, total_size)
+        session.preallocate()
+        
+        with upload_sessions_lock:
+            upload_sessions[upload_id] = session
+        video_store.save_upload_session(session)
+        
+        logger.info(f"创建上传会话: {upload_id}, 设备: {device_id}, 文件: {filename}, 大小: {total_size}")
+        
+        response = session.to_dict()
+        response['success'] = True
+        response['message'] = '上传会话创建成功'
+        return jsonify(response)
+        
+    except Exception as e:
+        logger.error(f"创建上传会话失败: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f'创建上传会话失败: {str(e)}'
+        }), 500
+
+@app.route('/api/upload/session/<upload_id>', methods=['PUT'])
+def upload_part(upload_id):
+    """上传一个字节区间（Content-Range: bytes start-end/total）"""
+    try:
+        session = upload_sessions.get(upload_id)
+        if session is None:
+            return jsonify({
+                'success': False,
+                'message': '上传会话不存在'
             }), 404
         
-        status_info = video_status[video_id]
+        content_range = parse_content_range_header(request.headers.get('Content-Range'))
+        if content_range is None or content_range.units != 'bytes' or content_range.start is None:
+            return jsonify({
+                'success': False,
+                'message': '缺少或无效的Content-Range'
+            }), 400
         
-        response = {
-            'success': True,
-            'status': status_info['status'],
-            'message': f"视频状态: {status_info['status']}"
-        }
+        start, end = content_range.start, content_range.stop
+        if content_range.length not in (None, session.total_size) or end > session.total_size:
+            return jsonify({
+                'success': False,
+                'message': '区间超出文件大小'
+            }), 416
         
-        # 如果处理完成，添加下载链接
-        if status_info['status'] == 'completed':
-            # 使用完整的URL
-            response['processedVideoUrl'] = request.url_root.rstrip('/') + f"/api/video/{video_id}"
+        if request.content_length is not None and request.content_length != end - start:
+            return jsonify({
+                'success': False,
+                'message': '请求体长度与Content-Range不一致'
+            }), 400
         
-        # 如果处理失败，添加错误信息
-        if status_info['status'] == 'failed':
-            response['error'] = status_info.get('error', '未知错误')
+        try:
+            written = session.write_part(start, request.stream, end - start)
+        finally:
+            video_store.save_upload_session(session)
         
+        response = session.to_dict()
+        if written < end - start:
+            response['success'] = False
+            response['message'] = f'区间不完整，已写入 {written} 字节'
+            return jsonify(response), 400
+        
+        response['success'] = True
+        response['message'] = '区间接收成功'
         return jsonify(response)
         
+    except Exception as e:
+        logger.error(f"上传区间失败: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f'上传失败: {str(e)}'
+        }), 500
+
+@app.route('/api/upload/session/<upload_id>', methods=['GET'])
+def get_upload_session(upload_id):
+    """查询已接收的区间，用于断点续传"""
+    session = upload_sessions.get(upload_id)
+    if session is None:
+        return jsonify({
+            'success': False,
+            'message': '上传会话不存在'
+        }), 404
+    
+    response = session.to_dict()
+    response['success'] = True
+    return jsonify(response)
+
+@app.route('/api/upload/session/<upload_id>', methods=['DELETE'])
+def abort_upload_session(upload_id):
+    """放弃上传会话并删除临时文件"""
+    with upload_sessions_lock:
+        session = upload_sessions.pop(upload_id, None)
+    
+    if session is None:
+        return jsonify({
+            'success': False,
+            'message': '上传会话不存在'
+        }), 404
+    
+    video_store.delete_upload_session(upload_id)
+    if os.path.exists(session.part_path):
+        os.remove(session.part_path)
+    
+    logger.info(f"上传会话已取消: {upload_id}")
+    return jsonify({
+        'success': True,
+        'message': '上传会话已取消'
+    })
+
+@app.route('/api/upload/session/<upload_id>/complete', methods=['POST'])
+def complete_upload_session(upload_id):
+    """完成分块上传并开始处理"""
+    try:
+        session = upload_sessions.get(upload_id)
+        if session is None:
+            return jsonify({
+                'success': False,
+                'message': '上传会话不存在'
+            }), 404
+        
+        if not session.is_complete():
+            response = session.to_dict()
+            response['success'] = False
+            response['message'] = '文件尚未上传完整'
+            return jsonify(response), 409
+        
+        reservation = job_scheduler.reserve()
+        if reservation is None:
+            return queue_full_response()
+        
+        with upload_sessions_lock:
+            if upload_sessions.pop(upload_id, None) is None:
+                job_scheduler.release(reservation)
+                return jsonify({
+                    'success': False,
+                    'message': '上传会话已完成'
+                }), 409
+        
+        video_id = str(uuid.uuid4())
+        digest = session.hexdigest()
+        input_path = store_upload(session.part_path, digest)
+        
+        priority = parse_priority((request.get_json(silent=True) or {}).get('priority'))
+        try:
+            start_video_processing(video_id, session.device_id, session.filename, input_path, priority, digest,
+                                   reservation)
+        finally:
+            job_scheduler.release(reservation)
+        
+        video_store.delete_upload_session(upload_id)
+        
+        logger.info(f"分块上传完成: {video_id}, 设备: {session.device_id}, 文件: {session.filename}")
+        
+        return jsonify({
+            'success': True,
+            'videoId': video_id,
+            'message': '视频上传成功，开始处理'
+        })
+        
+    except Exception as e:
+        logger.error(f"完成上传失败: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f'完成上传失败: {str(e)}'
+        }), 500
+
+def build_status_response(video_id, status_info, url_root):
+    """构造状态响应内容"""
+    status = status_info['status']
+    progress = status_info['progress'] or 0
+    if status_info['leader_id']:
+        # 跟随相同内容任务的视频显示该任务的状态和进度
+        leader = video_store.get(status_info['leader_id'])
+        if leader is not None and leader['status'] not in TERMINAL_STATUSES:
+            status = leader['status']
+            progress = leader['progress'] or 0
+    
+    response = {
+        'success': True,
+        'status': status,
+        'progress': progress,
+        'message': f"视频状态: {status}"
+    }
+    
+    # 排队中的任务返回队列位置
+    if status == 'uploaded':
+        response['queuePosition'] = job_scheduler.position(status_info['leader_id'] or video_id)
+    
+    # 如果处理完成，添加下载链接
+    if status_info['status'] == 'completed':
+        # 使用完整的URL
+        response['processedVideoUrl'] = url_root + f"/api/video/{video_id}"
+    
+    # 如果处理失败，添加错误信息
+    if status_info['status'] == 'failed':
+        response['error'] = status_info['error'] or '未知错误'
+    
+    return response
+
+@app.route('/api/video/<video_id>/status', methods=['GET'])
+def get_video_status(video_id):
+    """获取视频处理状态
+
+    带 ?wait=秒数 时为长轮询：状态或进度发生变化（或超时）后才返回。
+    """
+    try:
+        wait = min(request.args.get('wait', 0, type=float), MAX_STATUS_WAIT)
+        channel = status_notifier.subscribe(video_id) if wait > 0 else None
+        try:
+            version = channel.version if channel else 0
+            status_info = video_store.get(video_id)
+            if status_info is None:
+                return jsonify({
+                    'success': False,
+                    'message': '视频不存在'
+                }), 404
+            
+            if channel and status_info['status'] not in TERMINAL_STATUSES:
+                if channel.wait(version, wait) != version:
+                    status_info = video_store.get(video_id) or status_info
+        finally:
+            if channel:
+                status_notifier.unsubscribe(video_id, channel)
+        
+        return jsonify(build_status_response(video_id, status_info, request.url_root.rstrip('/')))
+        
     except Exception as e:
         logger.error(f"获取视频状态失败: {str(e)}")
         return jsonify({
@@ -185,17 +1656,75 @@ def get_video_status(video_id):
             'message': f'获取状态失败: {str(e)}'
         }), 500
 
+@app.route('/api/video/<video_id>/events', methods=['GET'])
+def video_events(video_id):
+    """以Server-Sent Events推送处理进度和完成事件，完成或失败后结束"""
+    if video_store.get(video_id) is None:
+        return jsonify({
+            'success': False,
+            'message': '视频不存在'
+        }), 404
+    
+    url_root = request.url_root.rstrip('/')
+    
+    def generate():
+        channel = status_notifier.subscribe(video_id)
+        try:
+            version = channel.version
+            last_sent = None
+            while True:
+                status_info = video_store.get(video_id)
+                if status_info is None:
+                    yield 'event: deleted\ndata: {}\n\n'
+                    break
+                
+                response = build_status_response(video_id, status_info, url_root)
+                state = (response['status'], response['progress'])
+                if state != last_sent:
+                    event = response['status'] if response['status'] in TERMINAL_STATUSES else 'progress'
+                    yield f"event: {event}\ndata: {json.dumps(response, ensure_ascii=False)}\n\n"
+                    last_sent = state
+                if response['status'] in TERMINAL_STATUSES:
+                    break
+                
+                new_version = channel.wait(version, SSE_KEEPALIVE_INTERVAL)
+                if new_version == version:
+                    yield ': keepalive\n\n'
+                version = new_version
+        finally:
+            status_notifier.unsubscribe(video_id, channel)
+    
+    return Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
 @app.route('/api/video/<video_id>', methods=['GET'])
 def download_video(video_id):
     """下载处理后的视频"""
     try:
-        if video_id not in video_status:
+        status_info = video_store.get(video_id)
+        if status_info is None:
             return jsonify({
                 'success': False,
                 'message': '视频不存在'
             }), 404
         
-        status_info = video_status[video_id]
+        if status_info['status'] != 'completed':
+            # 处理中的视频（或跟随相同内容任务的视频）边处理边下载
+            with job_outputs_lock:
+                job_output = job_outputs.get(status_info['leader_id'] or video_id)
+            if job_output is not None:
+                try:
+                    logger.info(f"渐进式下载视频: {video_id}")
+                    return send_growing_file(job_output, f"processed_{video_id}.mp4")
+                except FileNotFoundError:
+                    # 处理恰好结束，结果已改名
+                    status_info = video_store.get(video_id) or status_info
         
         if status_info['status'] != 'completed':
             return jsonify({
@@ -211,14 +1740,10 @@ def download_video(video_id):
                 'message': '处理后的视频文件不存在'
             }), 404
         
+        video_store.touch(video_id)
         logger.info(f"下载视频: {video_id}")
         
-        return send_file(
-            output_path,
-            as_attachment=False,
-            download_name=f"processed_{video_id}.mp4",
-            mimetype='video/mp4'
-        )
+        return send_video_file(output_path, f"processed_{video_id}.mp4")
         
     except Exception as e:
         logger.error(f"下载视频失败: {str(e)}")
@@ -229,23 +1754,28 @@ def download_video(video_id):
 
 @app.route('/api/videos', methods=['GET'])
 def list_videos():
-    """列出所有视频（调试用）"""
+    """分页列出视频，支持按设备和状态过滤
+
+    查询参数: device_id, status, limit, before（上一页返回的nextCursor）
+    """
     try:
-        videos = []
-        for video_id, info in video_status.items():
-            videos.append({
-                'video_id': video_id,
-                'device_id': info.get('device_id'),
-                'status': info['status'],
-                'uploaded_at': info.get('uploaded_at'),
-                'completed_at': info.get('completed_at')
-            })
+        limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+        videos = video_store.list(
+            device_id=request.args.get('device_id'),
+            status=request.args.get('status'),
+            before=request.args.get('before'),
+            limit=limit
+        )
         
-        return jsonify({
+        response = {
             'success': True,
             'videos': videos,
             'total': len(videos)
-        })
+        }
+        if len(videos) == limit:
+            response['nextCursor'] = videos[-1]['uploaded_at']
+        
+        return jsonify(response)
         
     except Exception as e:
         logger.error(f"列出视频失败: {str(e)}")
@@ -254,39 +1784,29 @@ def list_videos():
             'message': f'获取视频列表失败: {str(e)}'
         }), 500
 
+@app.route('/api/queue', methods=['GET'])
+def queue_stats():
+    """处理队列状态（调试用）"""
+    return jsonify({
+        'success': True,
+        'queue': job_scheduler.stats(),
+        'expiry': expiry_service.stats()
+    })
+
 @app.route('/api/cleanup', methods=['POST'])
 def cleanup_old_videos():
-    """清理旧视频文件（调试用）"""
+    """立即触发一轮后台过期清理（调试用）
+
+    清理由后台服务按过期时间自动进行，这里只唤醒它，不在请求中删除文件。
+    """
     try:
-        cleaned_count = 0
-        
-        # 清理超过1小时的视频
-        current_time = datetime.now()
-        to_remove = []
-        
-        for video_id, info in video_status.items():
-            uploaded_time = datetime.fromisoformat(info['uploaded_at'])
-            if (current_time - uploaded_time).total_seconds() > 3600:  # 1小时
-                to_remove.append(video_id)
-        
-        for video_id in to_remove:
-            info = video_status[video_id]
-            
-            # 删除文件
-            for path in [info.get('input_path'), info.get('output_path')]:
-                if path and os.path.exists(path):
-                    os.remove(path)
-            
-            # 删除状态记录
-            del video_status[video_id]
-            cleaned_count += 1
-        
-        logger.info(f"清理了 {cleaned_count} 个旧视频")
+        expiry_service.wake()
         
         return jsonify({
             'success': True,
-            'message': f'清理了 {cleaned_count} 个旧视频'
-        })
+            'message': '已触发后台清理',
+            'expiry': expiry_service.stats()
+        }), 202
         
     except Exception as e:
         logger.error(f"清理视频失败: {str(e)}")
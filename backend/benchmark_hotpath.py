@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+帧处理热路径微基准
+
+覆盖 streaming_app 中每帧都会经过的步骤：帧头写入、process_video_chunk、压缩上传帧的解码、关键帧评分、RGB565/RGB888像素格式转换、各出口格式的序列化
+（HTTP原始字节、base64、Socket.IO文本/二进制包）以及多线程争用下的队列put/get，
+每项在多种帧尺寸下测量。结果可保存为基线文件，之后与基线比较，
+任一项变慢超过阈值即以非零状态码退出，用于防止优化重构时悄悄引入性能回退。
+
+基线与机器相关，应在同一台机器上生成和比较。
+
+用法:
+    python benchmark_hotpath.py --save-baseline
+    python benchmark_hotpath.py                       # 与基线比较，回退时退出码为1
+    python benchmark_hotpath.py --sizes vga --filter queue --threshold 0.3
+"""
+
+import argparse
+import base64
+import json
+import logging
+import os
+import platform
+import queue
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from socketio import packet
+
+import streaming_app
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BACKEND_DIR, 'benchmark_hotpath_baseline.json')
+
+# NV21帧尺寸（宽, 高）
+FRAME_SIZES = {
+    'qvga': (320, 240),
+    'vga': (640, 480),
+    '720p': (1280, 720),
+}
+
+DEFAULT_THRESHOLD = 0.2  # 比基线慢20%以上视为回退
+DEFAULT_REPEAT = 5
+DEFAULT_MIN_TIME = 0.1  # 每次重复的最短测量时长（秒）
+
+QUEUE_ITEMS_PER_LOOP = 1  # 队列基准每个循环传递一帧
+
+def make_frame(width, height):
+    """生成一帧NV21合成数据（亮度渐变 + 中性色度）"""
+    y_size = width * height
+    row = bytes(x % 256 for x in range(width))
+    frame = bytearray(row * height)
+    frame.extend(b'\x80' * (y_size // 2))
+    return bytes(frame)
+
+def timed_loop(func):
+    """把单次操作包装成 run(loops) -> 耗时(秒)"""
+    def run(loops):
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        return time.perf_counter() - start
+    return run
+
+def bench_write_frame_header(frame):
+    return timed_loop(lambda: streaming_app.write_frame_header(frame))
+
+def bench_process_video_chunk(frame):
+    return timed_loop(lambda: streaming_app.process_video_chunk(frame, 'bench'))
+
+def bench_decode(codec):
+    """压缩上传帧的解码（zlib，或与关键帧的差分），每次用新的EncodedFrame避免命中解码缓存"""
+    def factory(frame):
+        keyframe = streaming_app.EncodedFrame('raw', frame)
+        # 差分帧：与关键帧相比只有第一行变化
+        changed = bytes((b + 1) % 256 for b in frame[:256]) + frame[256:]
+        if codec == 'delta':
+            delta = bytes((a - b) % 256 for a, b in zip(changed[:256], frame[:256])) + bytes(len(frame) - 256)
+            payload = zlib.compress(delta, 1)
+        else:
+            payload = zlib.compress(frame, 1)
+        return timed_loop(lambda: streaming_app.EncodedFrame(codec, payload, keyframe).pixels())
+    return factory
+
+def bench_keyframe_metrics(frame):
+    """关键帧评分：Y平面拉普拉斯方差和相对参考帧的新颖度（相位相关）"""
+    width, height = next(size for size in FRAME_SIZES.values() if size[0] * size[1] * 3 // 2 == len(frame))
+    y_plane = streaming_app.np.frombuffer(frame, dtype=streaming_app.np.uint8, count=width * height).reshape(height, width)
+    reference = streaming_app.luma_thumbnail(y_plane)
+    
+    def score():
+        streaming_app.laplacian_variance(y_plane)
+        streaming_app.view_novelty(reference, streaming_app.luma_thumbnail(y_plane))
+    return timed_loop(score)
+
+def bench_convert(output_format):
+    """ProcessedFrame 的像素格式转换（每帧只做一次，之后由所有订阅者共享）"""
+    def factory(frame):
+        stream = streaming_app.VideoStream('bench', 'bench')
+        processed = streaming_app.write_frame_header(frame)
+
+        def convert():
+            # 每次用新帧，避免命中转换缓存
+            stream.frame_output(streaming_app.ProcessedFrame(0, processed, None), output_format)
+        return timed_loop(convert)
+    return factory
+
+def bench_egress_http_raw(frame):
+    # get_stream 直接把处理后的bytes交给WSGI，出口成本仅为一次拷贝
+    return timed_loop(lambda: bytes(memoryview(frame)))
+
+def bench_egress_base64(frame):
+    return timed_loop(lambda: base64.b64encode(frame).decode('utf-8'))
+
+def bench_egress_socketio_base64(frame):
+    # 与 request_processed_stream / get_processed_chunk 发送的 processed_chunk 事件一致
+    def encode():
+        payload = {
+            'stream_id': 'bench',
+            'data': base64.b64encode(frame).decode('utf-8'),
+            'size': len(frame),
+            'timestamp': datetime.now().isoformat()
+        }
+        return packet.Packet(packet.EVENT, data=['processed_chunk', payload], namespace='/').encode()
+    return timed_loop(encode)
+
+def bench_egress_socketio_binary(frame):
+    # Socket.IO二进制附件：元数据为JSON文本，帧数据原样作为附件发送
+    def encode():
+        payload = {
+            'stream_id': 'bench',
+            'data': frame,
+            'size': len(frame),
+            'timestamp': datetime.now().isoformat()
+        }
+        return packet.Packet(packet.EVENT, data=['processed_chunk', payload], namespace='/').encode()
+    return timed_loop(encode)
+
+def queue_contention(producers, consumers):
+    """producers个线程put、consumers个线程get，经过与VideoStream相同容量的有界队列"""
+    def factory(frame):
+        def run(loops):
+            q = queue.Queue(maxsize=streaming_app.MAX_BUFFER_SIZE)
+            total = loops * QUEUE_ITEMS_PER_LOOP
+            per_producer = [total // producers + (1 if i < total % producers else 0) for i in range(producers)]
+            per_consumer = [total // consumers + (1 if i < total % consumers else 0) for i in range(consumers)]
+            barrier = threading.Barrier(producers + consumers + 1)
+
+            def produce(count):
+                barrier.wait()
+                for _ in range(count):
+                    q.put(frame)
+
+            def consume(count):
+                barrier.wait()
+                for _ in range(count):
+                    q.get()
+
+            threads = [threading.Thread(target=produce, args=(n,)) for n in per_producer]
+            threads += [threading.Thread(target=consume, args=(n,)) for n in per_consumer]
+            for t in threads:
+                t.start()
+            barrier.wait()
+            start = time.perf_counter()
+            for t in threads:
+                t.join()
+            return time.perf_counter() - start
+        return run
+    return factory
+
+BENCHMARKS = [
+    ('write_frame_header', bench_write_frame_header),
+    ('process_video_chunk', bench_process_video_chunk),
+    ('decode_zlib', bench_decode('zlib')),
+    ('decode_delta', bench_decode('delta')),
+    ('keyframe_metrics', bench_keyframe_metrics),
+    ('convert_rgb565', bench_convert('rgb565')),
+    ('convert_rgb888', bench_convert('rgb888')),
+    ('egress_http_raw', bench_egress_http_raw),
+    ('egress_base64', bench_egress_base64),
+    ('egress_socketio_base64', bench_egress_socketio_base64),
+    ('egress_socketio_binary', bench_egress_socketio_binary),
+    ('queue_1p1c', queue_contention(1, 1)),
+    ('queue_4p4c', queue_contention(4, 4)),
+]
+
+def measure(run, repeat, min_time):
+    """自动确定循环次数使单次测量不短于min_time，重复repeat次取最小值（每次操作秒数）"""
+    loops = 1
+    while True:
+        elapsed = run(loops)
+        if elapsed >= min_time:
+            break
+        loops = max(loops * 2, int(loops * min_time / max(elapsed, 1e-9) * 1.2))
+    best = elapsed / loops
+    for _ in range(repeat - 1):
+        best = min(best, run(loops) / loops)
+    return best, loops
+
+def run_benchmarks(sizes, name_filter, repeat, min_time):
+    results = {}
+    for size_name in sizes:
+        width, height = FRAME_SIZES[size_name]
+        frame = make_frame(width, height)
+        for bench_name, factory in BENCHMARKS:
+            if name_filter and name_filter not in bench_name:
+                continue
+            key = f'{bench_name}[{size_name}]'
+            seconds, loops = measure(factory(frame), repeat, min_time)
+            results[key] = {
+                'us_per_op': round(seconds * 1e6, 3),
+                'mb_per_s': round(len(frame) / seconds / 1e6, 1),
+                'frame_bytes': len(frame),
+                'loops': loops
+            }
+            print(f'{key:<36} {seconds * 1e6:>12.2f} us/op {len(frame) / seconds / 1e6:>10.1f} MB/s')
+    return results
+
+def compare(results, baseline, threshold):
+    """与基线逐项比较，返回回退项列表"""
+    regressions = []
+    print()
+    print(f'{"基准":<36} {"基线us":>12} {"当前us":>12} {"变化":>9}')
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            print(f'{key:<36} {"-":>12} {current["us_per_op"]:>12.2f} {"新增":>9}')
+            continue
+        ratio = current['us_per_op'] / previous['us_per_op'] if previous['us_per_op'] else 1.0
+        change = ratio - 1
+        mark = ''
+        if change > threshold:
+            mark = '  <-- 回退'
+            regressions.append({'benchmark': key, 'baseline_us': previous['us_per_op'],
+                                'current_us': current['us_per_op'], 'change': round(change, 4)})
+        print(f'{key:<36} {previous["us_per_op"]:>12.2f} {current["us_per_op"]:>12.2f} {change:>+8.1%}{mark}')
+    return regressions
+
+def environment_info():
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'created_at': datetime.now().isoformat()
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='帧处理热路径微基准')
+    parser.add_argument('--sizes', default=','.join(FRAME_SIZES),
+                        help=f'帧尺寸，逗号分隔，可选: {",".join(FRAME_SIZES)}')
+    parser.add_argument('--filter', default='', help='只运行名称包含该字符串的基准')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help='每项重复次数（取最小值）')
+    parser.add_argument('--min-time', type=float, default=DEFAULT_MIN_TIME, help='每次重复的最短时长（秒）')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='基线文件路径')
+    parser.add_argument('--save-baseline', action='store_true', help='把本次结果写入基线文件')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='允许的变慢比例，超过即判定回退（0.2 表示 20%%）')
+    parser.add_argument('--json', help='把本次结果和比较结果写入JSON文件')
+    args = parser.parse_args()
+
+    sizes = [s.strip() for s in args.sizes.split(',') if s.strip()]
+    unknown = [s for s in sizes if s not in FRAME_SIZES]
+    if unknown:
+        parser.error(f'未知帧尺寸: {",".join(unknown)}')
+
+    # 处理函数每10帧记录一次日志，基准测试时关闭
+    streaming_app.logger.setLevel(logging.WARNING)
+
+    results = run_benchmarks(sizes, args.filter, args.repeat, args.min_time)
+    report = {'environment': environment_info(), 'results': results}
+
+    if args.save_baseline:
+        existing = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                existing = json.load(f).get('results', {})
+        existing.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump({'environment': report['environment'], 'results': existing}, f, indent=2, ensure_ascii=False)
+        print(f'\n基线已保存: {args.baseline}')
+        regressions = []
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline.get('results', {}), args.threshold)
+        report['baseline_environment'] = baseline.get('environment')
+    else:
+        print(f'\n未找到基线文件 {args.baseline}，使用 --save-baseline 生成')
+        regressions = []
+
+    report['regressions'] = regressions
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    if regressions:
+        print(f'\n{len(regressions)} 项比基线慢超过 {args.threshold:.0%}')
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,538 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多路流压测工具
+
+模拟N台设备按指定帧率上传640x480 NV21合成帧，每路流M个观看端通过WebSocket接收处理后的数据，
+统计端到端（上传到观看端收到）延迟的p50/p95/p99、实际帧率、丢帧率以及服务器CPU/内存占用，
+结果可输出为JSON，便于比较不同配置和版本。
+
+每帧末尾写入 [魔数, 设备序号, 帧序号, 发送时间(ns)]，观看端据此计算延迟，
+因此压测端和服务器不在同一台机器时需要保证时钟同步。
+
+用法:
+    python benchmark_streaming.py --devices 4 --viewers 2 --fps 5 --duration 30
+    python benchmark_streaming.py --ramp 1,2,4,8,16 --json results.json
+    python benchmark_streaming.py --url http://192.168.1.10:5000 --devices 2
+"""
+
+import argparse
+import base64
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+import socketio
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+FRAME_WIDTH = 640
+FRAME_HEIGHT = 480
+FRAME_SIZE = FRAME_WIDTH * FRAME_HEIGHT * 3 // 2  # NV21: Y平面 + 交错VU平面
+
+TRAILER = struct.Struct('>4sIIQ')  # 魔数, 设备序号, 帧序号, 发送时间(ns)
+TRAILER_MAGIC = b'BNCH'
+PROCESSED_HEADER_SIZE = 8  # 服务器在处理后数据前添加的8字节时间戳
+
+SERVER_START_TIMEOUT = 15
+
+def make_base_frames(device_index, variants=8):
+    """生成若干张合成NV21帧（带移动的亮度渐变），循环使用以模拟画面变化"""
+    frames = []
+    y_size = FRAME_WIDTH * FRAME_HEIGHT
+    row = bytes((x + device_index * 16) % 256 for x in range(FRAME_WIDTH))
+    for v in range(variants):
+        shift = v * 8
+        shifted_row = row[shift:] + row[:shift]
+        frame = bytearray(shifted_row * FRAME_HEIGHT)
+        frame.extend(b'\x80' * (FRAME_SIZE - y_size))  # 中性色度
+        frames.append(frame)
+    return frames
+
+def percentiles(values):
+    """返回延迟分布摘要（毫秒）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def pick(p):
+        index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))
+        return round(ordered[index], 2)
+
+    return {
+        'p50': pick(50),
+        'p95': pick(95),
+        'p99': pick(99),
+        'max': round(ordered[-1], 2),
+        'mean': round(sum(ordered) / len(ordered), 2),
+        'count': len(ordered)
+    }
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_server(base_url, timeout=SERVER_START_TIMEOUT):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f'{base_url}/', timeout=1).ok:
+                return True
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    return False
+
+class ServerProcess:
+    """在子进程中启动流服务器"""
+
+    def __init__(self, port, log_path=None):
+        self.port = port
+        code = (
+            'import streaming_app as s; '
+            f"s.socketio.run(s.app, host='127.0.0.1', port={port}, allow_unsafe_werkzeug=True)"
+        )
+        self.log_file = open(log_path, 'w') if log_path else subprocess.DEVNULL
+        self.process = subprocess.Popen(
+            [sys.executable, '-c', code],
+            cwd=BACKEND_DIR,
+            stdout=self.log_file,
+            stderr=subprocess.STDOUT
+        )
+        self.pid = self.process.pid
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        if self.log_file is not subprocess.DEVNULL:
+            self.log_file.close()
+
+class InProcessServer:
+    """在当前进程的线程中启动流服务器（CPU统计会包含压测端自身的开销）"""
+
+    def __init__(self, port):
+        sys.path.insert(0, BACKEND_DIR)
+        import streaming_app
+        self.port = port
+        self.pid = os.getpid()
+        thread = threading.Thread(
+            target=streaming_app.socketio.run,
+            args=(streaming_app.app,),
+            kwargs={'host': '127.0.0.1', 'port': port, 'allow_unsafe_werkzeug': True,
+                    'use_reloader': False, 'log_output': False}
+        )
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        pass  # 守护线程随进程退出
+
+class ResourceSampler(threading.Thread):
+    """定期采样服务器进程的CPU和常驻内存"""
+
+    def __init__(self, pid, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.cpu_samples = []
+        self.rss_samples = []
+        self.stop_event = threading.Event()
+
+    def _read_proc(self):
+        """没有psutil时从/proc读取（仅Linux），返回 (累计CPU秒, RSS字节)"""
+        with open(f'/proc/{self.pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        ticks = os.sysconf('SC_CLK_TCK')
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / ticks
+        with open(f'/proc/{self.pid}/statm') as f:
+            rss_pages = int(f.read().split()[1])
+        return cpu_seconds, rss_pages * os.sysconf('SC_PAGE_SIZE')
+
+    def run(self):
+        if self.pid is None:
+            return
+        try:
+            if psutil is not None:
+                process = psutil.Process(self.pid)
+                process.cpu_percent()
+                while not self.stop_event.wait(self.interval):
+                    self.cpu_samples.append(process.cpu_percent())
+                    self.rss_samples.append(process.memory_info().rss)
+            else:
+                last_cpu, _ = self._read_proc()
+                last_time = time.time()
+                while not self.stop_event.wait(self.interval):
+                    cpu, rss = self._read_proc()
+                    now = time.time()
+                    self.cpu_samples.append((cpu - last_cpu) / (now - last_time) * 100)
+                    self.rss_samples.append(rss)
+                    last_cpu, last_time = cpu, now
+        except (OSError, IndexError, ValueError) as e:
+            print(f'资源采样不可用: {e}', file=sys.stderr)
+        except Exception as e:
+            if psutil is None or not isinstance(e, psutil.Error):
+                raise
+
+    def stop(self):
+        self.stop_event.set()
+
+    def summary(self):
+        if not self.cpu_samples:
+            return None
+        return {
+            'cpu_percent_avg': round(sum(self.cpu_samples) / len(self.cpu_samples), 1),
+            'cpu_percent_max': round(max(self.cpu_samples), 1),
+            'rss_mb_max': round(max(self.rss_samples) / 1024 / 1024, 1)
+        }
+
+class RoundStats:
+    """一轮压测的统计数据（线程安全）"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.measuring = False  # 统计窗口内发送的帧
+        self.receiving = False  # 窗口结束后继续接收在途帧，直到排空
+        self.frames_sent = 0
+        self.frames_accepted = 0
+        self.frames_rejected = 0
+        self.frames_late = 0
+        self.send_errors = 0
+        self.upload_rtts = []
+        self.latencies = []
+        self.frames_received = 0
+        self.frames_repeated = 0  # 静态帧的重复标记，不带帧数据
+        self.delivered = set()  # 至少被一个观看端收到的 (设备序号, 帧序号)
+        self.accepted = set()
+
+    def record_send(self, device_index, seq, status, rtt_ms):
+        with self.lock:
+            if not self.measuring:
+                return
+            self.frames_sent += 1
+            if status == 200:
+                self.frames_accepted += 1
+                self.accepted.add((device_index, seq))
+                self.upload_rtts.append(rtt_ms)
+            elif status == 429:
+                self.frames_rejected += 1
+            else:
+                self.send_errors += 1
+
+    def record_late(self):
+        with self.lock:
+            if self.measuring:
+                self.frames_late += 1
+
+    def record_repeat(self):
+        with self.lock:
+            if self.receiving:
+                self.frames_repeated += 1
+
+    def record_receive(self, device_index, seq, latency_ms):
+        with self.lock:
+            if not self.receiving or (device_index, seq) not in self.accepted:
+                return
+            self.frames_received += 1
+            self.delivered.add((device_index, seq))
+            self.latencies.append(latency_ms)
+
+class DeviceSimulator(threading.Thread):
+    """模拟一台眼镜：开始流并按固定帧率上传合成帧"""
+
+    def __init__(self, base_url, device_index, fps, stats, stop_event):
+        super().__init__(daemon=True)
+        self.base_url = base_url
+        self.device_index = device_index
+        self.fps = fps
+        self.stats = stats
+        self.stop_event = stop_event
+        self.session = requests.Session()
+        self.frames = make_base_frames(device_index)
+        self.stream_id = None
+
+    def start_stream(self):
+        """开始流，服务器准入控制拒绝（503）时返回None"""
+        response = self.session.post(
+            f'{self.base_url}/api/stream/start',
+            json={'device_id': f'bench_device_{self.device_index}'},
+            timeout=10
+        )
+        if response.status_code == 503:
+            return None
+        response.raise_for_status()
+        self.stream_id = response.json()['streamId']
+        return self.stream_id
+
+    def stop_stream(self):
+        if self.stream_id:
+            try:
+                self.session.post(f'{self.base_url}/api/stream/{self.stream_id}/stop', timeout=5)
+            except requests.exceptions.RequestException:
+                pass
+
+    def run(self):
+        interval = 1.0 / self.fps
+        next_send = time.perf_counter()
+        seq = 0
+        url = f'{self.base_url}/api/stream/{self.stream_id}/chunk'
+        while not self.stop_event.is_set():
+            frame = self.frames[seq % len(self.frames)]
+            frame[-TRAILER.size:] = TRAILER.pack(TRAILER_MAGIC, self.device_index, seq, time.time_ns())
+            started = time.perf_counter()
+            try:
+                response = self.session.post(
+                    url, data=bytes(frame),
+                    headers={'Content-Type': 'application/octet-stream'},
+                    timeout=10
+                )
+                status = response.status_code
+            except requests.exceptions.RequestException:
+                status = None
+            self.stats.record_send(self.device_index, seq, status, (time.perf_counter() - started) * 1000)
+            seq += 1
+
+            next_send += interval
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                self.stop_event.wait(delay)
+            elif -delay > interval:
+                # 发送跟不上目标帧率，跳过落后的帧而不是集中补发
+                skipped = int(-delay // interval)
+                for _ in range(skipped):
+                    self.stats.record_late()
+                seq += skipped
+                next_send += skipped * interval
+
+class Viewer:
+    """通过WebSocket接收处理后的数据并计算延迟"""
+
+    def __init__(self, base_url, stream_id, stats):
+        self.base_url = base_url
+        self.stream_id = stream_id
+        self.stats = stats
+        self.ready = threading.Event()
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on('connect', self._on_connect)
+        self.sio.on('joined_stream', self._on_joined)
+        self.sio.on('processed_stream_started', self._on_started)
+        self.sio.on('processed_chunk', self._on_chunk)
+
+    def _on_connect(self):
+        self.sio.emit('join_stream', {'stream_id': self.stream_id})
+
+    def _on_joined(self, data):
+        self.sio.emit('request_processed_stream', {'stream_id': self.stream_id})
+
+    def _on_started(self, data):
+        self.ready.set()
+
+    def _on_chunk(self, data):
+        received_ns = time.time_ns()
+        if data.get('repeat'):
+            # 服务器判定为静态帧，只发送重复标记，没有数据可解码
+            self.stats.record_repeat()
+            return
+        chunk = base64.b64decode(data['data'])
+        if len(chunk) < PROCESSED_HEADER_SIZE + TRAILER.size:
+            return
+        magic, device_index, seq, sent_ns = TRAILER.unpack(chunk[-TRAILER.size:])
+        if magic == TRAILER_MAGIC:
+            self.stats.record_receive(device_index, seq, (received_ns - sent_ns) / 1e6)
+
+    def connect(self):
+        self.sio.connect(self.base_url, wait_timeout=10)
+
+    def disconnect(self):
+        try:
+            self.sio.disconnect()
+        except Exception:
+            pass
+
+def run_round(base_url, server_pid, devices, viewers, fps, duration, warmup, drain, label):
+    """运行一轮压测并返回结果"""
+    stats = RoundStats()
+    stop_event = threading.Event()
+    simulators = [DeviceSimulator(base_url, i, fps, stats, stop_event) for i in range(devices)]
+    viewer_clients = []
+    admitted = []
+    try:
+        for simulator in simulators:
+            # 准入控制拒绝新流说明服务器已满载，只对已准入的流加压
+            if simulator.start_stream() is None:
+                continue
+            admitted.append(simulator)
+            for _ in range(viewers):
+                viewer = Viewer(base_url, simulator.stream_id, stats)
+                viewer.connect()
+                viewer_clients.append(viewer)
+        for viewer in viewer_clients:
+            viewer.ready.wait(10)
+
+        for simulator in admitted:
+            simulator.start()
+        time.sleep(warmup)
+
+        sampler = ResourceSampler(server_pid)
+        sampler.start()
+        with stats.lock:
+            stats.measuring = True
+            stats.receiving = True
+        started = time.time()
+        time.sleep(duration)
+        with stats.lock:
+            stats.measuring = False
+        elapsed = time.time() - started
+        sampler.stop()
+        time.sleep(drain)
+        with stats.lock:
+            stats.receiving = False
+    finally:
+        stop_event.set()
+        for simulator in simulators:
+            if simulator.is_alive():
+                simulator.join(timeout=10)
+            simulator.stop_stream()
+        for viewer in viewer_clients:
+            viewer.disconnect()
+
+    with stats.lock:
+        delivered = len(stats.delivered & stats.accepted)
+        accepted = stats.frames_accepted
+        streams = len(admitted)
+        target = streams * fps * elapsed
+        return {
+            'label': label,
+            'devices': devices,
+            'streams_admitted': streams,
+            'streams_rejected': devices - streams,
+            'viewers_per_stream': viewers,
+            'target_fps': fps,
+            'duration': round(elapsed, 2),
+            'frame_size': FRAME_SIZE,
+            'frames_sent': stats.frames_sent,
+            'frames_accepted': accepted,
+            'frames_rejected': stats.frames_rejected,
+            'frames_late': stats.frames_late,
+            'send_errors': stats.send_errors,
+            'frames_received': stats.frames_received,
+            'frames_repeated': stats.frames_repeated,
+            'upload_fps_per_stream': round(accepted / elapsed / streams, 2) if streams else 0,
+            'delivered_fps_per_stream': round(delivered / elapsed / streams, 2) if streams else 0,
+            'send_shortfall_rate': round(1 - stats.frames_sent / target, 4) if target else 0,
+            'reject_rate': round(stats.frames_rejected / stats.frames_sent, 4) if stats.frames_sent else 0,
+            'drop_rate': round(1 - delivered / accepted, 4) if accepted else 0,
+            'latency_ms': percentiles(stats.latencies),
+            'upload_rtt_ms': percentiles(stats.upload_rtts),
+            'server': sampler.summary()
+        }
+
+def is_saturated(result, max_drop_rate, max_p95_ms):
+    """判断服务器是否已过载（准入控制拒绝新流即视为已达饱和点）"""
+    latency = result['latency_ms']
+    return (
+        result['streams_rejected'] > 0
+        or result['drop_rate'] > max_drop_rate
+        or result['reject_rate'] > max_drop_rate
+        or latency is None
+        or latency['p95'] > max_p95_ms
+    )
+
+def print_result(result):
+    latency = result['latency_ms'] or {}
+    server = result['server'] or {}
+    print(
+        f"[{result['label']}] 设备={result['devices']} 拒绝流={result['streams_rejected']} "
+        f"观看端/流={result['viewers_per_stream']} "
+        f"上传fps/流={result['upload_fps_per_stream']} 送达fps/流={result['delivered_fps_per_stream']} "
+        f"丢帧率={result['drop_rate']:.2%} 拒绝率={result['reject_rate']:.2%} "
+        f"延迟p50/p95/p99={latency.get('p50')}/{latency.get('p95')}/{latency.get('p99')}ms "
+        f"CPU={server.get('cpu_percent_avg')}% RSS={server.get('rss_mb_max')}MB"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description='INMO AIR3 多路流压测')
+    parser.add_argument('--url', help='压测已运行的服务器（不指定时自动启动）')
+    parser.add_argument('--server-pid', type=int, help='配合--url，采样该进程的CPU/内存')
+    parser.add_argument('--in-process', action='store_true', help='在压测进程内启动服务器')
+    parser.add_argument('--server-log', help='子进程服务器日志输出文件')
+    parser.add_argument('--devices', type=int, default=2, help='模拟设备数（每台一路流）')
+    parser.add_argument('--ramp', help='逐轮增加设备数，例如 1,2,4,8，过载后停止')
+    parser.add_argument('--viewers', type=int, default=1, help='每路流的观看端数')
+    parser.add_argument('--fps', type=float, default=5, help='每台设备的上传帧率')
+    parser.add_argument('--duration', type=float, default=20, help='每轮统计时长（秒）')
+    parser.add_argument('--warmup', type=float, default=2, help='每轮开始后不计入统计的预热时长（秒）')
+    parser.add_argument('--drain', type=float, default=2, help='统计窗口结束后等待在途帧送达的时长（秒）')
+    parser.add_argument('--label', default='default', help='结果标签，用于比较不同配置')
+    parser.add_argument('--max-drop-rate', type=float, default=0.05, help='判定过载的丢帧率/拒绝率')
+    parser.add_argument('--max-p95-ms', type=float, default=1000, help='判定过载的p95延迟（毫秒）')
+    parser.add_argument('--json', help='结果输出的JSON文件，"-" 表示标准输出')
+    args = parser.parse_args()
+
+    server = None
+    if args.url:
+        base_url = args.url.rstrip('/')
+        server_pid = args.server_pid
+    else:
+        port = free_port()
+        server = InProcessServer(port) if args.in_process else ServerProcess(port, args.server_log)
+        base_url = f'http://127.0.0.1:{port}'
+        server_pid = server.pid
+
+    results = []
+    try:
+        if not wait_for_server(base_url):
+            print(f'服务器未响应: {base_url}', file=sys.stderr)
+            return 1
+
+        device_counts = [int(n) for n in args.ramp.split(',')] if args.ramp else [args.devices]
+        for devices in device_counts:
+            result = run_round(base_url, server_pid, devices, args.viewers, args.fps,
+                               args.duration, args.warmup, args.drain, args.label)
+            result['saturated'] = is_saturated(result, args.max_drop_rate, args.max_p95_ms)
+            results.append(result)
+            print_result(result)
+            if args.ramp and result['saturated']:
+                if result['streams_rejected']:
+                    print(f"{devices} 台设备时准入控制拒绝了 {result['streams_rejected']} 路流，停止加压")
+                else:
+                    print(f'{devices} 台设备时服务器过载，停止加压')
+                break
+    finally:
+        if server is not None:
+            server.stop()
+
+    sustainable = [r['devices'] for r in results if not r['saturated']]
+    report = {
+        'label': args.label,
+        'url': base_url,
+        'max_sustainable_devices': max(sustainable) if sustainable else 0,
+        # 准入控制开始拒绝新流时已准入的流数（未触发准入控制时为None）
+        'admission_limit': next((r['streams_admitted'] for r in results if r['streams_rejected']), None),
+        'rounds': results
+    }
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f'结果已保存: {args.json}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,14 +5,32 @@ from flask import Flask, request, Response, jsonify
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import os
+import sys
 import uuid
 import time
 import threading
+import tracemalloc
 import queue
 import base64
+import io
+import random
+import itertools
+import math
+import zlib
+import zipfile
+import json
+import hmac
+from collections import OrderedDict, deque
 from datetime import datetime
 import logging
 
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError:  # 缩略图等图像功能需要 numpy 和 Pillow
+    np = None
+    Image = None
+
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -23,42 +41,1388 @@ CORS(app, origins="*")
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
 
 # 流媒体配置
-CHUNK_SIZE = 8192  # 8KB chunks
+CHUNK_SIZE = 8192  # 分块上传时建议的数据块大小（8KB，开始流时告知设备）
 MAX_BUFFER_SIZE = 100  # 最大缓冲区大小
+FRAME_RING_SIZE = int(os.environ.get('STREAM_FRAME_RING_SIZE', '30'))  # 每路流保留的最近处理帧数
+FRAME_FETCH_LIMIT = 10  # get_processed_chunk 单次最多返回的帧数
+STREAM_SEND_INTERVAL = 0.2  # request_processed_stream 推送间隔，5 FPS，匹配帧捕获频率
+FRAME_HEADER_SIZE = 8  # 处理后数据开头的时间戳长度
+
+# 未在开始流时指定尺寸时，按NV21数据长度（宽*高*1.5）推断
+COMMON_FRAME_SIZES = [(640, 480), (1280, 720), (1920, 1080), (320, 240), (800, 600), (352, 288), (176, 144)]
+
+# 拥塞反馈：按输入队列等待时间、队列深度和丢帧率估计拥塞，通过 adjust_capture 建议设备调整采集档位
+CAPTURE_LADDER = [  # 由高到低的采集档位
+    {'fps': 10, 'width': 640, 'height': 480},
+    {'fps': 5, 'width': 640, 'height': 480},
+    {'fps': 3, 'width': 640, 'height': 480},
+    {'fps': 3, 'width': 320, 'height': 240},
+    {'fps': 1, 'width': 320, 'height': 240},
+]
+CAPTURE_DEFAULT_LEVEL = 1  # 设备默认 5 FPS、640x480
+CONGESTION_CHECK_INTERVAL = 1.0  # 评估间隔（秒）
+CONGESTION_LAG_HIGH = 0.5  # 输入队列等待超过该值（秒）视为拥塞
+CONGESTION_LAG_LOW = 0.15  # 低于该值才视为空闲
+CONGESTION_DEPTH_HIGH = 0.5  # 队列占用超过缓冲区的比例视为拥塞
+CONGESTION_DEPTH_LOW = 0.1
+CONGESTION_DROP_HIGH = 0.05  # 拒绝率超过该值视为拥塞
+CONGESTION_DEGRADE_AFTER = 2  # 连续拥塞的评估次数达到后降档
+CONGESTION_UPGRADE_AFTER = 10  # 连续空闲的评估次数达到后升档
+CONGESTION_SETTLE_TIME = 5.0  # 调整后等待设备生效、积压排空的时间（秒），期间不再调整
+CONGESTION_HEADROOM = 0.8  # 建议帧率不超过估计处理能力的比例
+CONGESTION_EWMA_ALPHA = 0.3
+
+# 延迟预算：输入队列中等待超过预算的帧在处理前丢弃；延迟持续增长时逐级跳过可选处理阶段，恢复后逐级回升
+LATENCY_BUDGET = float(os.environ.get('STREAM_LATENCY_BUDGET', '1.0'))  # 默认预算（秒），0表示关闭
+PROCESSING_TIERS = ('full', 'light', 'passthrough')  # 完整处理 / 跳过重处理阶段 / 只写时间戳头
+LATENCY_DEGRADE_RATIO = 0.5  # 平均延迟超过预算的该比例视为延迟增长
+LATENCY_RECOVER_RATIO = 0.2  # 低于该比例视为已恢复
+LATENCY_DEGRADE_AFTER = 5  # 连续超过的帧数达到后降一级
+LATENCY_RECOVER_AFTER = 25  # 连续恢复的帧数达到后升一级
+LATENCY_TIER_HOLD = 1.0  # 档位变化后保持的最短时间（秒），等待积压排空
+LATENCY_EWMA_ALPHA = 0.3
+
+# 加权公平调度：各流处理线程共享有限的处理槽位，按字节数做开始时间公平排队（SFQ），
+# 槽位不足时高码率设备只占用与其权重成比例的处理能力
+PROCESSING_SLOTS = int(os.environ.get('STREAM_PROCESSING_SLOTS', str(os.cpu_count() or 1)))  # 同时处理的帧数
+QOS_CLASSES = {'premium': 4.0, 'standard': 1.0, 'background': 0.25}  # QoS等级 -> 权重
+QOS_DEFAULT_CLASS = 'standard'
+SCHEDULER_SHARE_WINDOW = 10.0  # 统计实际份额和槽位利用率的时间窗口（秒）
+
+# 准入控制：按实测的每字节处理耗时估计新流的负载，预计利用率超过目标时拒绝开始新流，保证已有流的质量
+ADMISSION_TARGET_UTILIZATION = float(os.environ.get('STREAM_ADMISSION_TARGET', '0.8'))  # 0表示关闭
+ADMISSION_DEFAULT_FRAME_COST = 0.06  # 还没有实测数据时640x480一帧的处理耗时估计（秒）
+ADMISSION_RETRY_AFTER = 10  # 拒绝时建议的重试间隔（秒）
+PEER_NODES = [url.strip() for url in os.environ.get('STREAM_PEER_NODES', '').split(',') if url.strip()]
+
+# 分块上传：带帧序号和偏移的任意大小数据块直接写入预分配的帧缓冲区，收齐后才进入处理队列
+ASSEMBLY_TIMEOUT = 2.0  # 帧在该时间（秒）内没有收齐即丢弃
+ASSEMBLY_MAX_PENDING = 4  # 每路流同时组装的帧数，超出时丢弃最早的未完成帧
+ASSEMBLY_MAX_FRAME_BYTES = 8 * 1024 * 1024  # 任何流的帧长度上限，各流按协商的帧尺寸进一步限制
+ASSEMBLY_FINISHED_HISTORY = 64  # 记住最近完成或丢弃的帧序号，迟到的重复数据块直接拒绝
+
+# 压缩上传：X-Frame-Codec 标明帧的编码，需要像素的阶段才解码，直通和丢弃的帧不解码
+FRAME_CODECS = ('raw', 'zlib', 'delta')  # delta：与最近一个非差分帧（关键帧）逐字节相减（模256）后zlib压缩
+
+# 上传速率限制：每路流和每个设备各有帧数、字节数两个令牌桶，在读取请求体之前检查
+STREAM_RATE_LIMIT_FPS = float(os.environ.get('STREAM_RATE_LIMIT_FPS', '15'))  # 每路流默认上限，0表示不限制
+STREAM_RATE_LIMIT_BYTES = float(os.environ.get('STREAM_RATE_LIMIT_BYTES', str(16 * 1024 * 1024)))  # 字节/秒
+DEVICE_RATE_LIMIT_FPS = float(os.environ.get('DEVICE_RATE_LIMIT_FPS', '30'))  # 同一设备所有流合计
+DEVICE_RATE_LIMIT_BYTES = float(os.environ.get('DEVICE_RATE_LIMIT_BYTES', str(32 * 1024 * 1024)))
+RATE_LIMIT_BURST = 1.0  # 桶容量为该秒数的配额
+
+# 静态帧检测：降采样Y平面与上一处理帧比较，变化小于阈值时跳过处理并向观看端发送重复标记
+STATIC_FRAME_THRESHOLD = float(os.environ.get('STREAM_STATIC_THRESHOLD', '2.0'))  # 平均绝对差（0-255），0表示关闭
+STATIC_SIGNATURE_GRID = (40, 30)  # 签名采样点（宽 x 高）
+STATIC_MAX_REPEATS = 50  # 连续重复超过该帧数时强制处理一次，避免长期沿用旧结果
+
+# 关键帧选择：为3DGS重建挑选清晰（Y平面拉普拉斯方差）且与上一关键帧差异足够大的帧，每路流保存一组可导出的关键帧
+KEYFRAME_MIN_SHARPNESS = float(os.environ.get('STREAM_KEYFRAME_MIN_SHARPNESS', '30'))  # 拉普拉斯方差下限
+KEYFRAME_SHARPNESS_RATIO = 0.7  # 不低于近期平均清晰度的该比例，排除运动模糊的帧
+KEYFRAME_NOVELTY = float(os.environ.get('STREAM_KEYFRAME_NOVELTY', '0.3'))  # 新颖度下限（0-1，约为与上一关键帧不重叠的比例）
+KEYFRAME_THUMB_SIZE = (160, 120)  # 计算新颖度的缩略图（块平均）
+KEYFRAME_RESIDUAL_SCALE = 40.0  # 对齐后平均绝对差达到该值（0-255）视为内容完全不同
+KEYFRAME_MAX_PER_STREAM = int(os.environ.get('STREAM_KEYFRAME_MAX', '50'))  # 达到上限后不再选择
+KEYFRAME_ARCHIVE_STREAMS = 8  # 已停止的流保留关键帧供导出的数量
+KEYFRAME_EXPORT_FORMATS = {'jpeg': 'jpg', 'png': 'png', 'nv21': 'nv21'}
+
+# 观看端可选的输出像素格式，RGB格式在服务器上每帧只转换一次，供所有订阅者共享
+OUTPUT_FORMATS = ('nv21', 'rgb565', 'rgb888')
+# 观看端可请求原样接收的上传编码：直通的压缩帧不解码直接转发，其他帧仍发送NV21
+# （delta帧依赖观看端不一定收到过的关键帧，总是解码后发送）
+FORWARD_CODECS = ('zlib',)
+
+# 缩略图配置
+SNAPSHOT_DEFAULT_WIDTH = 160
+SNAPSHOT_MIN_WIDTH = 16
+SNAPSHOT_JPEG_QUALITY = 75
+SNAPSHOT_FORMATS = {'jpeg': ('JPEG', 'image/jpeg'), 'png': ('PNG', 'image/png')}
+
+# 帧追踪配置：按采样率记录帧在各阶段的耗时，可通过 /api/admin/trace 调整和导出
+TRACE_SAMPLE_RATE = float(os.environ.get('STREAM_TRACE_SAMPLE_RATE', '0'))  # 0表示关闭
+TRACE_BUFFER_SIZE = int(os.environ.get('STREAM_TRACE_BUFFER_SIZE', '20000'))  # 最多保留的事件数
+
+# 管理接口（/api/admin/*）的访问令牌，请求需带 X-Admin-Token 头；未设置时管理接口关闭
+ADMIN_TOKEN = os.environ.get('STREAM_ADMIN_TOKEN', '')
+
+# 诊断配置：采样分析器和内存快照仅在调用管理接口时运行，平时没有开销
+PROFILE_DEFAULT_SECONDS = 2
+PROFILE_MAX_SECONDS = 5  # 单次采样分析的最长时长，更长的请求按该值截断（分析期间占用一个请求线程）
+PROFILE_DEFAULT_INTERVAL = 0.005  # 采样间隔（秒）
+TRACEMALLOC_MAX_SNAPSHOTS = 10  # 保留的内存快照数量
+
+# 通知合并窗口：同一房间的同类通知在窗口内只发送最新一条
+NOTIFY_COALESCE_WINDOW = float(os.environ.get('STREAM_NOTIFY_WINDOW', '0.05'))
 
 # 存储活跃的流
 active_streams = {}
 stream_buffers = {}
 
+class FrameTrace:
+    """单个被采样帧的追踪上下文，随帧经过各个队列"""
+    __slots__ = ('trace_id', 'stream_id', 'size', 'last_ns')
+    
+    def __init__(self, trace_id, stream_id, size, start_ns):
+        self.trace_id = trace_id
+        self.stream_id = stream_id
+        self.size = size
+        self.last_ns = start_ns
+
+class FrameTracer:
+    """按采样率追踪帧经过 上传→输入队列→处理→输出队列→发送 的耗时，事件保存在有界缓冲区"""
+    
+    def __init__(self, sample_rate, capacity):
+        self.sample_rate = sample_rate
+        self.events = deque(maxlen=capacity)
+        self.ids = itertools.count(1)
+        self.stream_pids = {}
+        self.lock = threading.Lock()
+    
+    def start(self, stream_id, size):
+        """按采样率决定是否追踪该帧，不追踪时返回None"""
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        return FrameTrace(next(self.ids), stream_id, size, time.perf_counter_ns())
+    
+    def stage(self, trace, name, **args):
+        """记录从上一阶段结束到现在的一段耗时"""
+        if trace is None:
+            return
+        now = time.perf_counter_ns()
+        self._append(trace, {
+            'name': name,
+            'ph': 'X',
+            'ts': trace.last_ns / 1000,
+            'dur': (now - trace.last_ns) / 1000,
+        }, args)
+        trace.last_ns = now
+    
+    def span(self, trace, name, start_ns, **args):
+        """记录从start_ns到现在的一段耗时，不改变帧的阶段进度（用于同一帧被多个观看端读取），返回当前时间"""
+        if trace is None:
+            return None
+        now = time.perf_counter_ns()
+        self._append(trace, {
+            'name': name,
+            'ph': 'X',
+            'ts': start_ns / 1000,
+            'dur': (now - start_ns) / 1000,
+        }, args)
+        return now
+    
+    def instant(self, trace, name, **args):
+        """记录一个瞬时事件（如丢帧）"""
+        if trace is None:
+            return
+        self._append(trace, {
+            'name': name,
+            'ph': 'i',
+            's': 't',
+            'ts': time.perf_counter_ns() / 1000,
+        }, args)
+    
+    def _append(self, trace, event, args):
+        with self.lock:
+            pid = self.stream_pids.get(trace.stream_id)
+            if pid is None:
+                pid = self.stream_pids[trace.stream_id] = len(self.stream_pids) + 1
+        event['pid'] = pid
+        event['tid'] = trace.trace_id
+        event['args'] = dict(args, frame=trace.trace_id, size=trace.size)
+        self.events.append(event)
+    
+    def configure(self, sample_rate=None, clear=False):
+        if sample_rate is not None:
+            self.sample_rate = min(1.0, max(0.0, sample_rate))
+        if clear:
+            with self.lock:
+                self.events.clear()
+                self.stream_pids.clear()
+    
+    def export(self, stream_id=None):
+        """导出为Chrome trace-event格式（chrome://tracing 或 Perfetto 可直接打开）"""
+        with self.lock:
+            events = list(self.events)
+            pids = dict(self.stream_pids)
+        if stream_id is not None:
+            pid = pids.get(stream_id)
+            events = [e for e in events if e['pid'] == pid]
+            pids = {stream_id: pid} if pid is not None else {}
+        
+        # 每路流一个进程，每个帧一个线程
+        metadata = [{
+            'name': 'process_name', 'ph': 'M', 'pid': pid,
+            'args': {'name': f'stream {sid}'}
+        } for sid, pid in pids.items()]
+        metadata.extend({
+            'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+            'args': {'name': f'frame {tid}'}
+        } for pid, tid in {(e['pid'], e['tid']) for e in events})
+        
+        return {
+            'traceEvents': metadata + events,
+            'displayTimeUnit': 'ms',
+            'otherData': {
+                'sample_rate': self.sample_rate,
+                'buffer_capacity': self.events.maxlen,
+                'event_count': len(events)
+            }
+        }
+
+frame_tracer = FrameTracer(TRACE_SAMPLE_RATE, TRACE_BUFFER_SIZE)
+
+class SamplingProfiler:
+    """定时采样所有线程的调用栈，输出火焰图可用的折叠栈格式"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+    
+    def run(self, seconds, interval):
+        """在调用线程中采样seconds秒，返回 ({折叠栈: 次数}, 采样次数)；已有分析在运行时返回None"""
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            own_ident = threading.get_ident()
+            counts = {}
+            samples = 0
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own_ident:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                        frame = frame.f_back
+                    stack.append(names.get(ident, f'thread-{ident}'))
+                    key = ';'.join(reversed(stack))
+                    counts[key] = counts.get(key, 0) + 1
+                samples += 1
+                time.sleep(interval)
+            return counts, samples
+        finally:
+            self.lock.release()
+
+class AllocationTracker:
+    """按需启停tracemalloc，保存快照并按分配位置统计和比较"""
+    
+    GROUP_BY = ('lineno', 'filename', 'traceback')
+    
+    def __init__(self, max_snapshots):
+        self.snapshots = {}
+        self.max_snapshots = max_snapshots
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+    
+    @property
+    def is_tracing(self):
+        return tracemalloc.is_tracing()
+    
+    def start(self, frames):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+    
+    def stop(self):
+        tracemalloc.stop()
+        with self.lock:
+            self.snapshots.clear()
+    
+    def take_snapshot(self):
+        """保存一份快照，超出数量时丢弃最早的"""
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        ))
+        with self.lock:
+            snapshot_id = next(self.ids)
+            self.snapshots[snapshot_id] = snapshot
+            while len(self.snapshots) > self.max_snapshots:
+                del self.snapshots[min(self.snapshots)]
+        return snapshot_id, snapshot
+    
+    def get(self, snapshot_id):
+        with self.lock:
+            return self.snapshots.get(snapshot_id)
+    
+    @staticmethod
+    def describe(stat, group_by):
+        frames = stat.traceback if group_by == 'traceback' else stat.traceback[:1]
+        return [f'{frame.filename}:{frame.lineno}' for frame in frames]
+    
+    def top(self, snapshot, group_by, limit):
+        return [{
+            'site': self.describe(stat, group_by),
+            'size': stat.size,
+            'count': stat.count
+        } for stat in snapshot.statistics(group_by)[:limit]]
+    
+    def diff(self, old, new, group_by, limit):
+        return [{
+            'site': self.describe(stat, group_by),
+            'size': stat.size,
+            'size_diff': stat.size_diff,
+            'count': stat.count,
+            'count_diff': stat.count_diff
+        } for stat in new.compare_to(old, group_by)[:limit]]
+
+sampling_profiler = SamplingProfiler()
+allocation_tracker = AllocationTracker(TRACEMALLOC_MAX_SNAPSHOTS)
+
+class NotificationEmitter:
+    """在独立线程中发送WebSocket通知，按 (事件, 房间) 合并窗口内的多次通知，只发送最新状态"""
+    
+    def __init__(self, window):
+        self.window = window
+        self.pending = OrderedDict()  # (event, room) -> [data, 合并次数]
+        self.condition = threading.Condition()
+        self.thread = None
+        self.queued = 0
+        self.sent = 0
+    
+    def emit(self, event, data, room):
+        """登记一条通知，立即返回，不等待发送"""
+        with self.condition:
+            self.queued += 1
+            key = (event, room)
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = [data, 1]
+            else:
+                entry[0] = data
+                entry[1] += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='notification-emitter', daemon=True)
+                self.thread.start()
+            self.condition.notify()
+    
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                batch, self.pending = self.pending, OrderedDict()
+            
+            started = time.monotonic()
+            with app.app_context():
+                for (event, room), (data, merged) in batch.items():
+                    if merged > 1:
+                        data = dict(data, coalesced=merged)
+                    try:
+                        socketio.emit(event, data, room=room)
+                        self.sent += 1
+                    except Exception as e:
+                        logger.error(f"发送通知 {event} 失败: {e}")
+            
+            # 每个窗口最多发送一批，窗口内到达的通知留到下一批合并
+            remaining = self.window - (time.monotonic() - started)
+            if remaining > 0:
+                time.sleep(remaining)
+    
+    def stats(self):
+        with self.condition:
+            return {
+                'queued': self.queued,
+                'sent': self.sent,
+                'pending': len(self.pending),
+                'window_ms': self.window * 1000
+            }
+
+notification_emitter = NotificationEmitter(NOTIFY_COALESCE_WINDOW)
+
+class CongestionController:
+    """估计单路流的处理延迟、队列深度和丢帧率，带滞回地给出建议采集档位"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.level = CAPTURE_DEFAULT_LEVEL
+        self.accepted = 0  # 本评估窗口内的上传计数
+        self.rejected = 0
+        self.lag = 0.0  # 输入队列等待时间（秒，EWMA）
+        self.service_time = 0.0  # 每帧处理耗时（秒，EWMA）
+        self.drop_rate = 0.0
+        self.depth = 0
+        self.congested_checks = 0
+        self.idle_checks = 0
+        self.last_check = time.monotonic()
+        self.hold_until = 0.0
+        self.adjustments = 0
+    
+    def record_upload(self, accepted):
+        with self.lock:
+            if accepted:
+                self.accepted += 1
+            else:
+                self.rejected += 1
+    
+    def record_processed(self, lag, service_time=None):
+        """记录一帧的排队等待和处理耗时，过期丢弃的帧没有处理耗时"""
+        with self.lock:
+            alpha = CONGESTION_EWMA_ALPHA
+            self.lag = lag if self.service_time == 0 else (1 - alpha) * self.lag + alpha * lag
+            if service_time is not None:
+                self.service_time = service_time if self.service_time == 0 else \
+                    (1 - alpha) * self.service_time + alpha * service_time
+    
+    @property
+    def capacity_fps(self):
+        """按平均处理耗时估计的最大处理帧率"""
+        return 1.0 / self.service_time if self.service_time > 0 else None
+    
+    def suggestion(self):
+        return dict(CAPTURE_LADDER[self.level], level=self.level)
+    
+    def evaluate(self, depth):
+        """到达评估间隔时更新状态，档位变化时返回新的建议，否则返回None"""
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_check < CONGESTION_CHECK_INTERVAL:
+                return None
+            self.last_check = now
+            
+            total = self.accepted + self.rejected
+            self.drop_rate = self.rejected / total if total else 0.0
+            self.depth = depth
+            uploads = self.accepted
+            self.accepted = self.rejected = 0
+            
+            if now < self.hold_until:
+                return None
+            
+            congested = (self.lag > CONGESTION_LAG_HIGH
+                         or depth > MAX_BUFFER_SIZE * CONGESTION_DEPTH_HIGH
+                         or self.drop_rate > CONGESTION_DROP_HIGH)
+            idle = (uploads > 0 and self.lag < CONGESTION_LAG_LOW
+                    and depth <= MAX_BUFFER_SIZE * CONGESTION_DEPTH_LOW and self.drop_rate == 0)
+            self.congested_checks = self.congested_checks + 1 if congested else 0
+            self.idle_checks = self.idle_checks + 1 if idle else 0
+            
+            level = self.level
+            capacity = self.capacity_fps
+            if self.congested_checks >= CONGESTION_DEGRADE_AFTER and level < len(CAPTURE_LADDER) - 1:
+                # 至少降一档，处理能力明显不足时直接降到能承受的档位
+                level += 1
+                while (capacity is not None and level < len(CAPTURE_LADDER) - 1
+                       and CAPTURE_LADDER[level]['fps'] > capacity * CONGESTION_HEADROOM):
+                    level += 1
+                reason = 'congested'
+            elif self.idle_checks >= CONGESTION_UPGRADE_AFTER and level > 0:
+                # 只有估计的处理能力足以支撑上一档时才升档
+                if capacity is None or CAPTURE_LADDER[level - 1]['fps'] <= capacity * CONGESTION_HEADROOM:
+                    level -= 1
+                reason = 'recovered'
+            
+            if level == self.level:
+                return None
+            self.level = level
+            self.congested_checks = self.idle_checks = 0
+            self.hold_until = now + CONGESTION_SETTLE_TIME
+            self.adjustments += 1
+            return dict(self.suggestion(), reason=reason, **self._metrics())
+    
+    def _metrics(self):
+        capacity = self.capacity_fps
+        return {
+            'lag_ms': round(self.lag * 1000, 1),
+            'queue_depth': self.depth,
+            'drop_rate': round(self.drop_rate, 4),
+            'capacity_fps': round(capacity, 1) if capacity else None
+        }
+    
+    def stats(self):
+        with self.lock:
+            return dict(self._metrics(), suggested=self.suggestion(), adjustments=self.adjustments)
+
+class FairScheduler:
+    """处理槽位的加权公平调度：每个请求按 字节数/权重 推进流的虚拟时间，空闲槽位分给开始标签最小的请求"""
+    
+    def __init__(self, slots):
+        self.condition = threading.Condition()
+        self.slots = slots
+        self.busy = 0
+        self.virtual_time = 0.0
+        self.flows = {}  # stream_id -> 调度状态
+        self.arrivals = itertools.count()  # 开始标签相同时按到达顺序
+        self.cost_per_byte = ADMISSION_DEFAULT_FRAME_COST / (640 * 480 * 3 // 2)  # 每字节占用槽位的秒数（EWMA）
+    
+    def register(self, stream_id, weight):
+        with self.condition:
+            self.flows[stream_id] = {
+                'weight': weight,
+                'finish': self.virtual_time,  # 上一请求的结束标签
+                'pending': None,  # 等待中的请求 (开始标签, 到达序号)
+                'served': deque(),  # 窗口内的 (完成时间, 字节数)
+                'served_bytes': 0,
+                'served_frames': 0,
+                'wait': 0.0,  # 等待槽位的时间（秒，EWMA）
+                'granted_at': None,
+                'busy': deque()  # 窗口内的 (完成时间, 占用槽位秒数)
+            }
+    
+    def unregister(self, stream_id):
+        with self.condition:
+            self.flows.pop(stream_id, None)
+            self.condition.notify_all()
+    
+    def _next_flow(self):
+        pending = [(flow['pending'], stream_id) for stream_id, flow in self.flows.items()
+                   if flow['pending'] is not None]
+        return min(pending)[1] if pending else None
+    
+    def acquire(self, stream_id, cost):
+        """等待一个处理槽位，cost为本帧字节数"""
+        started = time.monotonic()
+        with self.condition:
+            flow = self.flows[stream_id]
+            # 空闲后重新到达的流不累积额度，从当前虚拟时间开始
+            start = max(self.virtual_time, flow['finish'])
+            flow['finish'] = start + cost / flow['weight']
+            flow['pending'] = (start, next(self.arrivals))
+            self.condition.wait_for(lambda: self.busy < self.slots and self._next_flow() == stream_id)
+            flow['pending'] = None
+            self.busy += 1
+            self.virtual_time = start
+            
+            now = time.monotonic()
+            flow['wait'] = 0.7 * flow['wait'] + 0.3 * (now - started)
+            flow['served'].append((now, cost))
+            flow['served_bytes'] += cost
+            flow['served_frames'] += 1
+            flow['granted_at'] = (now, cost)
+    
+    def release(self, stream_id):
+        now = time.monotonic()
+        with self.condition:
+            self.busy -= 1
+            flow = self.flows.get(stream_id)
+            if flow is not None and flow['granted_at'] is not None:
+                granted, cost = flow['granted_at']
+                flow['granted_at'] = None
+                flow['busy'].append((now, now - granted))
+                if cost:
+                    self.cost_per_byte = 0.9 * self.cost_per_byte + 0.1 * (now - granted) / cost
+            self.condition.notify_all()
+    
+    def utilization(self, stream_id=None):
+        """最近窗口内占用槽位的时间比例（相对全部槽位），指定stream_id时只统计该流"""
+        cutoff = time.monotonic() - SCHEDULER_SHARE_WINDOW
+        with self.condition:
+            total = 0.0
+            for sid, flow in self.flows.items():
+                if stream_id is not None and sid != stream_id:
+                    continue
+                while flow['busy'] and flow['busy'][0][0] < cutoff:
+                    flow['busy'].popleft()
+                total += sum(seconds for _, seconds in flow['busy'])
+            return total / (SCHEDULER_SHARE_WINDOW * self.slots)
+    
+    def estimate_load(self, frame_bytes, fps):
+        """按实测的每字节处理耗时估计一路流占用的槽位比例"""
+        return fps * frame_bytes * self.cost_per_byte / self.slots
+    
+    def stats(self, stream_id=None):
+        """调度统计；share为窗口内实际获得的处理字节份额，fair_share为按权重应得的份额"""
+        cutoff = time.monotonic() - SCHEDULER_SHARE_WINDOW
+        with self.condition:
+            window = {}
+            for sid, flow in self.flows.items():
+                while flow['served'] and flow['served'][0][0] < cutoff:
+                    flow['served'].popleft()
+                window[sid] = sum(cost for _, cost in flow['served'])
+            total = sum(window.values())
+            busy_weight = sum(self.flows[sid]['weight'] for sid, served in window.items() if served)
+            
+            def flow_stats(sid):
+                flow = self.flows[sid]
+                return {
+                    'weight': flow['weight'],
+                    'share': round(window[sid] / total, 4) if total else 0.0,
+                    'fair_share': round(flow['weight'] / busy_weight, 4) if busy_weight and window[sid] else None,
+                    'wait_ms': round(flow['wait'] * 1000, 1),
+                    'served_frames': flow['served_frames'],
+                    'served_bytes': flow['served_bytes']
+                }
+            
+            if stream_id is not None:
+                return flow_stats(stream_id) if stream_id in self.flows else None
+            return {'slots': self.slots, 'busy': self.busy,
+                    'waiting': sum(1 for flow in self.flows.values() if flow['pending'] is not None),
+                    'frame_cost_ms': round(self.cost_per_byte * (640 * 480 * 3 // 2) * 1000, 2)}  # 按640x480一帧换算
+
+processing_scheduler = FairScheduler(PROCESSING_SLOTS)
+
+class AdmissionController:
+    """按实测槽位利用率和新流的预计负载决定是否接受新流"""
+    
+    def __init__(self, scheduler, target):
+        self.lock = threading.Lock()  # 检查与登记之间持有，避免同时到达的请求都被接受
+        self.scheduler = scheduler
+        self.target = target
+        self.rejected = 0
+    
+    def stream_load(self, stream):
+        """流的负载：实测利用率，流刚开始、统计窗口还未填满时不低于准入时预留的负载"""
+        measured = self.scheduler.utilization(stream.stream_id)
+        if (datetime.now() - stream.created_at).total_seconds() < SCHEDULER_SHARE_WINDOW:
+            return max(measured, stream.reserved_load)
+        return measured
+    
+    def check(self, expected_load):
+        """返回 (是否接受, 当前负载, 接受后的预计负载)，调用方需持有self.lock"""
+        current = sum(self.stream_load(stream) for stream in list(active_streams.values()) if stream.is_active)
+        projected = current + expected_load
+        if self.target > 0 and projected > self.target and current > 0:
+            self.rejected += 1
+            return False, current, projected
+        return True, current, projected
+    
+    def stats(self):
+        current = sum(self.stream_load(stream) for stream in list(active_streams.values()) if stream.is_active)
+        return {
+            'target_utilization': self.target,
+            'utilization': round(self.scheduler.utilization(), 4),
+            'committed_load': round(current, 4),
+            'rejected': self.rejected
+        }
+
+admission_controller = AdmissionController(processing_scheduler, ADMISSION_TARGET_UTILIZATION)
+
+class RateLimiter:
+    """帧数和字节数两个令牌桶，一次上传需同时满足两者才扣除"""
+    
+    def __init__(self, fps, bytes_per_sec):
+        self.lock = threading.Lock()
+        self.fps = fps  # 0表示不限制
+        self.bytes_per_sec = bytes_per_sec
+        self.frame_tokens = fps * RATE_LIMIT_BURST
+        self.byte_tokens = bytes_per_sec * RATE_LIMIT_BURST
+        self.last = time.monotonic()
+        self.rejected = 0
+    
+    def allow(self, size, frames=1):
+        """允许时扣除令牌并返回0，否则返回需要等待的秒数（分块上传时只有帧的第一个数据块计帧数）"""
+        now = time.monotonic()
+        with self.lock:
+            elapsed = now - self.last
+            self.last = now
+            self.frame_tokens = min(self.fps * RATE_LIMIT_BURST, self.frame_tokens + elapsed * self.fps)
+            self.byte_tokens = min(self.bytes_per_sec * RATE_LIMIT_BURST,
+                                   self.byte_tokens + elapsed * self.bytes_per_sec)
+            
+            wait = 0.0
+            if self.fps > 0 and self.frame_tokens < frames:
+                wait = (frames - self.frame_tokens) / self.fps
+            # 单帧超过桶容量时桶满即可通过，令牌记为负数，之后的上传相应等待更久
+            needed = min(size, self.bytes_per_sec * RATE_LIMIT_BURST)
+            if self.bytes_per_sec > 0 and self.byte_tokens < needed:
+                wait = max(wait, (needed - self.byte_tokens) / self.bytes_per_sec)
+            if wait > 0:
+                self.rejected += 1
+                return wait
+            
+            self.frame_tokens -= frames
+            self.byte_tokens -= size
+            return 0.0
+    
+    def refund(self, size, frames=1):
+        """另一个限制拒绝了本次上传时退回已扣除的令牌"""
+        with self.lock:
+            self.frame_tokens += frames
+            self.byte_tokens += size
+    
+    def stats(self):
+        return {'fps': self.fps, 'bytes_per_sec': self.bytes_per_sec, 'rejected': self.rejected}
+
+device_rate_limiters = {}  # device_id -> RateLimiter
+device_rate_limiters_lock = threading.Lock()
+
+def device_rate_limiter(device_id):
+    with device_rate_limiters_lock:
+        limiter = device_rate_limiters.get(device_id)
+        if limiter is None:
+            limiter = device_rate_limiters[device_id] = RateLimiter(DEVICE_RATE_LIMIT_FPS, DEVICE_RATE_LIMIT_BYTES)
+        return limiter
+
+class FrameSlot:
+    """正在组装的一帧：预分配的缓冲区和已收到的字节区间"""
+    __slots__ = ('seq', 'buffer', 'ranges', 'created', 'trace')
+    
+    def __init__(self, seq, length, trace):
+        self.seq = seq
+        self.buffer = bytearray(length)
+        self.ranges = []  # 已收到的 [start, end) 区间，按起点排序且互不重叠
+        self.created = time.monotonic()
+        self.trace = trace
+    
+    def mark(self, start, end):
+        """记录收到的区间（重传或重叠的数据块会合并），收齐时返回True"""
+        merged = []
+        for range_start, range_end in self.ranges:
+            if range_end < start or range_start > end:
+                merged.append((range_start, range_end))
+            else:
+                start, end = min(start, range_start), max(end, range_end)
+        merged.append((start, end))
+        merged.sort()
+        self.ranges = merged
+        return merged == [(0, len(self.buffer))]
+    
+    @property
+    def received(self):
+        return sum(end - start for start, end in self.ranges)
+
+class FrameAssembler:
+    """把带帧序号和偏移的数据块组装成完整帧，超时未收齐的帧被丢弃"""
+    
+    def __init__(self, stream_id, max_frame_bytes=ASSEMBLY_MAX_FRAME_BYTES):
+        self.lock = threading.Lock()
+        self.stream_id = stream_id
+        self.max_frame_bytes = max_frame_bytes  # 预分配前检查，声明的帧长度不能超过该值
+        self.slots = {}  # 帧序号 -> FrameSlot
+        self.finished = OrderedDict()  # 最近完成或丢弃的帧序号
+        self.completed = 0
+        self.evicted = 0
+    
+    def is_pending(self, seq):
+        with self.lock:
+            return seq in self.slots
+    
+    def _finish(self, slot):
+        del self.slots[slot.seq]
+        self.finished[slot.seq] = True
+        while len(self.finished) > ASSEMBLY_FINISHED_HISTORY:
+            self.finished.popitem(last=False)
+    
+    def _evict(self, slot, reason):
+        self._finish(slot)
+        self.evicted += 1
+        frame_tracer.instant(slot.trace, 'dropped', reason=reason, received=slot.received)
+        logger.warning(f"流 {self.stream_id} 丢弃未收齐的帧 {slot.seq}（{reason}，"
+                       f"{slot.received}/{len(slot.buffer)} 字节）")
+    
+    def _expire(self):
+        now = time.monotonic()
+        expired = [slot for slot in self.slots.values() if now - slot.created > ASSEMBLY_TIMEOUT]
+        for slot in expired:
+            self._evict(slot, 'reassembly_timeout')
+        return len(expired)
+    
+    def expire(self):
+        """丢弃超时未收齐的帧（客户端中途停止发送时由处理线程定期调用），返回丢弃的帧数"""
+        with self.lock:
+            return self._expire()
+    
+    def clear(self):
+        """流停止时丢弃所有未收齐的帧，释放预分配的缓冲区"""
+        with self.lock:
+            for slot in list(self.slots.values()):
+                self._evict(slot, 'stream_stopped')
+    
+    def open_slot(self, seq, length):
+        """返回帧的组装槽，第一次收到该帧的数据块时按帧长度预分配；帧已完成或已丢弃时返回None"""
+        if length > self.max_frame_bytes:
+            raise ValueError(f'帧长度 {length} 超过该流的上限 {self.max_frame_bytes} 字节')
+        with self.lock:
+            self._expire()
+            
+            if seq in self.finished:
+                return None
+            slot = self.slots.get(seq)
+            if slot is None:
+                if len(self.slots) >= ASSEMBLY_MAX_PENDING:
+                    self._evict(min(self.slots.values(), key=lambda pending: pending.created), 'reassembly_overflow')
+                slot = self.slots[seq] = FrameSlot(seq, length, frame_tracer.start(self.stream_id, length))
+            elif len(slot.buffer) != length:
+                raise ValueError(f'帧 {seq} 的长度与之前的数据块不一致')
+            return slot
+    
+    def commit(self, slot, offset, length):
+        """数据块已写入槽位，帧收齐时返回True（此后由调用方交给处理队列），写入期间帧已被丢弃时返回None"""
+        with self.lock:
+            if self.slots.get(slot.seq) is not slot:
+                return None
+            if not slot.mark(offset, offset + length):
+                return False
+            self._finish(slot)
+            self.completed += 1
+            return True
+    
+    def stats(self):
+        with self.lock:
+            return {'pending': len(self.slots), 'completed': self.completed, 'evicted': self.evicted}
+
+class LatencyBudget:
+    """单路流的延迟预算：判断帧是否过期，并按排队延迟的变化带滞回地选择处理档位"""
+    
+    def __init__(self, budget, base_tier=0):
+        self.lock = threading.Lock()
+        self.budget = budget  # 秒，0表示关闭
+        self.base_tier = base_tier  # 开始流时选择的处理档位，恢复时不超过该档位
+        self.tier = base_tier  # PROCESSING_TIERS 的下标
+        self.lag = 0.0  # 排队延迟（秒，EWMA）
+        self.over_frames = 0
+        self.under_frames = 0
+        self.hold_until = 0.0
+        self.expired_frames = 0
+        self.tier_changes = 0
+        self.tier_frames = [0] * len(PROCESSING_TIERS)
+    
+    @property
+    def tier_name(self):
+        return PROCESSING_TIERS[self.tier]
+    
+    def is_expired(self, age):
+        """等待时间超过预算的帧不再处理，调用方直接丢弃"""
+        if self.budget > 0 and age > self.budget:
+            with self.lock:
+                self.expired_frames += 1
+            return True
+        return False
+    
+    def record(self, lag, tier=None):
+        """记录一帧的排队延迟（tier为处理该帧所用的档位，未处理的帧为None），档位变化时返回新档位名，否则返回None"""
+        now = time.monotonic()
+        with self.lock:
+            if tier is not None:
+                self.tier_frames[tier] += 1
+            alpha = LATENCY_EWMA_ALPHA
+            self.lag = (1 - alpha) * self.lag + alpha * lag
+            if self.budget <= 0 or now < self.hold_until:
+                # 档位刚变化时积压还在排空，这段时间的延迟不计入下一次调整
+                return None
+            
+            if self.lag > self.budget * LATENCY_DEGRADE_RATIO:
+                self.over_frames += 1
+                self.under_frames = 0
+            elif self.lag < self.budget * LATENCY_RECOVER_RATIO:
+                self.under_frames += 1
+                self.over_frames = 0
+            else:
+                self.over_frames = self.under_frames = 0
+            
+            tier = self.tier
+            if self.over_frames >= LATENCY_DEGRADE_AFTER and tier < len(PROCESSING_TIERS) - 1:
+                tier += 1
+            elif self.under_frames >= LATENCY_RECOVER_AFTER and tier > self.base_tier:
+                tier -= 1
+            if tier == self.tier:
+                return None
+            self.tier = tier
+            self.over_frames = self.under_frames = 0
+            self.hold_until = now + LATENCY_TIER_HOLD
+            self.tier_changes += 1
+            return self.tier_name
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'budget_ms': round(self.budget * 1000),
+                'lag_ms': round(self.lag * 1000, 1),
+                'tier': self.tier_name,
+                'expired_frames': self.expired_frames,
+                'tier_changes': self.tier_changes,
+                'frames_by_tier': dict(zip(PROCESSING_TIERS, self.tier_frames))
+            }
+
+class StaticFrameDetector:
+    """比较降采样Y平面签名，判断新帧与上一处理帧相比是否基本没有变化"""
+    
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.reference = None  # 上一处理帧的签名
+        self.repeats = 0
+        self.static_frames = 0
+        self.last_difference = None
+    
+    @staticmethod
+    def signature(nv21, width, height):
+        """在Y平面上按网格取样，得到 高x宽 的int16签名"""
+        grid_width, grid_height = STATIC_SIGNATURE_GRID
+        step_x = max(1, width // grid_width)
+        step_y = max(1, height // grid_height)
+        y_plane = np.frombuffer(nv21, dtype=np.uint8, count=width * height).reshape(height, width)
+        return y_plane[step_y // 2::step_y, step_x // 2::step_x].astype(np.int16)
+    
+    def is_static(self, nv21, size):
+        """新帧可以沿用上一处理结果时返回True；否则记录其签名作为新的参照并返回False"""
+        if self.threshold <= 0 or np is None or size is None:
+            return False
+        
+        signature = self.signature(nv21, *size)
+        if self.reference is not None and self.reference.shape == signature.shape:
+            self.last_difference = float(np.abs(signature - self.reference).mean())
+            if self.last_difference < self.threshold and self.repeats < STATIC_MAX_REPEATS:
+                # 始终与上次处理的帧比较，缓慢变化累积到阈值后也会触发处理
+                self.repeats += 1
+                self.static_frames += 1
+                return True
+        
+        self.reference = signature
+        self.repeats = 0
+        return False
+
+def luma_thumbnail(y_plane):
+    """Y平面按块平均缩小到约 KEYFRAME_THUMB_SIZE，去除亮度均值（曝光变化不算新视角）"""
+    height, width = y_plane.shape
+    step = max(1, min(width // KEYFRAME_THUMB_SIZE[0], height // KEYFRAME_THUMB_SIZE[1]))
+    rows, cols = height // step, width // step
+    blocks = y_plane[:rows * step, :cols * step].reshape(rows, step, cols, step)
+    thumb = blocks.mean(axis=(1, 3), dtype=np.float32)
+    return thumb - thumb.mean()
+
+def estimate_shift(reference, thumb):
+    """相位相关估计thumb相对reference的平移（行, 列），返回整数像素"""
+    window = np.outer(np.hanning(thumb.shape[0]), np.hanning(thumb.shape[1])).astype(np.float32)
+    cross = np.fft.rfft2(thumb * window) * np.conj(np.fft.rfft2(reference * window))
+    cross /= np.abs(cross) + 1e-6
+    correlation = np.fft.irfft2(cross, s=thumb.shape)
+    dy, dx = np.unravel_index(np.argmax(correlation), correlation.shape)
+    if dy > thumb.shape[0] // 2:
+        dy -= thumb.shape[0]
+    if dx > thumb.shape[1] // 2:
+        dx -= thumb.shape[1]
+    return int(dy), int(dx)
+
+def view_novelty(reference, thumb):
+    """与参考缩略图相比的新颖度（0-1）：按估计的平移计算不重叠的比例，再计入重叠区域对齐后的差异"""
+    height, width = thumb.shape
+    dy, dx = estimate_shift(reference, thumb)
+    overlap = (1 - abs(dy) / height) * (1 - abs(dx) / width)
+    if overlap <= 0:
+        return 1.0
+    current = thumb[max(dy, 0):height + min(dy, 0), max(dx, 0):width + min(dx, 0)]
+    previous = reference[max(-dy, 0):height + min(-dy, 0), max(-dx, 0):width + min(-dx, 0)]
+    residual = float(np.abs(current - previous).mean()) / KEYFRAME_RESIDUAL_SCALE
+    return 1 - overlap * (1 - min(1.0, residual))
+
+def laplacian_variance(y_plane):
+    """Y平面4邻域拉普拉斯响应的方差，越大越清晰"""
+    y = y_plane.astype(np.int16)
+    laplacian = 4 * y[1:-1, 1:-1] - y[:-2, 1:-1] - y[2:, 1:-1] - y[1:-1, :-2] - y[1:-1, 2:]
+    return float(laplacian.var())
+
+class Keyframe:
+    """选出的一帧关键帧（保存zlib压缩的未经滤镜处理的NV21原始像素，导出时才解压）"""
+    __slots__ = ('index', 'seq', 'timestamp', 'width', 'height', 'sharpness', 'novelty', 'payload')
+    
+    def __init__(self, index, seq, width, height, sharpness, novelty, payload):
+        self.index = index
+        self.seq = seq
+        self.timestamp = datetime.now().isoformat()
+        self.width = width
+        self.height = height
+        self.sharpness = sharpness
+        self.novelty = novelty
+        self.payload = payload
+    
+    def pixels(self):
+        """解压后的NV21像素"""
+        return zlib.decompress(self.payload)
+    
+    def describe(self):
+        return {
+            'index': self.index,
+            'seq': self.seq,
+            'timestamp': self.timestamp,
+            'width': self.width,
+            'height': self.height,
+            'sharpness': round(self.sharpness, 2),
+            'novelty': round(self.novelty, 3) if self.novelty is not None else None
+        }
+
+class KeyframeSelector:
+    """按清晰度和相对上一关键帧的新颖度挑选关键帧"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keyframes = []
+        self.reference = None  # 上一关键帧的缩略图
+        self.sharpness = None  # 近期平均清晰度（EWMA）
+        self.evaluated = 0
+        self.blurry = 0
+        self.similar = 0
+    
+    def consider(self, nv21, size, seq, payload=None):
+        """评估一帧，选为关键帧时返回Keyframe，否则返回None；payload为上传的zlib数据时直接保存，不再压缩"""
+        if np is None or size is None or len(self.keyframes) >= KEYFRAME_MAX_PER_STREAM:
+            return None
+        width, height = size
+        y_plane = np.frombuffer(nv21, dtype=np.uint8, count=width * height).reshape(height, width)
+        sharpness = laplacian_variance(y_plane)
+        self.evaluated += 1
+        average = self.sharpness if self.sharpness is not None else sharpness
+        self.sharpness = 0.9 * average + 0.1 * sharpness
+        if sharpness < max(KEYFRAME_MIN_SHARPNESS, KEYFRAME_SHARPNESS_RATIO * average):
+            self.blurry += 1
+            return None
+        
+        thumb = luma_thumbnail(y_plane)
+        novelty = None
+        if self.reference is not None and self.reference.shape == thumb.shape:
+            novelty = view_novelty(self.reference, thumb)
+            if novelty < KEYFRAME_NOVELTY:
+                self.similar += 1
+                return None
+        
+        self.reference = thumb
+        with self.lock:
+            keyframe = Keyframe(len(self.keyframes), seq, width, height, sharpness, novelty,
+                                payload if payload is not None else zlib.compress(nv21))
+            self.keyframes.append(keyframe)
+        return keyframe
+    
+    def get(self, index):
+        with self.lock:
+            return self.keyframes[index] if 0 <= index < len(self.keyframes) else None
+    
+    def snapshot(self):
+        with self.lock:
+            return list(self.keyframes)
+    
+    def stats(self):
+        return {
+            'count': len(self.keyframes),
+            'stored_bytes': sum(len(keyframe.payload) for keyframe in self.snapshot()),
+            'evaluated': self.evaluated,
+            'rejected_blurry': self.blurry,
+            'rejected_similar': self.similar,
+            'selection_ratio': round(len(self.keyframes) / self.evaluated, 4) if self.evaluated else 0.0
+        }
+
+keyframe_archive = OrderedDict()  # 已停止的流 stream_id -> (device_id, KeyframeSelector)
+keyframe_archive_lock = threading.Lock()
+
+def archive_keyframes(stream):
+    """保存已停止的流的关键帧，只保留最近 KEYFRAME_ARCHIVE_STREAMS 路"""
+    with keyframe_archive_lock:
+        keyframe_archive[stream.stream_id] = (stream.device_id, stream.keyframes)
+        while len(keyframe_archive) > KEYFRAME_ARCHIVE_STREAMS:
+            keyframe_archive.popitem(last=False)
+
+def keyframe_source(stream_id):
+    """返回 (device_id, KeyframeSelector)，活跃的流优先，其次是最近停止的流；都没有时返回None"""
+    stream = active_streams.get(stream_id)
+    if stream is not None:
+        return stream.device_id, stream.keyframes
+    with keyframe_archive_lock:
+        return keyframe_archive.get(stream_id)
+
+class EncodedFrame:
+    """上传的一帧：按编码保存收到的字节，第一次需要像素时才解码（结果缓存）"""
+    __slots__ = ('codec', 'payload', 'reference', 'decoded')
+    
+    def __init__(self, codec, payload, reference=None):
+        self.codec = codec
+        self.payload = payload
+        self.reference = reference  # delta帧的参考关键帧
+        self.decoded = payload if codec == 'raw' else None
+    
+    def pixels(self):
+        """NV21像素数据，压缩数据损坏时抛出ValueError"""
+        if self.decoded is None:
+            decompressor = zlib.decompressobj()
+            try:
+                data = decompressor.decompress(self.payload, ASSEMBLY_MAX_FRAME_BYTES)
+            except zlib.error as e:
+                raise ValueError(f'解压失败: {e}')
+            if decompressor.unconsumed_tail or not decompressor.eof:
+                raise ValueError('压缩数据不完整或超过帧大小上限')
+            if self.codec == 'delta':
+                base = self.reference.pixels()
+                if len(base) != len(data):
+                    raise ValueError('差分帧与参考帧长度不一致')
+                data = (np.frombuffer(data, dtype=np.uint8) + np.frombuffer(base, dtype=np.uint8)).tobytes()
+            self.decoded = data
+        return self.decoded
+
+class ProcessedFrame:
+    """环形缓冲区中的一帧处理结果"""
+    __slots__ = ('seq', 'base_seq', 'data', 'source', 'trace', 'timestamp', 'published_ns', 'outputs')
+    
+    def __init__(self, seq, data, trace, base=None, source=None):
+        self.seq = seq
+        self.data = data
+        self.source = source  # 直通的压缩帧：data为时间戳头加压缩数据，像素按需从source解码
+        self.trace = trace
+        self.timestamp = datetime.now().isoformat()
+        self.published_ns = time.perf_counter_ns()
+        if base is None:
+            self.base_seq = seq
+            self.outputs = {}  # 输出格式 -> 转换后的数据（同样带8字节时间戳头）
+        else:
+            # 静态帧：沿用base的处理结果和格式转换缓存
+            self.base_seq = base.base_seq
+            self.source = base.source
+            self.outputs = base.outputs
+    
+    @property
+    def is_repeat(self):
+        return self.base_seq != self.seq
+
+def max_frame_bytes(width=None, height=None):
+    """流的帧长度上限：声明的尺寸与采集档位中最大的尺寸取大者（未声明时按常见分辨率中最大的），
+    压缩帧的数据不可压缩时可能略大于原始帧"""
+    sizes = [(ladder['width'], ladder['height']) for ladder in CAPTURE_LADDER]
+    sizes.extend([(width, height)] if width and height else COMMON_FRAME_SIZES)
+    raw = max(w * h * 3 // 2 for w, h in sizes)
+    return min(ASSEMBLY_MAX_FRAME_BYTES, raw + raw // 1000 + 64)
+
+def infer_frame_size(length):
+    """根据NV21数据长度推断常见分辨率，无法推断时返回None"""
+    for width, height in COMMON_FRAME_SIZES:
+        if width * height * 3 // 2 == length:
+            return width, height
+    return None
+
+def nv21_to_rgb(nv21, width, height, out_width=None, out_height=None):
+    """NV21 转 RGB（uint8数组，形状 高x宽x3），int16定点运算（6位小数，误差不超过±1）；
+    指定输出尺寸时先按最近邻采样再转换，只计算输出像素"""
+    out_width = out_width or width
+    out_height = out_height or height
+    frame = np.frombuffer(nv21, dtype=np.uint8, count=width * height * 3 // 2)
+    y_plane = frame[:width * height].reshape(height, width)
+    vu_plane = frame[width * height:].reshape(height // 2, width // 2, 2)
+    
+    if (out_width, out_height) == (width, height):
+        # 原尺寸：色度项在半分辨率上计算，再按2x2广播到亮度
+        y = y_plane.reshape(height // 2, 2, width // 2, 2)
+        vu = vu_plane[:, None, :, None]
+    else:
+        rows = np.arange(out_height) * height // out_height
+        cols = np.arange(out_width) * width // out_width
+        y = y_plane[rows[:, None], cols]
+        vu = vu_plane[(rows // 2)[:, None], cols // 2]
+    
+    y = y.astype(np.int16)
+    y <<= 6
+    y += 32  # 右移时四舍五入
+    vu = vu.astype(np.int16) - 128
+    v = vu[..., 0]
+    u = vu[..., 1]
+    
+    rgb = np.empty(y.shape + (3,), dtype=np.uint8)
+    # R = Y + 1.402V, G = Y - 0.344U - 0.714V, B = Y + 1.772U（系数乘以64）
+    for channel, chroma in enumerate((90 * v, -22 * u - 46 * v, 113 * u)):
+        value = y + chroma
+        np.clip(value, 0, 16383, out=value)
+        value >>= 6
+        rgb[..., channel] = value
+    return rgb.reshape(out_height, out_width, 3)
+
+def rgb_to_rgb565(rgb):
+    """RGB888 打包为小端序RGB565（与Android Bitmap.Config.RGB_565内存布局一致）"""
+    r = rgb[..., 0].astype(np.uint16)
+    g = rgb[..., 1].astype(np.uint16)
+    b = rgb[..., 2].astype(np.uint16)
+    return (((r >> 3) << 11) | ((g >> 2) << 5) | (b >> 3)).astype('<u2')
+
 class VideoStream:
-    def __init__(self, stream_id, device_id):
+    def __init__(self, stream_id, device_id, width=None, height=None, latency_budget=LATENCY_BUDGET,
+                 qos_class=QOS_DEFAULT_CLASS, weight=None,
+                 max_fps=STREAM_RATE_LIMIT_FPS, max_bytes_per_sec=STREAM_RATE_LIMIT_BYTES, processing='full',
+                 select_keyframes=False):
         self.stream_id = stream_id
         self.device_id = device_id
+        self.qos_class = qos_class
+        self.reserved_load = 0.0  # 准入时预留的槽位比例
+        self.weight = weight if weight is not None else QOS_CLASSES[qos_class]  # 处理调度权重
+        self.width = width  # 帧尺寸，未指定时按数据长度推断
+        self.height = height
         self.created_at = datetime.now()
         self.is_active = True
         self.chunk_queue = queue.Queue(maxsize=MAX_BUFFER_SIZE)
-        self.processed_queue = queue.Queue(maxsize=MAX_BUFFER_SIZE)
+        self.frame_ring = deque(maxlen=FRAME_RING_SIZE)  # 最近的处理帧，按序号递增
+        self.frame_condition = threading.Condition()
+        self.next_seq = 1
+        self.convert_lock = threading.Lock()
+        self.snapshot_lock = threading.Lock()
+        self.snapshot_seq = 0  # 缓存对应的帧序号，新帧到达后缓存失效
+        self.snapshot_cache = {}  # (宽, 格式) -> 编码后的图像
+        self.congestion = CongestionController()
+        self.latency = LatencyBudget(latency_budget, PROCESSING_TIERS.index(processing))
+        self.assembler = FrameAssembler(stream_id, max_frame_bytes(width, height))
+        self.keyframe = None  # 最近进入队列的非差分帧，delta帧以它为参考
+        self.rate_limiter = RateLimiter(max_fps, max_bytes_per_sec)
+        self.device_rate_limiter = device_rate_limiter(device_id)
+        self.static_detector = StaticFrameDetector(STATIC_FRAME_THRESHOLD)
+        self.keyframes = KeyframeSelector() if select_keyframes else None
         self.clients = set()
         
-    def add_chunk(self, chunk_data):
+    def check_rate(self, size, frames=1):
+        """按流和设备的令牌桶检查一次上传，允许时返回0，否则返回建议等待的秒数"""
+        wait = self.rate_limiter.allow(size, frames)
+        if wait > 0:
+            return wait
+        wait = self.device_rate_limiter.allow(size, frames)
+        if wait > 0:
+            self.rate_limiter.refund(size, frames)
+        return wait
+    
+    def add_chunk(self, chunk_data, trace=None):
         """添加视频数据块"""
         try:
             if not self.chunk_queue.full():
-                self.chunk_queue.put(chunk_data, block=False)
+                self.chunk_queue.put((chunk_data, trace, time.monotonic()), block=False)
+                self.congestion.record_upload(True)
                 return True
             else:
                 logger.warning(f"Stream {self.stream_id} buffer full, dropping chunk")
+                self.congestion.record_upload(False)
                 return False
         except queue.Full:
+            self.congestion.record_upload(False)
             return False
     
-    def get_processed_chunk(self, timeout=1.0):
-        """获取处理后的数据块"""
+    def publish_frame(self, processed_data, trace=None, source=None):
+        """把处理后的帧放入环形缓冲区（最旧的帧被覆盖），返回帧序号"""
+        with self.frame_condition:
+            frame = ProcessedFrame(self.next_seq, processed_data, trace, source=source)
+            self.next_seq += 1
+            self.frame_ring.append(frame)
+            self.frame_condition.notify_all()
+        return frame.seq
+    
+    def publish_repeat(self, trace=None):
+        """静态帧：沿用最新处理结果放入环形缓冲区，返回帧序号"""
+        with self.frame_condition:
+            base = self.frame_ring[-1]
+            frame = ProcessedFrame(self.next_seq, base.data, trace, base=base)
+            self.next_seq += 1
+            self.frame_ring.append(frame)
+            self.frame_condition.notify_all()
+        return frame.seq
+    
+    def get_frame(self, seq):
+        """按序号取仍在缓冲区中的帧"""
+        with self.frame_condition:
+            if not self.frame_ring:
+                return None
+            index = seq - self.frame_ring[0].seq
+            return self.frame_ring[index] if 0 <= index < len(self.frame_ring) else None
+    
+    @property
+    def latest_seq(self):
+        """最新帧序号，还没有帧时为0"""
+        return self.next_seq - 1
+    
+    def latest_frame(self):
+        """最新的处理帧，不阻塞"""
+        with self.frame_condition:
+            return self.frame_ring[-1] if self.frame_ring else None
+    
+    def frames_after(self, seq, limit=None):
+        """序号大于seq且仍在缓冲区中的帧（按序号升序），不阻塞、不移除"""
+        with self.frame_condition:
+            if not self.frame_ring:
+                return []
+            start = max(0, seq + 1 - self.frame_ring[0].seq)
+            stop = len(self.frame_ring) if limit is None else min(len(self.frame_ring), start + limit)
+            return list(itertools.islice(self.frame_ring, start, stop))
+    
+    def wait_frame_after(self, seq, timeout=1.0):
+        """等待序号大于seq的新帧，返回其中最新的一帧，超时返回None（供推送线程使用）"""
+        with self.frame_condition:
+            if self.latest_seq <= seq:
+                self.frame_condition.wait_for(lambda: self.latest_seq > seq or not self.is_active, timeout)
+            if self.latest_seq <= seq:
+                return None
+            return self.frame_ring[-1]
+    
+    def frame_size(self, frame_length):
+        """返回帧宽高，开始流时未指定（或设备已调整分辨率）则按数据长度推断"""
+        if self.width and self.height and self.width * self.height * 3 // 2 == frame_length:
+            return self.width, self.height
+        return infer_frame_size(frame_length)
+    
+    def processing_cost(self, encoded):
+        """处理调度按解码后的帧大小计费（处理的是像素而不是压缩数据）：已解码时取实际长度，
+        否则按开始流时声明的尺寸，都没有时退回上传的字节数"""
+        if encoded.decoded is not None:
+            return len(encoded.decoded)
+        if self.width and self.height:
+            return self.width * self.height * 3 // 2
+        return len(encoded.payload)
+    
+    def frame_pixels(self, frame):
+        """帧的NV21像素（不含时间戳头），直通的压缩帧在第一次访问时解码；无法解码时返回None"""
+        if frame.source is None:
+            return memoryview(frame.data)[FRAME_HEADER_SIZE:]
         try:
-            return self.processed_queue.get(timeout=timeout)
-        except queue.Empty:
+            return memoryview(frame.source.pixels())
+        except ValueError as e:
+            logger.warning(f"流 {self.stream_id} 第 {frame.seq} 帧解码失败: {e}")
             return None
     
+    def frame_output(self, frame, output_format):
+        """返回帧的指定像素格式数据，同一帧同一格式只转换一次；无法解码或无法识别帧尺寸时返回None"""
+        if output_format == 'nv21' and frame.source is None:
+            return frame.data
+        
+        output = frame.outputs.get(output_format)
+        if output is not None:
+            return output
+        
+        with self.convert_lock:
+            output = frame.outputs.get(output_format)
+            if output is None:
+                nv21 = self.frame_pixels(frame)
+                if nv21 is None:
+                    return None
+                if output_format == 'nv21':
+                    output = frame.outputs['nv21'] = bytes(frame.data[:FRAME_HEADER_SIZE]) + bytes(nv21)
+                    return output
+                size = self.frame_size(len(nv21))
+                if size is None:
+                    return None
+                rgb = nv21_to_rgb(nv21, *size)
+                pixels = rgb_to_rgb565(rgb) if output_format == 'rgb565' else rgb
+                output = frame.outputs[output_format] = bytes(frame.data[:FRAME_HEADER_SIZE]) + pixels.tobytes()
+            return output
+    
+    def frame_encoded(self, frame, codec):
+        """返回 (编码, 数据)：观看端接受该编码且帧是直通的压缩帧时原样返回（时间戳头加压缩数据，不解码），
+        否则返回解码后的NV21；无法解码时数据为None"""
+        if codec != 'raw' and frame.source is not None and frame.source.codec == codec:
+            return codec, frame.data
+        return 'raw', self.frame_output(frame, 'nv21')
+    
+    def encoded_frame_size(self, frame):
+        """原样转发的帧的宽高：已解码时按像素长度，否则按开始流时声明的尺寸，不为此解码"""
+        if frame.source.decoded is not None:
+            return self.frame_size(len(frame.source.decoded))
+        if self.width and self.height:
+            return self.width, self.height
+        return None
+    
+    def get_snapshot(self, frame, nv21, width, image_format):
+        """帧的缩略图，每帧每种尺寸只编码一次
+
+        frame和nv21由调用方取得并确认可以识别尺寸，期间到达的新帧不影响本次结果。
+        """
+        with self.snapshot_lock:
+            if self.snapshot_seq != frame.base_seq:
+                self.snapshot_seq = frame.base_seq
+                self.snapshot_cache = {}
+            
+            key = (width, image_format)
+            encoded = self.snapshot_cache.get(key)
+            if encoded is None:
+                frame_width, frame_height = self.frame_size(len(nv21))
+                out_width = min(width, frame_width)
+                out_height = max(2, frame_height * out_width // frame_width)
+                rgb = nv21_to_rgb(nv21, frame_width, frame_height, out_width, out_height)
+                
+                output = io.BytesIO()
+                pil_format = SNAPSHOT_FORMATS[image_format][0]
+                if pil_format == 'JPEG':
+                    Image.fromarray(rgb).save(output, pil_format, quality=SNAPSHOT_JPEG_QUALITY)
+                else:
+                    Image.fromarray(rgb).save(output, pil_format)
+                encoded = self.snapshot_cache[key] = output.getvalue()
+            return encoded
+    
     def add_client(self, client_id):
         """添加客户端"""
         self.clients.add(client_id)
@@ -72,6 +1436,9 @@ class VideoStream:
     def stop(self):
         """停止流"""
         self.is_active = False
+        self.assembler.clear()
+        with self.frame_condition:
+            self.frame_condition.notify_all()
 
 def simulate_video_processing(stream):
     """模拟实时视频处理"""
@@ -80,46 +1447,119 @@ def simulate_video_processing(stream):
     while stream.is_active:
         try:
             # 从输入队列获取数据
-            chunk_data = stream.chunk_queue.get(timeout=1.0)
-            
-            # 模拟处理延迟
-            time.sleep(0.05)  # 50ms处理延迟
-            
-            # 简单的视频处理：添加时间戳和滤镜效果
-            processed_data = process_video_chunk(chunk_data, stream.stream_id)
+            encoded, trace, enqueued_at = stream.chunk_queue.get(timeout=1.0)
+            frame_tracer.stage(trace, 'chunk_queue')
+            started = time.monotonic()
+            age = started - enqueued_at
             
-            # 将处理后的数据放入输出队列
-            if not stream.processed_queue.full():
-                stream.processed_queue.put(processed_data, block=False)
+            tier = stream.latency.tier
+            processed_tier = None  # 实际处理所用的档位，过期和静态帧为None
+            seq = processed_data = None
+            # 超过延迟预算的帧已没有观看价值，不再处理，让队列尽快追上最新帧
+            if stream.latency.is_expired(age):
+                frame_tracer.instant(trace, 'dropped', reason='deadline', age_ms=round(age * 1000, 1))
+                stream.congestion.record_processed(age)
+            # 画面基本没有变化时跳过处理，沿用上一帧的处理结果（直通档位不为检测而解码压缩帧）
+            elif ((encoded.codec == 'raw' or PROCESSING_TIERS[tier] != 'passthrough')
+                  and stream.static_detector.is_static(encoded.pixels(), stream.frame_size(len(encoded.pixels())))):
+                frame_tracer.stage(trace, 'static_skip')
+                stream.congestion.record_processed(age, time.monotonic() - started)
+                seq = stream.publish_repeat(trace)
+            else:
+                processed_tier = tier
+                # 按权重公平地等待处理槽位
+                processing_scheduler.acquire(stream.stream_id, stream.processing_cost(encoded))
+                frame_tracer.stage(trace, 'scheduler_wait')
+                source = None
+                try:
+                    if PROCESSING_TIERS[tier] == 'passthrough' and encoded.codec != 'raw':
+                        # 直通：只添加时间戳，压缩数据原样放入缓冲区，观看端需要像素时才解码
+                        processed_data = bytes(write_frame_header(encoded.payload))
+                        source = encoded
+                    else:
+                        if PROCESSING_TIERS[tier] == 'full':
+                            # 模拟处理延迟（可选的重处理阶段，过载时跳过）
+                            time.sleep(0.05)  # 50ms处理延迟
+                        
+                        # 简单的视频处理：添加时间戳和滤镜效果（passthrough档位只添加时间戳）
+                        processed_data = process_video_chunk(encoded.pixels(), stream.stream_id,
+                                                             enhance=PROCESSING_TIERS[tier] != 'passthrough')
+                finally:
+                    processing_scheduler.release(stream.stream_id)
+                frame_tracer.stage(trace, 'processing', tier=PROCESSING_TIERS[tier], codec=encoded.codec)
+                stream.congestion.record_processed(age, time.monotonic() - started)
+                
+                # 将处理后的数据放入环形缓冲区，观看端按序号读取
+                seq = stream.publish_frame(processed_data, trace, source)
                 
-                # 使用app上下文发送WebSocket消息
-                with app.app_context():
-                    socketio.emit('processed_data_ready', {
-                        'stream_id': stream.stream_id,
-                        'data_size': len(processed_data),
-                        'timestamp': datetime.now().isoformat()
-                    }, room=f'stream_{stream.stream_id}')
+                # 关键帧选择需要像素，直通档位（过载或只转发的流）跳过
+                if stream.keyframes is not None and source is None:
+                    pixels = encoded.pixels()
+                    keyframe = stream.keyframes.consider(pixels, stream.frame_size(len(pixels)), seq,
+                                                         encoded.payload if encoded.codec == 'zlib' else None)
+                    frame_tracer.stage(trace, 'keyframe', selected=keyframe is not None)
+            change_tier(stream, stream.latency.record(age, processed_tier))
+            
+            # 通知由发送线程合并后异步发出，处理线程不等待
+            if seq is not None and stream.clients:
+                notification_emitter.emit('processed_data_ready', {
+                    'stream_id': stream.stream_id,
+                    'seq': seq,
+                    'repeat': processed_data is None,
+                    'tier': PROCESSING_TIERS[tier],
+                    'data_size': len(processed_data) if processed_data is not None else 0,
+                    'timestamp': datetime.now().isoformat()
+                }, room=f'stream_{stream.stream_id}')
             
         except queue.Empty:
-            continue
+            pass
+        except ValueError as e:
+            # 压缩数据损坏：丢弃该帧，继续处理后续帧
+            logger.warning(f"流 {stream.stream_id} 丢弃无法解码的帧: {e}")
+            frame_tracer.instant(trace, 'dropped', reason='decode_error')
         except Exception as e:
             logger.error(f"处理流 {stream.stream_id} 时出错: {e}")
             break
+        
+        # 客户端中途停止发送的帧不会再有数据块触发清理，这里定期丢弃
+        stream.assembler.expire()
+        
+        # 定期评估拥塞，档位变化时通知设备（滞回由控制器保证）
+        adjustment = stream.congestion.evaluate(stream.chunk_queue.qsize())
+        if adjustment is not None:
+            logger.info(f"流 {stream.stream_id} 建议调整采集: {adjustment}")
+            notification_emitter.emit('adjust_capture', dict(adjustment, stream_id=stream.stream_id),
+                                      room=f'stream_{stream.stream_id}')
     
+    processing_scheduler.unregister(stream.stream_id)
     logger.info(f"流 {stream.stream_id} 处理结束")
 
-def process_video_chunk(chunk_data, stream_id):
-    """处理视频数据块"""
+def change_tier(stream, tier_name):
+    """处理档位变化时记录日志"""
+    if tier_name is not None:
+        stats = stream.latency.stats()
+        logger.info(f"流 {stream.stream_id} 处理档位调整为 {tier_name}"
+                    f"（排队延迟 {stats['lag_ms']}ms，预算 {stats['budget_ms']}ms）")
+
+def write_frame_header(chunk_data):
+    """在数据前添加8字节毫秒时间戳，返回可继续修改的bytearray"""
+    timestamp = int(time.time() * 1000).to_bytes(8, byteorder='big')
+    
+    # 创建新的bytearray，先添加时间戳，再添加原始数据
+    processed_data = bytearray(timestamp)
+    processed_data.extend(chunk_data)
+    return processed_data
+
+def process_video_chunk(chunk_data, stream_id, enhance=True):
+    """处理视频数据块，enhance为False时跳过滤镜只添加时间戳"""
     try:
         # 这里可以添加真正的视频处理逻辑
         # 例如：滤镜、特效、格式转换等
         
         # 模拟添加时间戳（在数据开头添加时间信息）
-        timestamp = int(time.time() * 1000).to_bytes(8, byteorder='big')
-        
-        # 创建新的bytearray，先添加时间戳，再添加原始数据
-        processed_data = bytearray(timestamp)
-        processed_data.extend(chunk_data)
+        processed_data = write_frame_header(chunk_data)
+        if not enhance:
+            return bytes(processed_data)
         
         # 轻量级的视频处理（减少计算量）
         video_data_start = 8  # 跳过时间戳
@@ -170,12 +1610,96 @@ def start_stream():
         data = request.get_json() or {}
         device_id = data.get('device_id', 'unknown')
         
-        # 生成流ID
-        stream_id = str(uuid.uuid4())
+        # 可选的帧尺寸（NV21要求宽高为偶数）
+        width = data.get('width')
+        height = data.get('height')
+        if width is not None or height is not None:
+            if not (isinstance(width, int) and isinstance(height, int)
+                    and width > 0 and height > 0 and width % 2 == 0 and height % 2 == 0):
+                return jsonify({
+                    'success': False,
+                    'message': 'width 和 height 必须是正偶数'
+                }), 400
+        
+        # 可选的延迟预算（毫秒），0表示不丢弃过期帧也不降级
+        latency_budget = data.get('latency_budget_ms')
+        if latency_budget is None:
+            latency_budget = LATENCY_BUDGET
+        elif isinstance(latency_budget, (int, float)) and not isinstance(latency_budget, bool) and latency_budget >= 0:
+            latency_budget = latency_budget / 1000
+        else:
+            return jsonify({
+                'success': False,
+                'message': 'latency_budget_ms 必须是非负数'
+            }), 400
+        
+        # 可选的上传速率限制（帧/秒、字节/秒），0表示不限制
+        rate_limits = {}
+        for key, default in (('max_fps', STREAM_RATE_LIMIT_FPS), ('max_bytes_per_sec', STREAM_RATE_LIMIT_BYTES)):
+            value = data.get(key, default)
+            if not (isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0):
+                return jsonify({
+                    'success': False,
+                    'message': f'{key} 必须是非负数'
+                }), 400
+            rate_limits[key] = value
         
-        # 创建新流
-        stream = VideoStream(stream_id, device_id)
-        active_streams[stream_id] = stream
+        # 处理档位：passthrough 的流只转发不处理，压缩上传的帧不在服务器解码
+        processing = data.get('processing', 'full')
+        if processing not in PROCESSING_TIERS:
+            return jsonify({
+                'success': False,
+                'message': f'processing 必须是 {", ".join(PROCESSING_TIERS)} 之一'
+            }), 400
+        
+        select_keyframes = data.get('keyframes', False)
+        if not isinstance(select_keyframes, bool):
+            return jsonify({
+                'success': False,
+                'message': 'keyframes 必须是布尔值'
+            }), 400
+        
+        # 处理调度：QoS等级或直接指定权重（权重优先）
+        qos_class = data.get('qos', QOS_DEFAULT_CLASS)
+        if qos_class not in QOS_CLASSES:
+            return jsonify({
+                'success': False,
+                'message': f'qos 必须是 {", ".join(QOS_CLASSES)} 之一'
+            }), 400
+        weight = data.get('weight')
+        if weight is not None and not (isinstance(weight, (int, float)) and not isinstance(weight, bool) and weight > 0):
+            return jsonify({
+                'success': False,
+                'message': 'weight 必须是正数'
+            }), 400
+        
+        # 准入控制：按声明的尺寸和默认采集帧率估计新流的负载
+        capture = CAPTURE_LADDER[CAPTURE_DEFAULT_LEVEL]
+        frame_bytes = (width or capture['width']) * (height or capture['height']) * 3 // 2
+        expected_load = processing_scheduler.estimate_load(frame_bytes, capture['fps'])
+        with admission_controller.lock:
+            admitted, current, projected = admission_controller.check(expected_load)
+            if not admitted:
+                logger.warning(f"拒绝新流（设备 {device_id}）: 当前负载 {current:.2f}，"
+                               f"预计 {projected:.2f}，目标 {admission_controller.target}")
+                return jsonify({
+                    'success': False,
+                    'message': '服务器处理能力已满，请稍后重试或连接其他节点',
+                    'utilization': round(current, 4),
+                    'projected_utilization': round(projected, 4),
+                    'retry_after': ADMISSION_RETRY_AFTER,
+                    'alternatives': PEER_NODES
+                }), 503, {'Retry-After': str(ADMISSION_RETRY_AFTER)}
+            
+            # 生成流ID
+            stream_id = str(uuid.uuid4())
+            
+            # 创建新流
+            stream = VideoStream(stream_id, device_id, width, height, latency_budget, qos_class, weight,
+                                 processing=processing, select_keyframes=select_keyframes, **rate_limits)
+            stream.reserved_load = expected_load
+            active_streams[stream_id] = stream
+            processing_scheduler.register(stream_id, stream.weight)
         
         # 启动处理线程
         processing_thread = threading.Thread(
@@ -190,6 +1714,9 @@ def start_stream():
         return jsonify({
             'success': True,
             'streamId': stream_id,
+            'chunk_size': CHUNK_SIZE,
+            'qos': stream.qos_class,
+            'weight': stream.weight,
             'message': '流开始成功',
             'websocket_url': f'/stream/{stream_id}'
         })
@@ -219,6 +1746,36 @@ def upload_chunk(stream_id):
                 'message': '流已停止'
             }), 400
         
+        # 在读取请求体之前按声明的长度检查速率限制，超限的上传不占用解析和队列
+        if request.content_length is None:
+            return jsonify({
+                'success': False,
+                'message': '缺少 Content-Length'
+            }), 411
+        
+        # 帧编码（分块上传时每个数据块都带同样的编码）
+        codec = request.headers.get('X-Frame-Codec', 'raw')
+        if codec not in FRAME_CODECS:
+            return jsonify({
+                'success': False,
+                'message': f'X-Frame-Codec 必须是 {", ".join(FRAME_CODECS)} 之一'
+            }), 400
+        if codec == 'delta' and np is None:
+            return jsonify({
+                'success': False,
+                'message': '差分帧需要安装 numpy'
+            }), 501
+        
+        # 带帧序号的分块上传
+        if 'X-Frame-Seq' in request.headers:
+            return upload_frame_part(stream, codec)
+        
+        retry_after = stream.check_rate(request.content_length)
+        if retry_after > 0:
+            return rate_limited_response(retry_after)
+        
+        trace = frame_tracer.start(stream_id, request.content_length)
+        
         # 获取数据块
         chunk_data = request.data
         
@@ -228,27 +1785,8 @@ def upload_chunk(stream_id):
                 'message': '数据块为空'
             }), 400
         
-        # 添加到流缓冲区
-        success = stream.add_chunk(chunk_data)
-        
-        if success:
-            # 通知WebSocket客户端有新数据
-            with app.app_context():
-                socketio.emit('new_chunk', {
-                    'stream_id': stream_id,
-                    'chunk_size': len(chunk_data),
-                    'timestamp': datetime.now().isoformat()
-                }, room=f'stream_{stream_id}')
-            
-            return jsonify({
-                'success': True,
-                'message': '数据块接收成功'
-            })
-        else:
-            return jsonify({
-                'success': False,
-                'message': '缓冲区已满'
-            }), 429
+        frame_tracer.stage(trace, 'upload')
+        return enqueue_uploaded_frame(stream, chunk_data, trace, codec)
         
     except Exception as e:
         logger.error(f"上传数据块失败: {e}")
@@ -257,6 +1795,128 @@ def upload_chunk(stream_id):
             'message': f'上传失败: {str(e)}'
         }), 500
 
+def rate_limited_response(retry_after):
+    return jsonify({
+        'success': False,
+        'message': '超过上传速率限制',
+        'retry_after': round(retry_after, 3)
+    }), 429, {'Retry-After': str(math.ceil(retry_after))}
+
+def enqueue_uploaded_frame(stream, frame_data, trace, codec='raw', **extra):
+    """把完整的一帧（不解码）放入处理队列并返回响应"""
+    if codec == 'delta':
+        if stream.keyframe is None:
+            frame_tracer.instant(trace, 'dropped', reason='missing_keyframe')
+            return jsonify({
+                'success': False,
+                'message': '差分帧缺少参考关键帧，请先发送 raw 或 zlib 帧'
+            }), 409
+        encoded = EncodedFrame(codec, frame_data, stream.keyframe)
+    else:
+        encoded = EncodedFrame(codec, frame_data)
+    
+    # 添加到流缓冲区
+    success = stream.add_chunk(encoded, trace)
+    
+    if success:
+        if codec != 'delta':
+            stream.keyframe = encoded
+        # 通知WebSocket客户端有新数据
+        if stream.clients:
+            notification_emitter.emit('new_chunk', {
+                'stream_id': stream.stream_id,
+                'chunk_size': len(frame_data),
+                'timestamp': datetime.now().isoformat()
+            }, room=f'stream_{stream.stream_id}')
+        
+        return jsonify({
+            'success': True,
+            'message': '数据块接收成功',
+            **extra
+        })
+    else:
+        frame_tracer.instant(trace, 'dropped', reason='chunk_queue_full')
+        return jsonify({
+            'success': False,
+            'message': '缓冲区已满',
+            'suggested_capture': stream.congestion.suggestion()
+        }), 429
+
+def upload_frame_part(stream, codec):
+    """分块上传：X-Frame-Seq 帧序号、X-Frame-Offset 本块在帧内的偏移、X-Frame-Length 帧总长度，
+    请求体直接读入该帧的预分配缓冲区，收齐后整帧进入处理队列"""
+    try:
+        seq = int(request.headers['X-Frame-Seq'])
+        offset = int(request.headers.get('X-Frame-Offset', '0'))
+        frame_length = int(request.headers['X-Frame-Length'])
+    except (KeyError, ValueError):
+        return jsonify({
+            'success': False,
+            'message': '分块上传需要整数的 X-Frame-Seq、X-Frame-Offset、X-Frame-Length'
+        }), 400
+    
+    length = request.content_length
+    if (seq < 0 or offset < 0 or length == 0 or frame_length <= 0
+            or offset + length > frame_length):
+        return jsonify({
+            'success': False,
+            'message': '数据块超出帧范围'
+        }), 400
+    if frame_length > stream.assembler.max_frame_bytes:
+        return jsonify({
+            'success': False,
+            'message': f'帧长度超过该流的上限 {stream.assembler.max_frame_bytes} 字节'
+        }), 413
+    
+    # 只有帧的第一个数据块计入帧速率
+    retry_after = stream.check_rate(length, frames=0 if stream.assembler.is_pending(seq) else 1)
+    if retry_after > 0:
+        return rate_limited_response(retry_after)
+    
+    try:
+        slot = stream.assembler.open_slot(seq, frame_length)
+    except ValueError as e:
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+    if slot is None:
+        return jsonify({
+            'success': False,
+            'message': f'帧 {seq} 已完成或已丢弃'
+        }), 409
+    
+    # 直接读入帧缓冲区，不经过中间的bytes对象
+    view = memoryview(slot.buffer)[offset:offset + length]
+    read = 0
+    while read < length:
+        count = request.stream.readinto(view[read:])
+        if not count:
+            break
+        read += count
+    if read < length:
+        return jsonify({
+            'success': False,
+            'message': '数据块不完整'
+        }), 400
+    
+    complete = stream.assembler.commit(slot, offset, length)
+    if complete is None:
+        return jsonify({
+            'success': False,
+            'message': f'帧 {seq} 组装超时已丢弃'
+        }), 409
+    if not complete:
+        return jsonify({
+            'success': True,
+            'message': '数据块接收成功',
+            'seq': seq,
+            'complete': False
+        })
+    
+    frame_tracer.stage(slot.trace, 'upload')
+    return enqueue_uploaded_frame(stream, slot.buffer, slot.trace, codec, seq=seq, complete=True)
+
 @app.route('/api/stream/<stream_id>')
 def get_stream(stream_id):
     """获取处理后的视频流"""
@@ -268,13 +1928,34 @@ def get_stream(stream_id):
             }), 404
         
         stream = active_streams[stream_id]
+        codec = parse_output_codec(request.args)
+        if codec is None:
+            return jsonify({
+                'success': False,
+                'message': f'不支持的编码，可选: {", ".join(("raw",) + FORWARD_CODECS)}'
+            }), 400
         
         def generate():
-            """生成流数据"""
+            """生成流数据（每个连接独立游标，慢连接跳到最新帧）"""
+            cursor = 0
+            sent_base = 0
             while stream.is_active:
-                chunk = stream.get_processed_chunk(timeout=2.0)
-                if chunk is not None:
-                    yield chunk
+                frame = stream.wait_frame_after(cursor, timeout=2.0)
+                if frame is not None:
+                    cursor = frame.seq
+                    if frame.base_seq == sent_base:
+                        # 静态帧与已发送的数据相同，原始字节流无需重复发送
+                        continue
+                    sent_base = frame.base_seq
+                    start = frame_tracer.span(frame.trace, 'frame_ring', frame.published_ns)
+                    if codec == 'raw':
+                        data = stream.frame_output(frame, 'nv21')
+                    else:
+                        data = write_codec_header(*stream.frame_encoded(frame, codec))
+                    if data is None:
+                        continue
+                    yield data
+                    frame_tracer.span(frame.trace, 'http_write', start)
                 else:
                     # 发送心跳数据
                     yield b''
@@ -296,6 +1977,187 @@ def get_stream(stream_id):
             'message': f'获取流失败: {str(e)}'
         }), 500
 
+@app.route('/api/stream/<stream_id>/snapshot')
+def get_snapshot(stream_id):
+    """获取最新处理帧的缩略图（JPEG/PNG），同一帧同一尺寸只编码一次"""
+    try:
+        if stream_id not in active_streams:
+            return jsonify({
+                'success': False,
+                'message': '流不存在'
+            }), 404
+        
+        if Image is None:
+            return jsonify({
+                'success': False,
+                'message': '服务器未安装 numpy/Pillow，无法生成缩略图'
+            }), 501
+        
+        image_format = request.args.get('format', 'jpeg').lower()
+        if image_format == 'jpg':
+            image_format = 'jpeg'
+        if image_format not in SNAPSHOT_FORMATS:
+            return jsonify({
+                'success': False,
+                'message': f'不支持的格式: {image_format}'
+            }), 400
+        
+        width = request.args.get('w', SNAPSHOT_DEFAULT_WIDTH, type=int)
+        width = max(SNAPSHOT_MIN_WIDTH, width - width % 2)
+        
+        stream = active_streams[stream_id]
+        frame = stream.latest_frame()
+        if frame is None:
+            return jsonify({
+                'success': False,
+                'message': '暂无处理后的帧'
+            }), 404
+        pixels = stream.frame_pixels(frame)
+        if pixels is None or stream.frame_size(len(pixels)) is None:
+            return jsonify({
+                'success': False,
+                'message': '无法识别帧尺寸，请在开始流时提供 width 和 height'
+            }), 422
+        
+        # 仍是同一帧时直接返回304，轮询的仪表盘不重复下载
+        etag = f'{stream_id}-{frame.base_seq}-{width}-{image_format}'
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            encoded = stream.get_snapshot(frame, pixels, width, image_format)
+            response = Response(encoded, mimetype=SNAPSHOT_FORMATS[image_format][1])
+            response.headers['X-Frame-Seq'] = str(frame.base_seq)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+        
+    except Exception as e:
+        logger.error(f"获取缩略图失败: {e}")
+        return jsonify({
+            'success': False,
+            'message': f'获取缩略图失败: {str(e)}'
+        }), 500
+
+def encode_keyframe(keyframe, image_format):
+    """按导出格式编码关键帧，nv21为原始像素"""
+    nv21 = keyframe.pixels()
+    if image_format == 'nv21':
+        return nv21
+    rgb = nv21_to_rgb(nv21, keyframe.width, keyframe.height)
+    output = io.BytesIO()
+    pil_format, _ = SNAPSHOT_FORMATS[image_format]
+    if pil_format == 'JPEG':
+        Image.fromarray(rgb).save(output, pil_format, quality=95)
+    else:
+        Image.fromarray(rgb).save(output, pil_format)
+    return output.getvalue()
+
+def parse_keyframe_format():
+    """返回 (格式, 错误响应)"""
+    image_format = request.args.get('format', 'jpeg').lower()
+    if image_format not in KEYFRAME_EXPORT_FORMATS:
+        return None, (jsonify({
+            'success': False,
+            'message': f'不支持的格式: {image_format}'
+        }), 400)
+    if image_format != 'nv21' and (np is None or Image is None):
+        return None, (jsonify({
+            'success': False,
+            'message': '导出图像需要安装 numpy 和 Pillow，或使用 format=nv21'
+        }), 501)
+    return image_format, None
+
+@app.route('/api/stream/<stream_id>/keyframes', methods=['GET'])
+def list_keyframes(stream_id):
+    """列出流的关键帧（流停止后仍可在一段时间内获取）"""
+    source = keyframe_source(stream_id)
+    if source is None or source[1] is None:
+        return jsonify({
+            'success': False,
+            'message': '流不存在或未开启关键帧选择'
+        }), 404
+    device_id, selector = source
+    return jsonify({
+        'success': True,
+        'stream_id': stream_id,
+        'device_id': device_id,
+        'keyframes': [dict(keyframe.describe(), url=f'/api/stream/{stream_id}/keyframes/{keyframe.index}')
+                      for keyframe in selector.snapshot()],
+        'stats': selector.stats(),
+        'export_url': f'/api/stream/{stream_id}/keyframes/export'
+    })
+
+@app.route('/api/stream/<stream_id>/keyframes/<int:index>', methods=['GET'])
+def get_keyframe(stream_id, index):
+    """获取单个关键帧图像（format=jpeg/png/nv21）"""
+    try:
+        image_format, error = parse_keyframe_format()
+        if error:
+            return error
+        source = keyframe_source(stream_id)
+        keyframe = source[1].get(index) if source is not None and source[1] is not None else None
+        if keyframe is None:
+            return jsonify({
+                'success': False,
+                'message': '关键帧不存在'
+            }), 404
+        mimetype = SNAPSHOT_FORMATS[image_format][1] if image_format != 'nv21' else 'application/octet-stream'
+        response = Response(encode_keyframe(keyframe, image_format), mimetype=mimetype)
+        response.headers['X-Frame-Width'] = str(keyframe.width)
+        response.headers['X-Frame-Height'] = str(keyframe.height)
+        return response
+    
+    except Exception as e:
+        logger.error(f"获取关键帧失败: {e}")
+        return jsonify({
+            'success': False,
+            'message': f'获取关键帧失败: {str(e)}'
+        }), 500
+
+@app.route('/api/stream/<stream_id>/keyframes/export', methods=['GET'])
+def export_keyframes(stream_id):
+    """把关键帧打包为zip（images/ 下的图像和 keyframes.json 元数据），可直接作为重建的输入"""
+    try:
+        image_format, error = parse_keyframe_format()
+        if error:
+            return error
+        source = keyframe_source(stream_id)
+        if source is None or source[1] is None:
+            return jsonify({
+                'success': False,
+                'message': '流不存在或未开启关键帧选择'
+            }), 404
+        device_id, selector = source
+        keyframes = selector.snapshot()
+        
+        output = io.BytesIO()
+        frames = []
+        extension = KEYFRAME_EXPORT_FORMATS[image_format]
+        # 图像本身已压缩，zip只存储
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as archive:
+            for keyframe in keyframes:
+                name = f'images/{keyframe.index:05d}.{extension}'
+                archive.writestr(name, encode_keyframe(keyframe, image_format))
+                frames.append(dict(keyframe.describe(), file=name))
+            archive.writestr('keyframes.json', json.dumps({
+                'stream_id': stream_id,
+                'device_id': device_id,
+                'format': image_format,
+                'stats': selector.stats(),
+                'frames': frames
+            }, ensure_ascii=False, indent=2))
+        
+        return Response(output.getvalue(), mimetype='application/zip', headers={
+            'Content-Disposition': f'attachment; filename=keyframes_{stream_id}.zip'
+        })
+    
+    except Exception as e:
+        logger.error(f"导出关键帧失败: {e}")
+        return jsonify({
+            'success': False,
+            'message': f'导出关键帧失败: {str(e)}'
+        }), 500
+
 @app.route('/api/stream/<stream_id>/stop', methods=['POST'])
 def stop_stream(stream_id):
     """停止视频流"""
@@ -309,15 +2171,16 @@ def stop_stream(stream_id):
         stream = active_streams[stream_id]
         stream.stop()
         
-        # 通知所有客户端流已停止
-        with app.app_context():
-            socketio.emit('stream_stopped', {
-                'stream_id': stream_id,
-                'timestamp': datetime.now().isoformat()
-            }, room=f'stream_{stream_id}')
+        # 通知所有客户端流已停止（与之前排队的通知保持顺序）
+        notification_emitter.emit('stream_stopped', {
+            'stream_id': stream_id,
+            'timestamp': datetime.now().isoformat()
+        }, room=f'stream_{stream_id}')
         
-        # 清理资源
+        # 清理资源，关键帧保留到被更新的流挤出，供停止后导出
         del active_streams[stream_id]
+        if stream.keyframes is not None and stream.keyframes.keyframes:
+            archive_keyframes(stream)
         
         logger.info(f"流停止: {stream_id}")
         
@@ -345,13 +2208,27 @@ def list_streams():
                 'is_active': stream.is_active,
                 'created_at': stream.created_at.isoformat(),
                 'clients_count': len(stream.clients),
-                'buffer_size': stream.chunk_queue.qsize()
+                'buffer_size': stream.chunk_queue.qsize(),
+                'latest_seq': stream.latest_seq,
+                'snapshot_url': f'/api/stream/{stream_id}/snapshot',
+                'congestion': stream.congestion.stats(),
+                'static_frames': stream.static_detector.static_frames,
+                'latency': stream.latency.stats(),
+                'keyframes': stream.keyframes.stats() if stream.keyframes is not None else None,
+                'qos': stream.qos_class,
+                'scheduling': processing_scheduler.stats(stream_id),
+                'reassembly': stream.assembler.stats(),
+                'rate_limit': stream.rate_limiter.stats(),
+                'device_rate_limit': stream.device_rate_limiter.stats()
             })
         
         return jsonify({
             'success': True,
             'streams': streams,
-            'total': len(streams)
+            'total': len(streams),
+            'notifications': notification_emitter.stats(),
+            'scheduler': processing_scheduler.stats(),
+            'admission': admission_controller.stats()
         })
         
     except Exception as e:
@@ -361,6 +2238,188 @@ def list_streams():
             'message': f'列出流失败: {str(e)}'
         }), 500
 
+@app.before_request
+def require_admin_token():
+    """管理接口（追踪、采样分析、内存快照）需要令牌；未配置令牌时关闭"""
+    if not request.path.startswith('/api/admin/'):
+        return None
+    if not ADMIN_TOKEN:
+        return jsonify({
+            'success': False,
+            'message': '管理接口未开启，请设置 STREAM_ADMIN_TOKEN'
+        }), 404
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+        return jsonify({
+            'success': False,
+            'message': '管理令牌无效'
+        }), 401
+    return None
+
+@app.route('/api/admin/trace', methods=['GET'])
+def export_trace():
+    """导出帧追踪事件（Chrome trace-event JSON）"""
+    stream_id = request.args.get('stream_id')
+    response = jsonify(frame_tracer.export(stream_id))
+    if request.args.get('download'):
+        response.headers['Content-Disposition'] = 'attachment; filename=stream_trace.json'
+    return response
+
+@app.route('/api/admin/trace', methods=['POST'])
+def configure_trace():
+    """调整采样率或清空追踪缓冲区"""
+    try:
+        data = request.get_json(silent=True) or {}
+        sample_rate = data.get('sample_rate')
+        if sample_rate is not None:
+            sample_rate = float(sample_rate)
+        frame_tracer.configure(sample_rate=sample_rate, clear=bool(data.get('clear')))
+        
+        return jsonify({
+            'success': True,
+            'sample_rate': frame_tracer.sample_rate,
+            'event_count': len(frame_tracer.events),
+            'buffer_capacity': frame_tracer.events.maxlen
+        })
+        
+    except (TypeError, ValueError):
+        return jsonify({
+            'success': False,
+            'message': 'sample_rate 必须是0到1之间的数字'
+        }), 400
+
+@app.route('/api/admin/profile', methods=['GET'])
+def run_profiler():
+    """对所有线程做N秒采样分析，返回折叠栈（flamegraph.pl / speedscope 可直接使用）"""
+    try:
+        seconds = float(request.args.get('seconds', PROFILE_DEFAULT_SECONDS))
+        interval = float(request.args.get('interval', PROFILE_DEFAULT_INTERVAL))
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'message': 'seconds 和 interval 必须是数字'
+        }), 400
+    
+    if not seconds > 0 or not 0.001 <= interval <= 1:
+        return jsonify({
+            'success': False,
+            'message': 'seconds 需大于0，interval 需在 [0.001, 1] 内'
+        }), 400
+    seconds = min(seconds, PROFILE_MAX_SECONDS)
+    
+    result = sampling_profiler.run(seconds, interval)
+    if result is None:
+        return jsonify({
+            'success': False,
+            'message': '已有采样分析正在运行'
+        }), 409
+    
+    counts, samples = result
+    lines = [f'{stack} {count}' for stack, count in sorted(counts.items(), key=lambda item: -item[1])]
+    return Response(
+        '\n'.join(lines) + '\n',
+        mimetype='text/plain',
+        headers={
+            'X-Profile-Samples': str(samples),
+            'X-Profile-Seconds': str(seconds),
+            'X-Profile-Interval': str(interval)
+        }
+    )
+
+@app.route('/api/admin/tracemalloc/start', methods=['POST'])
+def start_tracemalloc():
+    """开始跟踪内存分配"""
+    data = request.get_json(silent=True) or {}
+    try:
+        frames = int(data.get('frames', 1))
+    except (TypeError, ValueError):
+        frames = 0
+    if frames < 1:
+        return jsonify({
+            'success': False,
+            'message': 'frames 必须是正整数'
+        }), 400
+    
+    allocation_tracker.start(frames)
+    return jsonify({
+        'success': True,
+        'tracing': True,
+        'traceback_limit': tracemalloc.get_traceback_limit()
+    })
+
+@app.route('/api/admin/tracemalloc/stop', methods=['POST'])
+def stop_tracemalloc():
+    """停止跟踪并清空快照"""
+    allocation_tracker.stop()
+    return jsonify({
+        'success': True,
+        'tracing': False
+    })
+
+def parse_tracemalloc_args():
+    group_by = request.args.get('group_by', 'lineno')
+    if group_by not in AllocationTracker.GROUP_BY:
+        group_by = 'lineno'
+    limit = request.args.get('limit', 30, type=int)
+    return group_by, max(1, min(limit, 500))
+
+@app.route('/api/admin/tracemalloc/snapshot', methods=['GET'])
+def tracemalloc_snapshot():
+    """保存一份快照，返回快照ID和按分配位置统计的前N项"""
+    if not allocation_tracker.is_tracing:
+        return jsonify({
+            'success': False,
+            'message': '未开启内存跟踪，请先调用 /api/admin/tracemalloc/start'
+        }), 409
+    
+    group_by, limit = parse_tracemalloc_args()
+    snapshot_id, snapshot = allocation_tracker.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    
+    return jsonify({
+        'success': True,
+        'snapshot_id': snapshot_id,
+        'traced_bytes': current,
+        'peak_bytes': peak,
+        'group_by': group_by,
+        'top': allocation_tracker.top(snapshot, group_by, limit)
+    })
+
+@app.route('/api/admin/tracemalloc/diff', methods=['GET'])
+def tracemalloc_diff():
+    """比较两份快照（不指定target时与当前新快照比较）"""
+    if not allocation_tracker.is_tracing:
+        return jsonify({
+            'success': False,
+            'message': '未开启内存跟踪，请先调用 /api/admin/tracemalloc/start'
+        }), 409
+    
+    group_by, limit = parse_tracemalloc_args()
+    base = allocation_tracker.get(request.args.get('base', type=int))
+    if base is None:
+        return jsonify({
+            'success': False,
+            'message': '基准快照不存在'
+        }), 404
+    
+    target_id = request.args.get('target', type=int)
+    if target_id is None:
+        target_id, target = allocation_tracker.take_snapshot()
+    else:
+        target = allocation_tracker.get(target_id)
+        if target is None:
+            return jsonify({
+                'success': False,
+                'message': '目标快照不存在'
+            }), 404
+    
+    return jsonify({
+        'success': True,
+        'base': request.args.get('base', type=int),
+        'target': target_id,
+        'group_by': group_by,
+        'diff': allocation_tracker.diff(base, target, group_by, limit)
+    })
+
 # WebSocket事件处理
 @socketio.on('connect')
 def handle_connect():
@@ -395,6 +2454,7 @@ def handle_join_stream(data):
         
         emit('joined_stream', {
             'stream_id': stream_id,
+            'latest_seq': stream.latest_seq,
             'message': '成功加入流'
         })
         
@@ -428,9 +2488,81 @@ def handle_leave_stream(data):
         logger.error(f"离开流失败: {e}")
         emit('error', {'message': f'离开流失败: {str(e)}'})
 
+def parse_output_format(data):
+    """读取观看端请求的像素格式，无效时返回None"""
+    output_format = str(data.get('format', 'nv21')).lower()
+    return output_format if output_format in OUTPUT_FORMATS else None
+
+def parse_output_codec(data):
+    """读取观看端可接受的压缩编码（只对 nv21 格式有效），无效时返回None"""
+    codec = str(data.get('codec', 'raw')).lower()
+    if codec != 'raw' and (codec not in FORWARD_CODECS or data.get('format', 'nv21') != 'nv21'):
+        return None
+    return codec
+
+def write_codec_header(codec, data):
+    """HTTP流的压缩转发模式：每帧前加4字节编码名和4字节帧长度（大端），观看端据此拆分帧并按编码解压"""
+    if data is None:
+        return None
+    return codec.encode('ascii').ljust(4) + len(data).to_bytes(4, byteorder='big') + bytes(data)
+
+def processed_chunk_payload(stream, frame, client_sid, output_format='nv21', known_base=None, codec='raw'):
+    """构造 processed_chunk 事件数据，并记录帧在缓冲区等待和编码的耗时；无法转换格式时返回None。
+    观看端已有该帧内容（known_base 与帧的 base_seq 相同）时只发送重复标记；
+    观看端接受 codec 编码时直通的压缩帧原样发送（payload 的 codec 标明编码）"""
+    start = frame_tracer.span(frame.trace, 'frame_ring', frame.published_ns, client=client_sid)
+    if known_base is not None and frame.base_seq == known_base:
+        frame_tracer.span(frame.trace, 'repeat_marker', start, client=client_sid)
+        return {
+            'stream_id': stream.stream_id,
+            'seq': frame.seq,
+            'latest_seq': stream.latest_seq,
+            'repeat': True,
+            'repeat_of': frame.base_seq,
+            'format': output_format,
+            'timestamp': frame.timestamp
+        }
+    
+    if codec != 'raw':
+        codec, output = stream.frame_encoded(frame, codec)
+    else:
+        output = stream.frame_output(frame, output_format)
+    if output is None:
+        return None
+    if output_format != 'nv21':
+        start = frame_tracer.span(frame.trace, 'convert', start, client=client_sid, format=output_format)
+    # 将二进制数据编码为base64
+    chunk_b64 = base64.b64encode(output).decode('utf-8')
+    frame_tracer.span(frame.trace, 'encode', start, client=client_sid)
+    
+    payload = {
+        'stream_id': stream.stream_id,
+        'seq': frame.seq,
+        'latest_seq': stream.latest_seq,
+        'repeat': False,
+        'format': output_format,
+        'codec': codec,
+        'data': chunk_b64,
+        'size': len(output),
+        'timestamp': frame.timestamp
+    }
+    if codec != 'raw':
+        size = stream.encoded_frame_size(frame)
+    else:
+        size = stream.frame_size(len(stream.frame_pixels(frame)))
+    if size is not None:
+        payload['width'], payload['height'] = size
+    return payload
+
+def unknown_frame_size_error(stream_id):
+    return {
+        'stream_id': stream_id,
+        'message': '无法识别帧尺寸，无法转换像素格式，请在开始流时提供 width 和 height'
+    }
+
 @socketio.on('get_processed_chunk')
 def handle_get_processed_chunk(data):
-    """获取处理后的数据块"""
+    """获取处理后的数据块：不带after时立即返回最新帧，带after时返回该序号之后的帧，不阻塞"""
     try:
         stream_id = data.get('stream_id')
         
@@ -439,19 +2571,38 @@ def handle_get_processed_chunk(data):
             return
         
         stream = active_streams[stream_id]
-        chunk = stream.get_processed_chunk(timeout=0.1)
+        output_format = parse_output_format(data)
+        if output_format is None:
+            emit('error', {'message': f'不支持的像素格式，可选: {", ".join(OUTPUT_FORMATS)}'})
+            return
+        if output_format != 'nv21' and Image is None:
+            emit('error', {'message': '服务器未安装 numpy，无法转换像素格式'})
+            return
+        codec = parse_output_codec(data)
+        if codec is None:
+            emit('error', {'message': f'不支持的编码（只用于 nv21 格式），可选: {", ".join(("raw",) + FORWARD_CODECS)}'})
+            return
         
-        if chunk is not None:
-            # 将二进制数据编码为base64
-            chunk_b64 = base64.b64encode(chunk).decode('utf-8')
-            emit('processed_chunk', {
-                'stream_id': stream_id,
-                'data': chunk_b64,
-                'size': len(chunk),
-                'timestamp': datetime.now().isoformat()
-            })
+        after = data.get('after')
+        if after is None:
+            latest = stream.latest_frame()
+            frames = [latest] if latest is not None else []
         else:
-            emit('no_data', {'stream_id': stream_id})
+            limit = max(1, min(int(data.get('limit', FRAME_FETCH_LIMIT)), FRAME_FETCH_LIMIT))
+            frames = stream.frames_after(int(after), limit)
+        
+        # 观看端已持有after对应的帧，内容相同的静态帧只发送重复标记
+        known = stream.get_frame(int(after)) if after is not None else None
+        known_base = known.base_seq if known is not None else None
+        for frame in frames:
+            payload = processed_chunk_payload(stream, frame, request.sid, output_format, known_base, codec)
+            if payload is None:
+                emit('error', unknown_frame_size_error(stream_id))
+                return
+            known_base = frame.base_seq
+            emit('processed_chunk', payload)
+        if not frames:
+            emit('no_data', {'stream_id': stream_id, 'latest_seq': stream.latest_seq})
         
     except Exception as e:
         logger.error(f"获取处理数据失败: {e}")
@@ -469,28 +2620,45 @@ def handle_request_processed_stream(data):
         
         stream = active_streams[stream_id]
         client_sid = request.sid  # 保存客户端ID
+        output_format = parse_output_format(data)
+        if output_format is None:
+            emit('error', {'message': f'不支持的像素格式，可选: {", ".join(OUTPUT_FORMATS)}'})
+            return
+        if output_format != 'nv21' and Image is None:
+            emit('error', {'message': '服务器未安装 numpy，无法转换像素格式'})
+            return
+        codec = parse_output_codec(data)
+        if codec is None:
+            emit('error', {'message': f'不支持的编码（只用于 nv21 格式），可选: {", ".join(("raw",) + FORWARD_CODECS)}'})
+            return
         
-        # 启动一个线程持续发送处理后的数据
+        # 启动一个线程持续发送处理后的数据：首帧立即发送缓冲区中的最新帧，
+        # 之后每次发送游标之后的最新帧，不与其他观看端争抢
         def send_processed_stream():
+            cursor = max(0, stream.latest_seq - 1)
+            sent_base = None
             while stream.is_active and client_sid in stream.clients:
-                chunk = stream.get_processed_chunk(timeout=1.0)
-                if chunk is not None:
-                    chunk_b64 = base64.b64encode(chunk).decode('utf-8')
+                frame = stream.wait_frame_after(cursor, timeout=1.0)
+                if frame is not None:
+                    cursor = frame.seq
+                    payload = processed_chunk_payload(stream, frame, client_sid, output_format, sent_base, codec)
+                    sent_base = frame.base_seq
+                    if payload is None:
+                        with app.app_context():
+                            socketio.emit('error', unknown_frame_size_error(stream_id), room=client_sid)
+                        break
+                    start = time.perf_counter_ns()
                     with app.app_context():
-                        socketio.emit('processed_chunk', {
-                            'stream_id': stream_id,
-                            'data': chunk_b64,
-                            'size': len(chunk),
-                            'timestamp': datetime.now().isoformat()
-                        }, room=client_sid)
-                    time.sleep(0.2)  # 5 FPS，匹配帧捕获频率
+                        socketio.emit('processed_chunk', payload, room=client_sid)
+                    frame_tracer.span(frame.trace, 'emit', start, client=client_sid)
+                    time.sleep(STREAM_SEND_INTERVAL)
         
         import threading
         thread = threading.Thread(target=send_processed_stream)
         thread.daemon = True
         thread.start()
         
-        emit('processed_stream_started', {'stream_id': stream_id})
+        emit('processed_stream_started', {'stream_id': stream_id, 'format': output_format, 'codec': codec})
         
     except Exception as e:
         logger.error(f"启动处理数据流失败: {e}")
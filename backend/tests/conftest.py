@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import threading
+import time
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    """在临时目录中导入视频处理服务（uploads、processed和数据库都建在该目录下）"""
+    workdir = tmp_path_factory.mktemp('video-service')
+    os.environ['VIDEO_DB_PATH'] = str(workdir / 'videos.db')
+    os.chdir(workdir)
+    import app as app_module
+    # 测试直接调用recover_state，不在第一个请求前自动恢复
+    app_module.recovery_done = True
+    return app_module
+
+
+class FakeProcessing:
+    """代替8秒的模拟处理：直接复制文件，可在写出.partial后暂停"""
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.gate.set()
+        self.delay = 0
+
+    def __call__(self, video_id, input_path, output_path, job_output):
+        with open(input_path, 'rb') as src, open(output_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        job_output.advance(os.path.getsize(output_path))
+        time.sleep(self.delay)
+        self.gate.wait(10)
+
+
+@pytest.fixture
+def fake_processing(app_module, monkeypatch):
+    fake = FakeProcessing()
+    monkeypatch.setattr(app_module, 'simulate_video_processing', fake)
+    yield fake
+    fake.gate.set()
+    wait_until(lambda: not app_module.job_scheduler.stats()['running']
+               and not app_module.job_scheduler.stats()['pending'])
+
+
+def wait_until(predicate, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return predicate()
+
+
+@pytest.fixture(scope='session')
+def streaming_module():
+    import streaming_app
+    return streaming_app
+
+
+@pytest.fixture
+def make_stream(streaming_module):
+    """创建并登记一路流，测试结束后移除"""
+    created = []
+
+    def factory(**kwargs):
+        stream_id = f'test-stream-{len(created)}-{time.monotonic_ns()}'
+        stream = streaming_module.VideoStream(stream_id, kwargs.pop('device_id', stream_id), **kwargs)
+        streaming_module.active_streams[stream_id] = stream
+        created.append(stream)
+        return stream
+
+    yield factory
+    for stream in created:
+        stream.is_active = False
+        streaming_module.active_streams.pop(stream.stream_id, None)
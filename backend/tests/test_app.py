@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+"""视频上传处理服务的行为测试"""
+
+import io
+import os
+import time
+import uuid
+import hashlib
+import sqlite3
+import threading
+from wsgiref.util import FileWrapper
+
+from conftest import wait_until
+
+
+def make_record(app_module, content, status='uploaded'):
+    """按上传接口的方式保存内容并创建视频记录"""
+    digest = hashlib.sha256(content).hexdigest()
+    input_path = os.path.join(app_module.UPLOAD_FOLDER, f"{digest}.mp4")
+    with open(input_path, 'wb') as f:
+        f.write(content)
+    video_id = str(uuid.uuid4())
+    app_module.video_store.create({
+        'video_id': video_id,
+        'device_id': 'test-device',
+        'original_filename': 'clip.mp4',
+        'status': status,
+        'priority': 'normal',
+        'progress': 0,
+        'uploaded_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'input_path': input_path,
+        'output_path': os.path.join(app_module.PROCESSED_FOLDER, f"{video_id}.mp4"),
+        'digest': digest,
+        'expires_at': time.time() + 3600,
+        'last_accessed': time.time()
+    })
+    return video_id, digest
+
+
+def video_status(app_module, video_id):
+    return app_module.video_store.get(video_id)['status']
+
+
+def wait_finished(app_module, video_id):
+    assert wait_until(lambda: video_status(app_module, video_id) in ('completed', 'failed'))
+    return app_module.video_store.get(video_id)
+
+
+def test_recovery_keeps_partial_file_of_redispatched_job(app_module, fake_processing):
+    # 上次运行中断时留下的记录和.partial文件
+    content = os.urandom(64 * 1024)
+    video_id, digest = make_record(app_module, content, status='processing')
+    stale_partial = os.path.join(app_module.PROCESSED_FOLDER, f"{digest}.mp4.partial")
+    with open(stale_partial, 'wb') as f:
+        f.write(b'stale')
+    orphan = os.path.join(app_module.PROCESSED_FOLDER, 'orphan.tmp')
+    with open(orphan, 'wb') as f:
+        f.write(b'orphan')
+    
+    # 重新分派的任务写出.partial后暂停，孤立文件清理不能删除它
+    fake_processing.delay = 0.3
+    app_module.recover_state()
+    
+    record = wait_finished(app_module, video_id)
+    assert record['status'] == 'completed', record['error']
+    with open(record['output_path'], 'rb') as f:
+        assert f.read() == content
+    assert not os.path.exists(orphan)
+
+
+def test_oversize_result_is_delivered_but_not_cached(app_module, fake_processing, monkeypatch):
+    monkeypatch.setattr(app_module, 'PROCESSED_CACHE_MAX_BYTES', 500 * 1024)
+    content = os.urandom(700 * 1024)
+    client = app_module.app.test_client()
+    response = client.post('/api/upload/video', data={
+        'video': (io.BytesIO(content), 'clip.mp4'),
+        'device_id': 'test-device'
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200
+    video_id = response.get_json()['videoId']
+    
+    record = wait_finished(app_module, video_id)
+    assert record['status'] == 'completed', record['error']
+    with open(record['output_path'], 'rb') as f:
+        assert f.read() == content
+    digest = hashlib.sha256(content).hexdigest()
+    assert app_module.video_store.cache_get(digest) is None
+    assert not os.path.exists(app_module.cache_path_for(digest))
+
+
+def test_cache_eviction_keeps_newest_result(app_module, fake_processing, monkeypatch):
+    monkeypatch.setattr(app_module, 'PROCESSED_CACHE_MAX_BYTES', 300 * 1024)
+    first_id, first_digest = make_record(app_module, os.urandom(200 * 1024))
+    app_module.dispatch_video(app_module.video_store.get(first_id))
+    assert wait_finished(app_module, first_id)['status'] == 'completed'
+    assert app_module.video_store.cache_get(first_digest) is not None
+    
+    # 第二个结果放入后超出容量，淘汰较早的结果而不是刚放入的结果
+    second_id, second_digest = make_record(app_module, os.urandom(200 * 1024))
+    app_module.dispatch_video(app_module.video_store.get(second_id))
+    assert wait_finished(app_module, second_id)['status'] == 'completed'
+    assert app_module.video_store.cache_get(first_digest) is None
+    assert app_module.video_store.cache_get(second_digest) == app_module.cache_path_for(second_digest)
+    assert os.path.exists(app_module.cache_path_for(second_digest))
+    # 已完成视频的输出是硬链接，淘汰缓存后仍可下载
+    assert os.path.exists(app_module.video_store.get(first_id)['output_path'])
+
+
+def test_queue_bound_holds_under_concurrent_uploads(app_module, fake_processing, monkeypatch):
+    scheduler = app_module.job_scheduler
+    monkeypatch.setattr(scheduler, 'max_pending', 2)
+    fake_processing.gate.clear()  # 工作线程处理第一个任务时阻塞
+    
+    responses = []
+    start = threading.Barrier(12)
+    
+    def upload():
+        client = app_module.app.test_client()
+        start.wait()
+        responses.append(client.post('/api/upload/video', data={
+            'video': (io.BytesIO(os.urandom(32 * 1024)), 'clip.mp4'),
+            'device_id': 'test-device'
+        }, content_type='multipart/form-data'))
+    
+    threads = [threading.Thread(target=upload) for _ in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    accepted = [r for r in responses if r.status_code == 200]
+    rejected = [r for r in responses if r.status_code == 503]
+    assert len(accepted) + len(rejected) == 12
+    assert rejected and all(r.headers['Retry-After'] for r in rejected)
+    stats = scheduler.stats()
+    assert stats['pending'] <= 2
+    assert stats['reserved'] == 0
+    assert len(accepted) == stats['pending'] + stats['running']
+
+
+def test_failed_upload_releases_reserved_slot(app_module, fake_processing, monkeypatch):
+    scheduler = app_module.job_scheduler
+    monkeypatch.setattr(scheduler, 'max_pending', 1)
+    client = app_module.app.test_client()
+    
+    response = client.post('/api/upload/video', data={'device_id': 'test-device'},
+                           content_type='multipart/form-data')
+    assert response.status_code == 400
+    assert scheduler.stats()['reserved'] == 0
+    assert not scheduler.is_full()
+
+
+def put_range(client, upload_id, content, start, end):
+    return client.put(f'/api/upload/session/{upload_id}', data=content[start:end], headers={
+        'Content-Range': f'bytes {start}-{end - 1}/{len(content)}'})
+
+
+def test_upload_session_resumes_out_of_order_parts_and_hashes_content(app_module, fake_processing):
+    content = os.urandom(3 * 1024 * 1024 + 123)
+    client = app_module.app.test_client()
+    created = client.post('/api/upload/session', json={
+        'device_id': 'test-device', 'filename': 'clip.mp4', 'size': len(content)})
+    assert created.status_code == 200
+    upload_id = created.get_json()['uploadId']
+    middle = len(content) // 2
+    
+    # 先传后半段：区间乱序到达，摘要还不能计算
+    assert put_range(client, upload_id, content, middle, len(content)).status_code == 200
+    status = client.get(f'/api/upload/session/{upload_id}').get_json()
+    assert status['missingRanges'] == [[0, middle]]
+    assert client.post(f'/api/upload/session/{upload_id}/complete').status_code == 409
+    
+    # 服务重启后从数据库恢复会话，只补传缺失的区间
+    session = app_module.upload_sessions[upload_id]
+    restored = app_module.UploadSession.from_record(session.to_record())
+    app_module.upload_sessions[upload_id] = restored
+    assert restored.missing_ranges() == [[0, middle]]
+    assert put_range(client, upload_id, content, 0, middle).status_code == 200
+    
+    completed = client.post(f'/api/upload/session/{upload_id}/complete')
+    assert completed.status_code == 200
+    record = wait_finished(app_module, completed.get_json()['videoId'])
+    assert record['digest'] == hashlib.sha256(content).hexdigest()
+    with open(record['output_path'], 'rb') as f:
+        assert f.read() == content
+    assert not os.path.exists(session.part_path)
+    assert client.get(f'/api/upload/session/{upload_id}').status_code == 404
+
+
+def test_upload_session_rejects_mismatched_range(app_module):
+    client = app_module.app.test_client()
+    upload_id = client.post('/api/upload/session', json={
+        'device_id': 'test-device', 'filename': 'clip.mp4', 'size': 100}).get_json()['uploadId']
+    content = bytes(200)
+    assert put_range(client, upload_id, content, 50, 150).status_code == 416
+    assert client.put(f'/api/upload/session/{upload_id}', data=bytes(10),
+                      headers={'Content-Range': 'bytes 0-19/100'}).status_code == 400
+    assert client.delete(f'/api/upload/session/{upload_id}').status_code == 200
+
+
+def store_record(video_id, device_id, uploaded_at, status='completed'):
+    return {
+        'video_id': video_id,
+        'device_id': device_id,
+        'original_filename': 'clip.mp4',
+        'status': status,
+        'progress': 0,
+        'uploaded_at': uploaded_at,
+        'input_path': None,
+        'output_path': None
+    }
+
+
+def test_status_store_persists_batched_progress_and_pages_by_device(app_module, tmp_path):
+    path = str(tmp_path / 'status.db')
+    store = app_module.VideoStatusStore(path)
+    for i in range(5):
+        store.create(store_record(f'a{i}', 'device-a', f'2026-01-01T00:00:0{i}'))
+    store.create(store_record('b0', 'device-b', '2026-01-01T00:00:09', status='processing'))
+    
+    # 进度先缓存在内存，读取时已可见，批量写入后其它连接才能看到
+    store.set_progress('b0', 42.5)
+    assert store.get('b0')['progress'] == 42.5
+    store.flush_pending()
+    reopened = app_module.VideoStatusStore(path)
+    assert reopened.get('b0')['progress'] == 42.5
+    assert [r['video_id'] for r in reopened.list_unfinished()] == ['b0']
+    
+    first_page = reopened.list(device_id='device-a', limit=2)
+    assert [r['video_id'] for r in first_page] == ['a4', 'a3']
+    second_page = reopened.list(device_id='device-a', before=first_page[-1]['uploaded_at'], limit=2)
+    assert [r['video_id'] for r in second_page] == ['a2', 'a1']
+    
+    # 按设备分页使用索引而不是全表扫描
+    plan = reopened._connect().execute(
+        'EXPLAIN QUERY PLAN SELECT * FROM videos WHERE device_id = ? ORDER BY uploaded_at DESC LIMIT 2',
+        ('device-a',)).fetchall()
+    assert any('idx_videos_device' in row['detail'] for row in plan)
+
+
+def test_status_store_adds_missing_columns_to_old_database(app_module, tmp_path):
+    path = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE videos (video_id TEXT PRIMARY KEY, status TEXT NOT NULL, uploaded_at TEXT NOT NULL)')
+    conn.execute("INSERT INTO videos VALUES ('old', 'completed', '2025-12-31T00:00:00')")
+    conn.commit()
+    conn.close()
+    
+    store = app_module.VideoStatusStore(path)
+    record = store.get('old')
+    assert record['status'] == 'completed'
+    assert record['digest'] is None and record['priority'] == 'normal'
+
+
+def completed_video(app_module, content):
+    video_id, _ = make_record(app_module, content)
+    app_module.dispatch_video(app_module.video_store.get(video_id))
+    assert wait_finished(app_module, video_id)['status'] == 'completed'
+    return video_id
+
+
+def test_range_download_returns_exact_bytes_with_generic_file_wrapper(app_module, fake_processing):
+    content = os.urandom(256 * 1024)
+    video_id = completed_video(app_module, content)
+    # wsgiref的FileWrapper不理会Content-Length，一直读到文件末尾
+    client = app_module.app.test_client()
+    client.environ_base['wsgi.file_wrapper'] = FileWrapper
+    
+    start, end = 1000, 70999
+    partial = client.get(f'/api/video/{video_id}', headers={'Range': f'bytes={start}-{end}'})
+    assert partial.status_code == 206
+    assert len(partial.data) == end - start + 1
+    assert partial.data == content[start:end + 1]
+    assert partial.headers['Content-Range'] == f'bytes {start}-{end}/{len(content)}'
+    
+    suffix = client.get(f'/api/video/{video_id}', headers={'Range': 'bytes=-100'})
+    assert suffix.status_code == 206 and suffix.data == content[-100:]
+    
+    full = client.get(f'/api/video/{video_id}')
+    assert full.status_code == 200 and full.data == content
+    
+    etag = full.headers['ETag']
+    assert client.get(f'/api/video/{video_id}', headers={'If-None-Match': etag}).status_code == 304
+    unsatisfiable = client.get(f'/api/video/{video_id}', headers={'Range': f'bytes={len(content)}-'})
+    assert unsatisfiable.status_code == 416
+
+
+def test_expiry_heap_deletes_due_videos_in_order(app_module, fake_processing):
+    service = app_module.ExpiryService(0)
+    now = time.time()
+    done = [completed_video(app_module, os.urandom(1024)) for _ in range(3)]
+    running, _ = make_record(app_module, os.urandom(1024), status='processing')
+    extended = completed_video(app_module, os.urandom(1024))
+    for offset, video_id in zip((-1, -3, -2), done):
+        app_module.video_store.update(video_id, expires_at=now + offset)
+        service.schedule(video_id, now + offset)
+    service.schedule(running, now - 4)
+    service.schedule(extended, now - 5)  # 过期时间已延长到一小时后，堆中留下的是旧条目
+    later, _ = make_record(app_module, os.urandom(1024))
+    service.schedule(later, now + 3600)
+    
+    due = service._pop_due()
+    assert due == [extended, running, done[1], done[2], done[0]]
+    assert service.stats()['scheduled'] == 1
+    
+    outputs = [app_module.video_store.get(video_id)['output_path'] for video_id in done]
+    service._expire(due)
+    assert all(app_module.video_store.get(video_id) is None for video_id in done)
+    assert not any(os.path.exists(path) for path in outputs)
+    assert service.stats()['expired'] == 3
+    # 仍在处理的视频延后，过期时间已延长的视频保留
+    assert app_module.video_store.get(running) is not None
+    assert service.stats()['scheduled'] == 2
+    assert app_module.video_store.get(extended)['status'] == 'completed'
+    app_module.video_store.update(running, status='failed')
+
+
+def test_quota_evicts_least_recently_used_video(app_module, fake_processing):
+    service = app_module.ExpiryService(0)
+    service._evict_unshared_cache()
+    victim = completed_video(app_module, os.urandom(1024 * 1024))
+    recent = completed_video(app_module, os.urandom(1024 * 1024))
+    app_module.video_store.update(victim, last_accessed=0)
+    app_module.video_store.update(recent, last_accessed=time.time() + 3600)
+    lru = app_module.video_store.list_least_recently_used(1000)
+    assert lru[0]['video_id'] == victim and lru[-1]['video_id'] == recent
+    
+    service.quota_bytes = app_module.storage_usage() - 512 * 1024
+    service._enforce_quota()
+    assert app_module.video_store.get(victim) is None
+    assert service.stats()['usage_bytes'] <= service.quota_bytes
+    assert service.stats()['evicted'] >= 1
+
+
+def test_progressive_download_streams_output_while_processing(app_module, fake_processing, monkeypatch):
+    content = os.urandom(200 * 1024)
+    half = len(content) // 2
+    gate = threading.Event()
+    
+    def process_in_two_halves(video_id, input_path, output_path, job_output):
+        with open(input_path, 'rb') as src, open(output_path, 'wb') as dst:
+            dst.write(src.read(half))
+            dst.flush()
+            job_output.advance(half)
+            gate.wait(10)
+            dst.write(src.read())
+            dst.flush()
+            job_output.advance(len(content))
+    
+    monkeypatch.setattr(app_module, 'simulate_video_processing', process_in_two_halves)
+    video_id, _ = make_record(app_module, content)
+    app_module.dispatch_video(app_module.video_store.get(video_id))
+    assert wait_until(lambda: app_module.job_outputs.get(video_id) is not None
+                      and app_module.job_outputs[video_id].written == half)
+    
+    response = app_module.app.test_client().get(f'/api/video/{video_id}', buffered=False)
+    assert response.status_code == 200
+    assert response.headers['X-Processing-Status'] == 'processing'
+    assert 'Content-Length' not in response.headers
+    body = response.iter_encoded()
+    received = b''
+    while len(received) < half:
+        received += next(body)
+    assert received == content[:half]  # 后半段还没有处理
+    
+    gate.set()
+    received += b''.join(body)
+    response.close()
+    assert received == content
+    assert wait_finished(app_module, video_id)['status'] == 'completed'
+
+
+def test_long_poll_status_wakes_on_change_and_times_out_without_one(app_module):
+    video_id, _ = make_record(app_module, os.urandom(1024))
+    client = app_module.app.test_client()
+    
+    started = time.time()
+    unchanged = client.get(f'/api/video/{video_id}/status?wait=0.3').get_json()
+    assert unchanged['status'] == 'uploaded'
+    assert time.time() - started >= 0.3
+    
+    def change_status():
+        time.sleep(0.2)
+        app_module.video_store.update(video_id, status='processing', progress=30)
+        app_module.notify_status(video_id)
+    
+    threading.Thread(target=change_status).start()
+    started = time.time()
+    changed = client.get(f'/api/video/{video_id}/status?wait=10').get_json()
+    assert changed['status'] == 'processing' and changed['progress'] == 30
+    assert time.time() - started < 5
+    assert not app_module.status_notifier.channels  # 等待结束后释放通知通道
+    app_module.video_store.update(video_id, status='failed')
+
+
+def test_sse_pushes_progress_and_completion_events(app_module):
+    video_id, _ = make_record(app_module, os.urandom(1024))
+    response = app_module.app.test_client().get(f'/api/video/{video_id}/events', buffered=False)
+    assert response.mimetype == 'text/event-stream'
+    events = response.iter_encoded()
+    assert next(events).startswith(b'event: progress\n')
+    
+    def next_event():
+        while True:
+            event = next(events)
+            if not event.startswith(b':'):
+                return event
+    
+    app_module.video_store.update(video_id, status='processing', progress=50)
+    app_module.notify_status(video_id)
+    assert b'"progress": 50' in next_event()
+    
+    app_module.video_store.update(video_id, status='completed', progress=100)
+    app_module.notify_status(video_id)
+    assert next_event().startswith(b'event: completed\n')
+    assert list(events) == []  # 完成后结束事件流
+    response.close()
@@ -0,0 +1,709 @@
+# -*- coding: utf-8 -*-
+"""实时流服务的行为测试"""
+
+import threading
+import time
+import zlib
+
+import pytest
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+WIDTH, HEIGHT = 64, 48
+FRAME_BYTES = WIDTH * HEIGHT * 3 // 2
+
+
+def nv21_frame(value=128):
+    return bytes([value]) * FRAME_BYTES
+
+
+def test_snapshot_uses_validated_frame_when_newer_frame_arrives(streaming_module, make_stream, monkeypatch):
+    if streaming_module.Image is None:
+        pytest.skip('需要numpy/Pillow')
+    stream = make_stream(width=WIDTH, height=HEIGHT)
+    header = bytes(streaming_module.FRAME_HEADER_SIZE)
+    good_seq = stream.publish_frame(header + nv21_frame())
+    
+    # 校验完最新帧后到达一帧无法解码的压缩帧
+    frame_pixels = stream.frame_pixels
+    
+    def pixels_then_publish_corrupt(frame):
+        pixels = frame_pixels(frame)
+        if stream.latest_seq == good_seq:
+            corrupt = streaming_module.EncodedFrame('zlib', b'not zlib data')
+            stream.publish_frame(header + corrupt.payload, source=corrupt)
+        return pixels
+    
+    monkeypatch.setattr(stream, 'frame_pixels', pixels_then_publish_corrupt)
+    client = streaming_module.app.test_client()
+    response = client.get(f'/api/stream/{stream.stream_id}/snapshot?format=png')
+    assert response.status_code == 200
+    assert response.headers['X-Frame-Seq'] == str(good_seq)
+    assert response.data.startswith(b'\x89PNG')
+
+
+def run_backlogged(scheduler, costs, duration=0.6, hold=0.002):
+    """每路流不停请求槽位（每次占用hold秒），模拟处理积压"""
+    stop = threading.Event()
+    
+    def flow(stream_id, cost):
+        while not stop.is_set():
+            scheduler.acquire(stream_id, cost)
+            time.sleep(hold)
+            scheduler.release(stream_id)
+    
+    threads = [threading.Thread(target=flow, args=item) for item in costs.items()]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+
+def test_fair_scheduler_shares_follow_weights(streaming_module):
+    scheduler = streaming_module.FairScheduler(1)
+    scheduler.register('heavy', 3)
+    scheduler.register('light', 1)
+    run_backlogged(scheduler, {'heavy': FRAME_BYTES, 'light': FRAME_BYTES})
+    
+    heavy, light = scheduler.stats('heavy'), scheduler.stats('light')
+    assert heavy['fair_share'] == 0.75 and light['fair_share'] == 0.25
+    assert heavy['share'] == pytest.approx(0.75, abs=0.08)
+    assert heavy['share'] + light['share'] == pytest.approx(1.0)
+    assert heavy['served_frames'] == pytest.approx(3 * light['served_frames'], rel=0.3)
+
+
+def test_fair_scheduler_shares_bytes_not_frames(streaming_module):
+    # 权重相同时按字节公平：帧大一倍的流获得的帧数约为一半
+    scheduler = streaming_module.FairScheduler(1)
+    scheduler.register('large', 1)
+    scheduler.register('small', 1)
+    run_backlogged(scheduler, {'large': 2 * FRAME_BYTES, 'small': FRAME_BYTES})
+    
+    large, small = scheduler.stats('large'), scheduler.stats('small')
+    assert large['share'] == pytest.approx(0.5, abs=0.08)
+    assert small['served_frames'] == pytest.approx(2 * large['served_frames'], rel=0.3)
+    assert scheduler.stats()['busy'] == 0
+
+
+def test_admission_rejects_stream_beyond_target_utilization(streaming_module, monkeypatch):
+    capture = streaming_module.CAPTURE_LADDER[streaming_module.CAPTURE_DEFAULT_LEVEL]
+    stream_load = streaming_module.processing_scheduler.estimate_load(FRAME_BYTES, capture['fps'])
+    # 目标利用率只够一路流
+    monkeypatch.setattr(streaming_module.admission_controller, 'target', 1.5 * stream_load)
+    client = streaming_module.app.test_client()
+    request = {'device_id': 'admission-test', 'width': WIDTH, 'height': HEIGHT}
+    
+    first = client.post('/api/stream/start', json=request)
+    assert first.status_code == 200
+    first_id = first.get_json()['streamId']
+    try:
+        rejected = client.post('/api/stream/start', json=request)
+        assert rejected.status_code == 503
+        assert rejected.headers['Retry-After'] == str(streaming_module.ADMISSION_RETRY_AFTER)
+        body = rejected.get_json()
+        assert body['success'] is False
+        assert body['projected_utilization'] > 1.5 * stream_load - 1e-4
+    finally:
+        assert client.post(f'/api/stream/{first_id}/stop').status_code == 200
+    
+    # 停止的流释放负载后可以重新准入
+    second = client.post('/api/stream/start', json=request)
+    assert second.status_code == 200
+    client.post(f"/api/stream/{second.get_json()['streamId']}/stop")
+
+
+def post_frame(client, stream, data=None):
+    return client.post(f'/api/stream/{stream.stream_id}/chunk', data=data or nv21_frame(),
+                       headers={'Content-Type': 'application/octet-stream'})
+
+
+def test_stream_rate_limit_returns_429_once_bucket_is_empty(streaming_module, make_stream):
+    stream = make_stream(width=WIDTH, height=HEIGHT, max_fps=4, max_bytes_per_sec=0)
+    client = streaming_module.app.test_client()
+    burst = int(4 * streaming_module.RATE_LIMIT_BURST)
+    
+    statuses = [post_frame(client, stream).status_code for _ in range(burst)]
+    assert statuses == [200] * burst
+    limited = post_frame(client, stream)
+    assert limited.status_code == 429
+    assert int(limited.headers['Retry-After']) >= 1
+    assert 0 < limited.get_json()['retry_after'] <= 0.25
+    # 被拒绝的帧不进入处理队列
+    assert stream.chunk_queue.qsize() == burst
+    
+    time.sleep(0.3)  # 补充一帧的令牌
+    assert post_frame(client, stream).status_code == 200
+
+
+def test_device_rate_limit_spans_streams_and_refunds_stream_tokens(streaming_module, make_stream, monkeypatch):
+    device_id = f'rate-limit-device-{time.monotonic_ns()}'
+    monkeypatch.setitem(streaming_module.device_rate_limiters, device_id,
+                        streaming_module.RateLimiter(0, 2 * FRAME_BYTES / streaming_module.RATE_LIMIT_BURST))
+    streams = [make_stream(device_id=device_id, width=WIDTH, height=HEIGHT, max_fps=10, max_bytes_per_sec=0)
+               for _ in range(2)]
+    client = streaming_module.app.test_client()
+    
+    assert post_frame(client, streams[0]).status_code == 200
+    assert post_frame(client, streams[1]).status_code == 200
+    # 每路流都还有额度，但设备合计的字节配额已用完
+    tokens_before = streams[0].rate_limiter.frame_tokens
+    limited = post_frame(client, streams[0])
+    assert limited.status_code == 429
+    assert 'Retry-After' in limited.headers
+    assert streams[0].rate_limiter.frame_tokens == pytest.approx(tokens_before, abs=0.1)
+    assert streaming_module.device_rate_limiters[device_id].stats()['rejected'] == 1
+
+
+def gradient_frame(offset=0):
+    """可压缩、逐帧变化的NV21帧"""
+    return bytes((i + offset) % 251 for i in range(FRAME_BYTES))
+
+
+def delta_payload(frame, keyframe):
+    diff = (np.frombuffer(frame, dtype=np.uint8) - np.frombuffer(keyframe, dtype=np.uint8)).tobytes()
+    return zlib.compress(diff)
+
+
+def test_zlib_and_delta_frames_decode_lazily(streaming_module):
+    if streaming_module.np is None:
+        pytest.skip('需要numpy')
+    keyframe_pixels, frame_pixels = gradient_frame(), gradient_frame(37)
+    keyframe = streaming_module.EncodedFrame('zlib', zlib.compress(keyframe_pixels))
+    delta = streaming_module.EncodedFrame('delta', delta_payload(frame_pixels, keyframe_pixels), keyframe)
+    assert keyframe.decoded is None and delta.decoded is None
+    
+    assert delta.pixels() == frame_pixels  # 差分帧解码时连带解码参考帧
+    assert keyframe.decoded == keyframe_pixels
+    assert delta.pixels() is delta.pixels()  # 解码结果缓存
+
+
+@pytest.mark.parametrize('codec, payload', [
+    ('zlib', b'not zlib data'),
+    ('zlib', zlib.compress(bytes(FRAME_BYTES))[:-8]),  # 截断
+    ('delta', zlib.compress(bytes(FRAME_BYTES // 2))),  # 与参考帧长度不一致
+])
+def test_corrupt_compressed_frames_raise_value_error(streaming_module, codec, payload):
+    if streaming_module.np is None:
+        pytest.skip('需要numpy')
+    reference = streaming_module.EncodedFrame('raw', bytes(FRAME_BYTES))
+    encoded = streaming_module.EncodedFrame(codec, payload, reference if codec == 'delta' else None)
+    with pytest.raises(ValueError):
+        encoded.pixels()
+
+
+def test_uploaded_delta_frame_references_previous_keyframe(streaming_module, make_stream):
+    if streaming_module.np is None:
+        pytest.skip('需要numpy')
+    stream = make_stream(width=WIDTH, height=HEIGHT, max_fps=0, max_bytes_per_sec=0)
+    client = streaming_module.app.test_client()
+    
+    def upload(codec, payload):
+        return client.post(f'/api/stream/{stream.stream_id}/chunk', data=payload, headers={
+            'Content-Type': 'application/octet-stream', 'X-Frame-Codec': codec})
+    
+    keyframe_pixels, frame_pixels = gradient_frame(), gradient_frame(90)
+    assert upload('delta', delta_payload(frame_pixels, keyframe_pixels)).status_code == 409
+    assert upload('zlib', zlib.compress(keyframe_pixels)).status_code == 200
+    assert upload('delta', delta_payload(frame_pixels, keyframe_pixels)).status_code == 200
+    
+    decoded = [stream.chunk_queue.get_nowait()[0].pixels() for _ in range(2)]
+    assert decoded == [keyframe_pixels, frame_pixels]
+
+
+def test_compressed_frames_are_charged_by_decoded_size(streaming_module):
+    client = streaming_module.app.test_client()
+    response = client.post('/api/stream/start', json={
+        'device_id': 'cost-test', 'width': WIDTH, 'height': HEIGHT, 'keyframes': False})
+    stream_id = response.get_json()['streamId']
+    try:
+        payload = zlib.compress(gradient_frame())
+        assert len(payload) < FRAME_BYTES // 2
+        assert client.post(f'/api/stream/{stream_id}/chunk', data=payload, headers={
+            'Content-Type': 'application/octet-stream', 'X-Frame-Codec': 'zlib'}).status_code == 200
+        stream = streaming_module.active_streams[stream_id]
+        deadline = time.time() + 5
+        while stream.latest_seq < 1 and time.time() < deadline:
+            time.sleep(0.02)
+        # 按解码后的帧大小计费，和上传raw帧时相同
+        assert streaming_module.processing_scheduler.stats(stream_id)['served_bytes'] == FRAME_BYTES
+        # 未解码的压缩帧按声明的尺寸计费
+        assert stream.processing_cost(streaming_module.EncodedFrame('zlib', payload)) == FRAME_BYTES
+    finally:
+        client.post(f'/api/stream/{stream_id}/stop')
+
+
+def test_frame_tracer_samples_and_bounds_events(streaming_module):
+    tracer = streaming_module.FrameTracer(0, 4)
+    assert tracer.start('s', 100) is None  # 采样率为0时不追踪
+    
+    tracer.configure(sample_rate=1)
+    trace = tracer.start('s', 100)
+    time.sleep(0.01)
+    tracer.stage(trace, 'upload')
+    tracer.instant(trace, 'dropped', reason='deadline')
+    exported = tracer.export()
+    upload = next(e for e in exported['traceEvents'] if e['name'] == 'upload')
+    assert upload['ph'] == 'X' and upload['dur'] >= 10000  # 微秒
+    assert upload['args'] == {'frame': trace.trace_id, 'size': 100}
+    assert {'name': 'process_name', 'ph': 'M', 'pid': upload['pid'], 'args': {'name': 'stream s'}} \
+        in exported['traceEvents']
+    
+    for _ in range(5):
+        tracer.stage(tracer.start('other', 10), 'upload')
+    assert len(tracer.events) == 4  # 有界缓冲区只保留最新的事件
+    assert tracer.export('s')['otherData']['event_count'] == 0
+    assert tracer.export('other')['otherData']['event_count'] == 4
+
+
+def test_processed_frame_records_pipeline_stages(streaming_module, monkeypatch):
+    monkeypatch.setattr(streaming_module.frame_tracer, 'sample_rate', 1.0)
+    client = streaming_module.app.test_client()
+    stream_id = client.post('/api/stream/start', json={
+        'device_id': 'trace-test', 'width': WIDTH, 'height': HEIGHT}).get_json()['streamId']
+    try:
+        assert client.post(f'/api/stream/{stream_id}/chunk', data=gradient_frame(),
+                           headers={'Content-Type': 'application/octet-stream'}).status_code == 200
+        stream = streaming_module.active_streams[stream_id]
+        deadline = time.time() + 5
+        while stream.latest_seq < 1 and time.time() < deadline:
+            time.sleep(0.02)
+        names = [e['name'] for e in streaming_module.frame_tracer.export(stream_id)['traceEvents']
+                 if e['ph'] == 'X']
+        assert names[:4] == ['upload', 'chunk_queue', 'scheduler_wait', 'processing']
+    finally:
+        client.post(f'/api/stream/{stream_id}/stop')
+
+
+def test_admin_endpoints_are_disabled_without_token(streaming_module, monkeypatch):
+    monkeypatch.setattr(streaming_module, 'ADMIN_TOKEN', '')
+    client = streaming_module.app.test_client()
+    assert client.get('/api/admin/trace').status_code == 404
+    assert client.post('/api/admin/tracemalloc/start', json={}).status_code == 404
+    assert not streaming_module.allocation_tracker.is_tracing
+
+
+def test_admin_endpoints_require_token_and_clamp_profile(streaming_module, monkeypatch):
+    monkeypatch.setattr(streaming_module, 'ADMIN_TOKEN', 'secret')
+    monkeypatch.setattr(streaming_module, 'PROFILE_MAX_SECONDS', 0.2)
+    client = streaming_module.app.test_client()
+    assert client.get('/api/admin/trace').status_code == 401
+    assert client.get('/api/admin/trace', headers={'X-Admin-Token': 'wrong'}).status_code == 401
+    assert client.get('/api/admin/trace', headers={'X-Admin-Token': 'secret'}).status_code == 200
+    # 其它接口不受影响
+    assert client.get('/api/streams').status_code == 200
+    
+    started = time.time()
+    profile = client.get('/api/admin/profile?seconds=60', headers={'X-Admin-Token': 'secret'})
+    assert profile.status_code == 200
+    assert float(profile.headers['X-Profile-Seconds']) == 0.2
+    assert time.time() - started < 2
+
+
+def test_notification_emitter_coalesces_per_room_off_thread(streaming_module, monkeypatch):
+    sent = []
+    release = threading.Event()
+    
+    def slow_emit(event, data, room=None):
+        release.wait(5)  # 发送阻塞时emit调用方不受影响
+        sent.append((event, data, room, threading.current_thread().name))
+    
+    monkeypatch.setattr(streaming_module.socketio, 'emit', slow_emit)
+    emitter = streaming_module.NotificationEmitter(0.1)
+    
+    started = time.monotonic()
+    emitter.emit('processed_data_ready', {'seq': 0}, room='room-a')
+    time.sleep(0.05)  # 第一批已取走，正在阻塞发送
+    for seq in range(1, 6):
+        emitter.emit('processed_data_ready', {'seq': seq}, room='room-a')
+    emitter.emit('processed_data_ready', {'seq': 1}, room='room-b')
+    emitter.emit('adjust_capture', {'fps': 10}, room='room-a')
+    assert time.monotonic() - started < 1
+    assert emitter.stats()['pending'] == 3
+    
+    release.set()
+    deadline = time.time() + 5
+    while len(sent) < 4 and time.time() < deadline:
+        time.sleep(0.02)
+    assert [(event, data, room) for event, data, room, _ in sent] == [
+        ('processed_data_ready', {'seq': 0}, 'room-a'),
+        ('processed_data_ready', {'seq': 5, 'coalesced': 5}, 'room-a'),
+        ('processed_data_ready', {'seq': 1}, 'room-b'),
+        ('adjust_capture', {'fps': 10}, 'room-a'),
+    ]
+    assert {thread for *_, thread in sent} == {'notification-emitter'}
+    assert emitter.stats()['queued'] == 8 and emitter.stats()['sent'] == 4
+
+
+def reference_nv21_to_rgb(nv21, width, height):
+    """逐像素浮点计算的NV21转RGB（BT.601全范围），作为对照"""
+    rgb = np.empty((height, width, 3), dtype=np.uint8)
+    for row in range(height):
+        for col in range(width):
+            y = nv21[row * width + col]
+            chroma = width * height + (row // 2) * width + (col // 2) * 2
+            v, u = nv21[chroma] - 128, nv21[chroma + 1] - 128
+            values = (y + 1.402 * v, y - 0.344136 * u - 0.714136 * v, y + 1.772 * u)
+            rgb[row, col] = [min(255, max(0, round(value))) for value in values]
+    return rgb
+
+
+def test_nv21_to_rgb_matches_reference(streaming_module):
+    if streaming_module.np is None:
+        pytest.skip('需要numpy')
+    width, height = 32, 24
+    rng = np.random.default_rng(41)
+    nv21 = rng.integers(0, 256, width * height * 3 // 2, dtype=np.uint8).tobytes()
+    # 包含极端色度，检查截断
+    nv21 = bytes(16) + nv21[16:width * height] + bytes([0, 255, 255, 0]) + nv21[width * height + 4:]
+    
+    rgb = streaming_module.nv21_to_rgb(nv21, width, height)
+    reference = reference_nv21_to_rgb(nv21, width, height)
+    assert rgb.shape == (height, width, 3) and rgb.dtype == np.uint8
+    assert np.abs(rgb.astype(int) - reference.astype(int)).max() <= 1
+    
+    # 缩小输出等价于对原尺寸结果做最近邻采样
+    small = streaming_module.nv21_to_rgb(nv21, width, height, 8, 6)
+    rows = np.arange(6) * height // 6
+    cols = np.arange(8) * width // 8
+    assert np.array_equal(small, rgb[rows[:, None], cols])
+
+
+def test_rgb565_packs_little_endian(streaming_module):
+    if streaming_module.np is None:
+        pytest.skip('需要numpy')
+    rgb = np.array([[[255, 0, 0], [0, 255, 0], [0, 0, 255], [255, 255, 255], [8, 4, 8]]], dtype=np.uint8)
+    packed = streaming_module.rgb_to_rgb565(rgb)
+    assert packed.tolist() == [[0xF800, 0x07E0, 0x001F, 0xFFFF, 0x0821]]
+    assert packed.tobytes()[:2] == b'\x00\xf8'  # 小端序，与Bitmap.Config.RGB_565一致
+
+
+def test_frame_output_converts_once_per_format(streaming_module, make_stream):
+    if streaming_module.np is None:
+        pytest.skip('需要numpy')
+    stream = make_stream(width=WIDTH, height=HEIGHT)
+    header = bytes(streaming_module.FRAME_HEADER_SIZE)
+    frame = stream.get_frame(stream.publish_frame(header + gradient_frame()))
+    
+    rgb565 = stream.frame_output(frame, 'rgb565')
+    assert len(rgb565) == len(header) + WIDTH * HEIGHT * 2
+    assert stream.frame_output(frame, 'rgb565') is rgb565  # 所有订阅者共享同一份转换结果
+    rgb888 = stream.frame_output(frame, 'rgb888')
+    expected = streaming_module.nv21_to_rgb(gradient_frame(), WIDTH, HEIGHT).tobytes()
+    assert rgb888[len(header):] == expected
+    assert stream.frame_output(frame, 'nv21') is frame.data
+
+
+def test_congestion_controller_degrades_with_hysteresis_and_recovers(streaming_module, monkeypatch):
+    monkeypatch.setattr(streaming_module, 'CONGESTION_CHECK_INTERVAL', 0)
+    monkeypatch.setattr(streaming_module, 'CONGESTION_SETTLE_TIME', 0.2)
+    controller = streaming_module.CongestionController()
+    assert controller.level == streaming_module.CAPTURE_DEFAULT_LEVEL
+    
+    # 排队等待1秒、每帧处理0.4秒：处理能力约2.5fps
+    controller.record_processed(1.0, 0.4)
+    assert controller.evaluate(0) is None  # 一次拥塞不调整
+    adjustment = controller.evaluate(0)
+    assert adjustment['reason'] == 'congested'
+    # 直接降到帧率不超过处理能力80%的档位
+    assert adjustment['level'] == len(streaming_module.CAPTURE_LADDER) - 1
+    assert adjustment['fps'] <= 2.5 * streaming_module.CONGESTION_HEADROOM
+    assert adjustment['capacity_fps'] == 2.5
+    
+    # 调整后的稳定期内不再调整
+    for _ in range(3):
+        controller.record_processed(0.01, 0.01)
+    assert controller.evaluate(0) is None
+    time.sleep(0.25)
+    
+    # 持续空闲且处理能力足够时逐档回升
+    for _ in range(10):
+        controller.record_processed(0.01, 0.01)
+    adjustments = []
+    for _ in range(streaming_module.CONGESTION_UPGRADE_AFTER):
+        controller.record_upload(True)
+        adjustments.append(controller.evaluate(0))
+    assert adjustments[:-1] == [None] * (len(adjustments) - 1)
+    assert adjustments[-1]['reason'] == 'recovered'
+    assert adjustments[-1]['level'] == len(streaming_module.CAPTURE_LADDER) - 2
+
+
+def test_processing_loop_sends_adjust_capture_to_stream_room(streaming_module, monkeypatch):
+    monkeypatch.setattr(streaming_module, 'CONGESTION_CHECK_INTERVAL', 0)
+    emitted = []
+    monkeypatch.setattr(streaming_module.notification_emitter, 'emit',
+                        lambda event, data, room: emitted.append((event, data, room)))
+    client = streaming_module.app.test_client()
+    stream_id = client.post('/api/stream/start', json={
+        'device_id': 'congestion-test', 'width': WIDTH, 'height': HEIGHT}).get_json()['streamId']
+    try:
+        stream = streaming_module.active_streams[stream_id]
+        # 上传被拒绝率过高视为拥塞
+        for _ in range(10):
+            stream.congestion.record_upload(False)
+        deadline = time.time() + 5
+        while not emitted and time.time() < deadline:
+            for _ in range(10):
+                stream.congestion.record_upload(False)
+            time.sleep(0.05)
+        event, data, room = emitted[0]
+        assert event == 'adjust_capture' and room == f'stream_{stream_id}'
+        assert data['stream_id'] == stream_id and data['reason'] == 'congested'
+        assert data['level'] > streaming_module.CAPTURE_DEFAULT_LEVEL
+    finally:
+        client.post(f'/api/stream/{stream_id}/stop')
+
+
+def upload_raw(client, stream_id, frame):
+    return client.post(f'/api/stream/{stream_id}/chunk', data=frame,
+                       headers={'Content-Type': 'application/octet-stream'})
+
+
+def wait_seq(stream, seq, timeout=5):
+    deadline = time.time() + timeout
+    while stream.latest_seq < seq and time.time() < deadline:
+        time.sleep(0.02)
+    return stream.latest_seq >= seq
+
+
+def test_static_frames_send_repeat_markers(streaming_module):
+    client = streaming_module.app.test_client()
+    stream_id = client.post('/api/stream/start', json={
+        'device_id': 'static-test', 'width': WIDTH, 'height': HEIGHT, 'keyframes': False}).get_json()['streamId']
+    stream = streaming_module.active_streams[stream_id]
+    
+    # 原始字节流：内容相同的帧只发送一次
+    http_chunks = []
+    body = client.get(f'/api/stream/{stream_id}', buffered=False).iter_encoded()
+    reader = threading.Thread(target=lambda: http_chunks.extend(chunk for chunk in body if chunk))
+    reader.start()
+    socket_client = streaming_module.socketio.test_client(streaming_module.app)
+    try:
+        for _ in range(2):
+            assert upload_raw(client, stream_id, gradient_frame()).status_code == 200
+            assert wait_seq(stream, stream.latest_seq + 1)
+        assert stream.get_frame(2).is_repeat
+        
+        socket_client.emit('get_processed_chunk', {'stream_id': stream_id, 'after': 1})
+        chunks = [event['args'][0] for event in socket_client.get_received() if event['name'] == 'processed_chunk']
+        assert len(chunks) == 1
+        assert chunks[0]['repeat'] is True and chunks[0]['repeat_of'] == 1
+        assert 'data' not in chunks[0]
+        
+        socket_client.emit('get_processed_chunk', {'stream_id': stream_id, 'after': 0})
+        chunks = [event['args'][0] for event in socket_client.get_received() if event['name'] == 'processed_chunk']
+        assert [chunk['repeat'] for chunk in chunks] == [False, True]
+    finally:
+        socket_client.disconnect()
+        client.post(f'/api/stream/{stream_id}/stop')
+        reader.join(5)
+    assert len(http_chunks) == 1
+    assert http_chunks[0][streaming_module.FRAME_HEADER_SIZE:] != b''
+
+
+def test_benchmark_viewer_counts_repeat_markers(streaming_module):
+    import benchmark_streaming
+    stats = benchmark_streaming.RoundStats()
+    stats.receiving = True
+    viewer = benchmark_streaming.Viewer('http://127.0.0.1:1', 'stream', stats)
+    viewer._on_chunk({'stream_id': 'stream', 'seq': 2, 'repeat': True, 'repeat_of': 1})
+    assert stats.frames_repeated == 1 and stats.frames_received == 0
+
+
+def test_latency_budget_degrades_and_recovers_with_hysteresis(streaming_module, monkeypatch):
+    monkeypatch.setattr(streaming_module, 'LATENCY_TIER_HOLD', 0.1)
+    budget = streaming_module.LatencyBudget(1.0)
+    assert budget.is_expired(1.5) and not budget.is_expired(0.5)
+    assert streaming_module.LatencyBudget(0).is_expired(100) is False  # 预算为0时关闭
+    
+    # 平均延迟超过预算一半的帧连续达到阈值后降一级
+    changes = [budget.record(0.9, budget.tier) for _ in range(streaming_module.LATENCY_DEGRADE_AFTER + 3)]
+    assert [c for c in changes if c] == ['light']
+    assert budget.record(0.9) is None  # 保持期内不再调整
+    time.sleep(0.15)
+    changes = [budget.record(0.9) for _ in range(streaming_module.LATENCY_DEGRADE_AFTER)]
+    assert changes[-1] == 'passthrough'
+    
+    time.sleep(0.15)
+    changes = [budget.record(0.0) for _ in range(100)]
+    assert [c for c in changes if c] == ['light']  # 保持期内只升一级
+    time.sleep(0.15)
+    changes = [budget.record(0.0) for _ in range(100)]
+    assert [c for c in changes if c] == ['full']
+    assert budget.stats()['tier_changes'] == 4 and budget.stats()['expired_frames'] == 1
+
+
+def test_latency_budget_recovery_stops_at_requested_tier(streaming_module):
+    budget = streaming_module.LatencyBudget(1.0, streaming_module.PROCESSING_TIERS.index('light'))
+    assert all(budget.record(0.0) is None for _ in range(100))
+    assert budget.tier_name == 'light'
+
+
+def test_frames_past_budget_are_dropped_before_processing(streaming_module):
+    client = streaming_module.app.test_client()
+    stream_id = client.post('/api/stream/start', json={
+        'device_id': 'budget-test', 'width': WIDTH, 'height': HEIGHT, 'latency_budget_ms': 200,
+        'keyframes': False}).get_json()['streamId']
+    stream = streaming_module.active_streams[stream_id]
+    try:
+        stale = streaming_module.EncodedFrame('raw', gradient_frame())
+        stream.chunk_queue.put((stale, None, time.monotonic() - 1.0))
+        assert upload_raw(client, stream_id, gradient_frame(50)).status_code == 200
+        assert wait_seq(stream, 1)
+        time.sleep(0.1)
+        assert stream.latest_seq == 1  # 只处理了未过期的帧
+        assert stream.latency.stats()['expired_frames'] == 1
+    finally:
+        client.post(f'/api/stream/{stream_id}/stop')
+
+
+def upload_part(client, stream_id, seq, frame, start, end):
+    return client.post(f'/api/stream/{stream_id}/chunk', data=frame[start:end], headers={
+        'Content-Type': 'application/octet-stream', 'X-Frame-Seq': str(seq),
+        'X-Frame-Offset': str(start), 'X-Frame-Length': str(len(frame))})
+
+
+def test_chunks_reassemble_out_of_order_and_duplicated(streaming_module, make_stream):
+    stream = make_stream(width=WIDTH, height=HEIGHT, max_fps=0, max_bytes_per_sec=0)
+    client = streaming_module.app.test_client()
+    frame = gradient_frame(7)
+    third = FRAME_BYTES // 3
+    
+    parts = [(2 * third, FRAME_BYTES), (0, third), (0, third), (third // 2, 2 * third)]
+    results = [upload_part(client, stream.stream_id, 5, frame, *part).get_json() for part in parts]
+    assert [result['complete'] for result in results] == [False, False, False, True]
+    # 帧完成后迟到的重复数据块被拒绝，不会再次入队
+    assert upload_part(client, stream.stream_id, 5, frame, 0, third).status_code == 409
+    
+    assert stream.chunk_queue.qsize() == 1
+    assert stream.chunk_queue.get_nowait()[0].pixels() == frame
+    assert stream.assembler.stats() == {'pending': 0, 'completed': 1, 'evicted': 0}
+
+
+def test_stale_partial_frames_are_evicted_without_new_chunks(streaming_module, make_stream, monkeypatch):
+    monkeypatch.setattr(streaming_module, 'ASSEMBLY_TIMEOUT', 0.05)
+    stream = make_stream(width=WIDTH, height=HEIGHT, max_fps=0, max_bytes_per_sec=0)
+    client = streaming_module.app.test_client()
+    frame = gradient_frame()
+    
+    assert upload_part(client, stream.stream_id, 1, frame, 0, 100).status_code == 200
+    assert stream.assembler.expire() == 0
+    time.sleep(0.1)
+    assert stream.assembler.expire() == 1
+    assert upload_part(client, stream.stream_id, 1, frame, 100, FRAME_BYTES).status_code == 409
+    
+    assert upload_part(client, stream.stream_id, 2, frame, 0, 100).status_code == 200
+    stream.stop()
+    assert stream.assembler.stats() == {'pending': 0, 'completed': 0, 'evicted': 2}
+    assert stream.chunk_queue.empty()
+
+
+def test_frame_length_is_capped_by_negotiated_size(streaming_module, make_stream):
+    stream = make_stream(width=WIDTH, height=HEIGHT, max_fps=0, max_bytes_per_sec=0)
+    undeclared = make_stream(max_fps=0, max_bytes_per_sec=0)
+    client = streaming_module.app.test_client()
+    
+    # 声明的尺寸小于采集档位时按最大的采集档位（640x480）限制
+    limit = stream.assembler.max_frame_bytes
+    assert 640 * 480 * 3 // 2 < limit < 640 * 480 * 2
+    assert 1920 * 1080 * 3 // 2 < undeclared.assembler.max_frame_bytes < streaming_module.ASSEMBLY_MAX_FRAME_BYTES
+    
+    oversized = bytes(limit + 1)
+    response = upload_part(client, stream.stream_id, 1, oversized, 0, 10)
+    assert response.status_code == 413
+    assert stream.assembler.stats()['pending'] == 0
+
+
+def test_passthrough_frames_are_forwarded_in_requested_codec(streaming_module):
+    import base64
+    client = streaming_module.app.test_client()
+    stream_id = client.post('/api/stream/start', json={
+        'device_id': 'forward-test', 'width': WIDTH, 'height': HEIGHT, 'processing': 'passthrough',
+        'max_fps': 0, 'max_bytes_per_sec': 0}).get_json()['streamId']
+    stream = streaming_module.active_streams[stream_id]
+    header = streaming_module.FRAME_HEADER_SIZE
+    assert client.get(f'/api/stream/{stream_id}?codec=delta').status_code == 400
+    
+    http_chunks = []
+    body = client.get(f'/api/stream/{stream_id}?codec=zlib', buffered=False).iter_encoded()
+    reader = threading.Thread(target=lambda: http_chunks.extend(chunk for chunk in body if chunk))
+    reader.start()
+    socket_client = streaming_module.socketio.test_client(streaming_module.app)
+    try:
+        payload = zlib.compress(gradient_frame())
+        assert client.post(f'/api/stream/{stream_id}/chunk', data=payload, headers={
+            'Content-Type': 'application/octet-stream', 'X-Frame-Codec': 'zlib'}).status_code == 200
+        assert wait_seq(stream, 1)
+        
+        socket_client.emit('get_processed_chunk', {'stream_id': stream_id, 'codec': 'zlib'})
+        chunk = socket_client.get_received()[-1]['args'][0]
+        assert chunk['codec'] == 'zlib'
+        assert base64.b64decode(chunk['data'])[header:] == payload
+        assert (chunk['width'], chunk['height']) == (WIDTH, HEIGHT)
+        assert stream.get_frame(1).source.decoded is None
+        
+        socket_client.emit('get_processed_chunk', {'stream_id': stream_id, 'codec': 'zlib', 'format': 'rgb565'})
+        assert socket_client.get_received()[-1]['name'] == 'error'
+        
+        # 需要原始帧的观看端收到解码后的NV21
+        socket_client.emit('get_processed_chunk', {'stream_id': stream_id})
+        chunk = socket_client.get_received()[-1]['args'][0]
+        assert chunk['codec'] == 'raw'
+        assert base64.b64decode(chunk['data'])[header:] == gradient_frame()
+    finally:
+        socket_client.disconnect()
+        client.post(f'/api/stream/{stream_id}/stop')
+        reader.join(5)
+    record = b''.join(http_chunks)
+    assert record[:8] == b'zlib' + (header + len(payload)).to_bytes(4, byteorder='big')
+    assert record[8 + header:] == payload
+
+
+def noise_frame(seed):
+    return np.random.default_rng(seed).integers(0, 256, FRAME_BYTES, dtype=np.uint8).tobytes()
+
+
+def test_keyframes_select_sharp_novel_frames_and_store_them_compressed(streaming_module):
+    if streaming_module.np is None:
+        pytest.skip('需要numpy')
+    selector = streaming_module.KeyframeSelector()
+    size = (WIDTH, HEIGHT)
+    
+    first = selector.consider(noise_frame(1), size, 1)
+    assert first is not None and first.novelty is None
+    # 静态画面与上一关键帧相同，模糊（平坦）的画面清晰度不足
+    assert selector.consider(noise_frame(1), size, 2) is None
+    assert selector.consider(nv21_frame(), size, 3) is None
+    payload = zlib.compress(noise_frame(2))
+    second = selector.consider(noise_frame(2), size, 4, payload)
+    assert second is not None and second.novelty >= streaming_module.KEYFRAME_NOVELTY
+    
+    stats = selector.stats()
+    assert (stats['count'], stats['rejected_similar'], stats['rejected_blurry']) == (2, 1, 1)
+    # 保存压缩数据，上传的zlib数据直接复用，导出时解压
+    assert second.payload is payload
+    assert first.pixels() == noise_frame(1)
+    assert streaming_module.encode_keyframe(second, 'nv21') == noise_frame(2)
+
+
+def test_keyframe_selection_is_opt_in_and_archive_is_bounded(streaming_module, make_stream, monkeypatch):
+    assert make_stream().keyframes is None
+    client = streaming_module.app.test_client()
+    stream_id = client.post('/api/stream/start', json={'device_id': 'keyframe-default'}).get_json()['streamId']
+    assert streaming_module.active_streams[stream_id].keyframes is None
+    client.post(f'/api/stream/{stream_id}/stop')
+    monkeypatch.setattr(streaming_module, 'KEYFRAME_ARCHIVE_STREAMS', 2)
+    monkeypatch.setattr(streaming_module, 'keyframe_archive', streaming_module.OrderedDict())
+    
+    streams = [make_stream(select_keyframes=True) for _ in range(3)]
+    for stream in streams:
+        streaming_module.active_streams.pop(stream.stream_id)
+        streaming_module.archive_keyframes(stream)
+    
+    assert list(streaming_module.keyframe_archive) == [stream.stream_id for stream in streams[1:]]
+    assert streaming_module.keyframe_source(streams[0].stream_id) is None
+    assert streaming_module.keyframe_source(streams[2].stream_id) == (streams[2].device_id, streams[2].keyframes)